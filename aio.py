@@ -0,0 +1,162 @@
+# Asyncio API over db.py and analyse.py.
+#
+# SQLite calls run on worker threads: a bounded pool for reads and a single writer thread, each with its own
+# connection. The tracker owns these connections (they are not in the pool of connection.py) and closes them. Concurrent check-offs are queued and the writer stores everything that is
+# waiting as one transaction. A full queue makes checkoff_habit wait (backpressure). Dates are checked before a
+# check-off is queued, and a batch that fails anyway is written again check-off by check-off, so one caller's
+# error doesn't fail the others.
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from analyse import calculate_streak, get_longest_streak
+from db import DEFAULT_USER_ID, add_habit, checkoff_batch, get_all_habits, get_db, to_day
+
+
+class AsyncHabitTracker:
+
+    def __init__(self, name="main.db", workers=4, max_queue=1000, batch_size=500, user_id=DEFAULT_USER_ID):
+        """
+        Asynchronous access to a habit database. Use as "async with AsyncHabitTracker() as tracker:".
+        :param name: Name of the database file.
+        :param workers: Number of threads for read queries.
+        :param max_queue: Maximum number of queued check-offs and of read queries in flight.
+        :param batch_size: Maximum number of check-offs per transaction.
+        :param user_id: Id of the user whose habits are accessed.
+        """
+        self.name = name
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.readers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="habit-read")
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="habit-write")
+        self.read_slots = asyncio.Semaphore(max_queue)
+        self.checkoffs = asyncio.Queue(maxsize=max_queue)
+        self.writer_task = None
+        self.batches = 0
+        self.local = threading.local()  # Connection of each worker thread
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def start(self):
+        """Starts the task that writes queued check-offs. Called by "async with"."""
+        if self.writer_task is None:
+            self.writer_task = asyncio.get_running_loop().create_task(self._write_checkoffs())
+
+    async def close(self):
+        """Writes all queued check-offs, stops the worker threads and closes their connections."""
+        if self.writer_task is not None:
+            await self.checkoffs.join()
+            self.writer_task.cancel()
+            self.writer_task = None
+        self.readers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+        for db in connections:
+            db.close()
+
+    def _connection(self):
+        """Returns the connection of the current worker thread, opened on first use."""
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = get_db(self.name)
+            with self.connections_lock:
+                self.connections.append(db)
+        return db
+
+    async def _read(self, function, *args):
+        """Runs a read function for the user with a connection of a reader thread."""
+        async with self.read_slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.readers, lambda: function(self._connection(), *args, user_id=self.user_id))
+
+    async def _write(self, function, *args):
+        """Runs a write function for the user on the writer thread."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.writer, lambda: function(self._connection(), *args, user_id=self.user_id))
+
+    async def add_habit(self, name, periodicity):
+        """
+        Adds a new habit.
+        :param name: Name of the habit.
+        :param periodicity: Periodicity of the habit.
+        """
+        await self._write(add_habit, name, periodicity)
+
+    async def checkoff_habit(self, name, event_date=None):
+        """
+        Logs a check-off. Check-offs arriving at the same time are stored in one transaction.
+        Waits while the queue is full.
+        :param name: Name of the habit.
+        :param event_date: Date of completion (YYYY-MM-DD). Defaults to today.
+        :return: True if the check-off was new, False if it was already stored.
+        :raises ValueError: If the date is not a valid date.
+        """
+        to_day(event_date or date.today())  # Invalid dates fail here instead of the whole batch
+        self.start()
+        done = asyncio.get_running_loop().create_future()
+        await self.checkoffs.put((name, event_date, done))
+        return await done
+
+    async def get_all_habits(self):
+        """
+        Returns the names of all habits.
+        :return: list of habit names.
+        """
+        return await self._read(get_all_habits)
+
+    async def calculate_streak(self, habit, periodicity=None):
+        """
+        Returns the longest streak of a habit.
+        :param habit: Name of the habit.
+        :param periodicity: Periodicity to count the streak with. Defaults to the habit's own.
+        :return: Longest streak.
+        """
+        return await self._read(calculate_streak, habit, periodicity)
+
+    async def get_longest_streak(self):
+        """
+        Returns the habit with the longest streak.
+        :return: tuple: (habit name, longest streak)
+        """
+        return await self._read(get_longest_streak)
+
+    async def _write_checkoffs(self):
+        """Takes all waiting check-offs from the queue and writes them as one transaction."""
+        while True:
+            batch = [await self.checkoffs.get()]
+            while len(batch) < self.batch_size and not self.checkoffs.empty():
+                batch.append(self.checkoffs.get_nowait())
+
+            try:
+                await self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    self.checkoffs.task_done()
+
+    async def _write_batch(self, batch):
+        """
+        Writes queued check-offs as one transaction and resolves their futures.
+        If the transaction fails, every check-off is written on its own, so only the failing ones raise.
+        :param batch: List of tuples (habit name, date, future).
+        """
+        try:
+            inserted = await self._write(checkoff_batch, [(name, event_date) for name, event_date, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                for item in batch:
+                    await self._write_batch([item])
+            elif not batch[0][2].done():
+                batch[0][2].set_exception(e)
+            return
+        self.batches += 1
+        for (_, _, done), new in zip(batch, inserted):
+            if not done.done():
+                done.set_result(new)
@@ -1,80 +1,360 @@
-from db import get_db, get_habit_checkoffs, get_all_habits
-from datetime import datetime, timedelta
+import heapq
+import bitmap
+from db import (DEFAULT_USER, DEFAULT_USER_ID, get_day_bitmap, get_habit, get_habit_days, get_streak_state,
+                iter_days_in_range, iter_habits, iter_rollup_counts, to_day)
+from datetime import date
+from cache import cached
+from instrument import count, span
+from streaks import current_streak, period_index, period_indices, period_start, streak_runs
 
-def get_habits_by_periodicity(db, periodicity):
+# Backends of the analytics: "sqlite" reads the stored streaks, rollups and tracker index, "columnar" loads
+# the check-offs of the user into columns and computes all habits at once (see columnar.py).
+BACKENDS = ("sqlite", "columnar")
+
+def _load_columns(db, backend, user_id):
+    """
+    Loads the check-offs of a user for the columnar backend.
+    :param db: Database connection object.
+    :param backend: One of BACKENDS.
+    :param user_id: Id of the user.
+    :return: columnar.Columns, None for the sqlite backend.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if backend == "sqlite":
+        return None
+    from columnar import load_columns
+    return load_columns(db, user_id)
+
+@cached
+def get_habits_by_periodicity(db, periodicity, user_id=DEFAULT_USER_ID):
     """
     Returns a list of all habits that match the given periodicity.
     :param db: Database connection object.
     :param periodicity: Periodicity to filter by.
-    :return: List of habit names that match the periodicity.
+    :param user_id: Id of the user.
+    :return: List of habit names that match the periodicity, ordered by name.
     """
     try:
-        cur = db.cursor()
-        cur.execute("SELECT name FROM habit WHERE periodicity = ?", (periodicity,))
-        habits = [row[0] for row in cur.fetchall()]
-        return habits
+        return list(iter_habits(db, periodicity, user_id=user_id))
     except Exception as e:  # Catch potential database errors
         print(f"Error getting habits: {e}")  # Print error for debugging
+        count("analyse_errors")
         return []
 
-def get_longest_streak(db):
+@span("get_longest_streak")
+@cached
+def get_longest_streak(db, user_id=DEFAULT_USER_ID):
     """
-    Finds the habit with the longest streak among all tracked habits.
+    Finds the habit with the longest streak among all tracked habits of a user.
+    Ties go to the habit whose name comes first. A habit is returned even if no habit has a streak yet.
     :param db: Database connection object.
-    :return: tuple: (habit_name, longest streak)
+    :param user_id: Id of the user.
+    :return: tuple: (habit_name, longest streak), (None, 0) if the user has no habits.
     """
     try:
-        cur = db.cursor()
-        cur.execute("SELECT name, periodicity FROM habit")  # Get periodicity here
-        habits = cur.fetchall()
-
-        max_streak = 0
-        best_habit = None
-
-        for habit_name, periodicity in habits:  # Unpack the tuple directly
-            streak = calculate_streak(db, habit_name, periodicity)  # Pass periodicity to the function
-            if streak > max_streak:
-                max_streak = streak
-                best_habit = habit_name
-
-        return best_habit, max_streak
+        top = get_top_streaks(db, 1, user_id=user_id)
+        return top[0] if top else (None, 0)
     except Exception as e:
         print(f"Error getting longest streak: {e}")
+        count("analyse_errors")
         return None, 0
 
-def calculate_streak(db, habit, periodicity):
+@cached
+def get_top_streaks(db, limit=10, by="longest", today=None, user_id=DEFAULT_USER_ID, backend="sqlite"):
+    """
+    Ranks the habits of a user by their longest or their current streak.
+    The stored streaks are streamed once and only the best habits are kept in a heap.
+    :param db: Database connection object.
+    :param limit: Number of habits to return.
+    :param by: "longest" or "current".
+    :param today: Reference date for the current streak. Defaults to today.
+    :param user_id: Id of the user.
+    :param backend: One of BACKENDS.
+    :return: list of tuples (habit_name, streak), best first. Ties are ordered by name.
+    """
+    if by not in ("longest", "current"):
+        raise ValueError(f"Unknown ranking: {by}")
+    columns = _load_columns(db, backend, user_id)
+    if columns is not None:
+        from columnar import column_streaks
+        return rank_streaks(column_streaks(columns, today and date.fromordinal(to_day(today))), limit, by)
+    today = to_day(today or date.today())
+
+    cur = db.cursor()
+    cur.execute("""SELECT habit.name, habit.periodicity, s.current_streak, s.longest_streak, s.last_period
+    FROM habit LEFT JOIN streak_state s ON s.habit_id = habit.id WHERE habit.user_id=? ORDER BY habit.name""",
+                (user_id,))
+    if by == "longest":
+        streaks = ((name, longest or 0) for name, _periodicity, _last, longest, _period in cur)
+    else:
+        streaks = ((name, current_streak(last, last_period, period_index(today, periodicity)))
+                   for name, periodicity, last, _longest, last_period in cur)
+    # nlargest keeps the first of equal streaks, the rows are ordered by name
+    return heapq.nlargest(limit, streaks, key=lambda item: item[1])
+
+def rank_streaks(streaks, limit=10, by="longest"):
+    """
+    Ranks streaks that were not read by get_top_streaks, e.g. from a snapshot or the check-off log.
+    :param streaks: dict: {habit_name: (longest streak, current streak)}
+    :param limit: Number of habits to return.
+    :param by: "longest" or "current".
+    :return: list of tuples (habit_name, streak), best first. Ties are ordered by name.
+    """
+    if by not in ("longest", "current"):
+        raise ValueError(f"Unknown ranking: {by}")
+    index = 0 if by == "longest" else 1
+    return heapq.nlargest(limit, sorted((name, streak[index]) for name, streak in streaks.items()),
+                          key=lambda item: item[1])
+
+def get_snapshot_top_streaks(snapshot, limit=10, by="longest", today=None, user=DEFAULT_USER):
+    """
+    Ranks the habits of a user like get_top_streaks, from a snapshot file instead of the database.
+    The streaks of all habits are calculated at once on the memory-mapped columns, see columnar.py.
+    :param snapshot: snapshot.Snapshot object.
+    :param limit: Number of habits to return.
+    :param by: "longest" or "current".
+    :param today: Reference date for the current streak. Defaults to today.
+    :param user: Name of the user.
+    :return: list of tuples (habit_name, streak), best first. Ties are ordered by name.
+    """
+    from columnar import column_streaks
+    return rank_streaks(column_streaks(snapshot.columns(user), today), limit, by)
+
+def get_snapshot_completion_rates(snapshot, since, until, user=DEFAULT_USER):
+    """
+    Calculates the completion rates like get_completion_rates, from a snapshot file instead of the database.
+    :param snapshot: snapshot.Snapshot object.
+    :param since: First date of the range (date or YYYY-MM-DD).
+    :param until: Last date of the range (date or YYYY-MM-DD).
+    :param user: Name of the user.
+    :return: dict: {habit_name: completion rate between 0 and 1}, ordered by name.
+    """
+    from columnar import completion_rates
+    first, last = to_day(since), to_day(until)
+    if first > last:
+        raise ValueError("The start of the range is after its end.")
+    rates = completion_rates(snapshot.columns(user), date.fromordinal(first), date.fromordinal(last))
+    return dict(sorted(rates.items()))
+
+@cached
+def get_completion_rates(db, since, until, user_id=DEFAULT_USER_ID, backend="sqlite"):
+    """
+    Calculates for every habit the share of periods in a date range with at least one check-off.
+    Only the check-offs in the range are read from the database.
+    :param db: Database connection object.
+    :param since: First date of the range (date or YYYY-MM-DD).
+    :param until: Last date of the range (date or YYYY-MM-DD).
+    :param user_id: Id of the user.
+    :param backend: One of BACKENDS.
+    :return: dict: {habit_name: completion rate between 0 and 1}, ordered by name.
+    """
+    first, last = to_day(since), to_day(until)
+    if first > last:
+        raise ValueError("The start of the range is after its end.")
+    columns = _load_columns(db, backend, user_id)
+    if columns is not None:
+        from columnar import completion_rates
+        return dict(sorted(completion_rates(columns, date.fromordinal(first), date.fromordinal(last)).items()))
+
+    rates = {}
+    for name, periodicity, days in iter_days_in_range(db, since, until, user_id):
+        total = period_index(last, periodicity) - period_index(first, periodicity) + 1
+        rates[name] = len(set(period_indices(days, periodicity))) / total
+    return rates
+
+@cached
+def get_period_counts(db, habit, since=None, until=None, per=None, user_id=DEFAULT_USER_ID):
+    """
+    Counts the check-offs of a habit per period of its periodicity, e.g. per ISO week for a weekly habit.
+    The counts are read from the coarsest rollup that fits the periods and the range, see get_checkoff_counts.
+    :param db: Database connection object.
+    :param habit: Name of the habit.
+    :param since: First date of the range (date or YYYY-MM-DD). Defaults to the first check-off.
+    :param until: Last date of the range (date or YYYY-MM-DD). Defaults to the last check-off.
+    :param per: Periodicity of the periods. Defaults to the periodicity of the habit.
+    :param user_id: Id of the user the habit belongs to.
+    :return: dict: {first day of the period (YYYY-MM-DD): number of check-offs}, periods without check-offs
+             are left out. None if the habit does not exist.
+    """
+    cur = db.cursor()
+    cur.execute("SELECT periodicity FROM habit WHERE user_id=? AND name=?", (user_id, habit))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return _count_per_period(db, per or row[0], since, until, user_id, habit).get(habit, {})
+
+@cached
+def get_checkoff_counts(db, periodicity, since=None, until=None, user_id=DEFAULT_USER_ID, backend="sqlite"):
+    """
+    Counts the check-offs of every habit of a user per period, e.g. for a monthly dashboard.
+    The counts are read from the coarsest rollup table whose buckets lie inside the periods and whose bucket
+    edges match the range, e.g. the yearly rollup for whole years and the monthly one for half years.
+    Ranges that don't start or end on a bucket edge fall back to finer rollups, down to the tracker rows.
+    :param db: Database connection object.
+    :param periodicity: Periodicity of the periods (daily, weekly, monthly, bi-annually or annually).
+    :param since: First date of the range (date or YYYY-MM-DD). Defaults to the first check-off.
+    :param until: Last date of the range (date or YYYY-MM-DD). Defaults to the last check-off.
+    :param user_id: Id of the user.
+    :param backend: One of BACKENDS.
+    :return: dict: {habit_name: {first day of the period (YYYY-MM-DD): number of check-offs}},
+             habits and periods without check-offs are left out.
+    """
+    columns = _load_columns(db, backend, user_id)
+    if columns is not None:
+        from columnar import period_counts
+        return period_counts(columns, periodicity, since and date.fromordinal(to_day(since)),
+                             until and date.fromordinal(to_day(until)))
+    return _count_per_period(db, periodicity, since, until, user_id)
+
+# Rollup grains whose buckets lie completely inside one period of a periodicity, coarsest first.
+# "daily" stands for the tracker rows, which fit every periodicity and range.
+_NESTED_GRAINS = {
+    "daily": ("daily",),
+    "weekly": ("weekly", "daily"),
+    "monthly": ("monthly", "daily"),
+    "bi-annually": ("monthly", "daily"),
+    "annually": ("annually", "monthly", "daily"),
+}
+
+def _choose_grain(periodicity, first, last):
+    """
+    Returns the coarsest grain that answers a count per period over a range of days.
+    :param periodicity: Periodicity of the periods.
+    :param first: First day of the range, None if it is open.
+    :param last: Last day of the range, None if it is open.
+    :return: Rollup grain or "daily".
+    """
+    if periodicity not in _NESTED_GRAINS:
+        raise ValueError(f"Unknown periodicity: {periodicity}")
+    for grain in _NESTED_GRAINS[periodicity]:
+        starts_on_edge = first is None or period_index(first - 1, grain) != period_index(first, grain)
+        ends_on_edge = last is None or period_index(last + 1, grain) != period_index(last, grain)
+        if starts_on_edge and ends_on_edge:
+            return grain
+
+def _count_per_period(db, periodicity, since, until, user_id, name=None):
+    """
+    Adds up the rollup counts per period, see get_checkoff_counts.
+    :param name: Name of a habit. Defaults to all habits of the user.
+    :return: dict: {habit_name: {first day of the period (YYYY-MM-DD): number of check-offs}}
+    """
+    periodicity = periodicity.lower()
+    first = to_day(since) if since else None
+    last = to_day(until) if until else None
+    grain = _choose_grain(periodicity, first, last)
+
+    starts = {}  # Bucket -> first day of its period, the habits share the buckets
+    counts = {}
+    rows = iter_rollup_counts(db, grain, first and period_index(first, grain), last and period_index(last, grain),
+                              name, user_id=user_id)
+    for habit, bucket, checkoffs in rows:
+        start = starts.get(bucket)
+        if start is None:
+            day = bucket if grain == "daily" else period_start(bucket, grain).toordinal()
+            start = starts[bucket] = period_start(period_index(day, periodicity), periodicity).isoformat()
+        habit_counts = counts.setdefault(habit, {})
+        habit_counts[start] = habit_counts.get(start, 0) + checkoffs
+    return counts
+
+@cached
+def get_all_streaks(db, today=None, user_id=DEFAULT_USER_ID, backend="sqlite"):
+    """
+    Returns the longest and the current streak of every habit of a user.
+    The streaks are read from the streak_state table, which is kept up to date on every check-off.
+    :param db: Database connection object.
+    :param today: Reference date for the current streak. Defaults to today.
+    :param user_id: Id of the user.
+    :param backend: One of BACKENDS.
+    :return: dict: {habit_name: (longest streak, current streak)}
+    """
+    columns = _load_columns(db, backend, user_id)
+    if columns is not None:
+        from columnar import column_streaks
+        return column_streaks(columns, today)
+    today = (today or date.today()).toordinal()
+
+    cur = db.cursor()
+    cur.execute("""SELECT habit.name, habit.periodicity, s.current_streak, s.longest_streak, s.last_period
+    FROM habit LEFT JOIN streak_state s ON s.habit_id = habit.id WHERE habit.user_id=?""", (user_id,))
+
+    streaks = {}
+    for name, periodicity, last_streak, longest, last_period in cur:
+        current = current_streak(last_streak, last_period, period_index(today, periodicity))
+        streaks[name] = (longest or 0, current)
+    return streaks
+
+@cached
+def get_streak_as_of(db, habit, day, user_id=DEFAULT_USER_ID):
+    """
+    Calculates the streaks of a habit as they were on a given day, from its day bitmap.
+    Daily streaks are runs of set bits, for other periodicities the days are mapped to their periods first.
+    :param db: Database connection object.
+    :param habit: Name of the habit.
+    :param day: Reference date (date or YYYY-MM-DD), later check-offs are ignored.
+    :param user_id: Id of the user the habit belongs to.
+    :return: tuple: (longest streak, current streak), None if the habit does not exist.
+    """
+    found = get_habit(db, habit, user_id)
+    if found is None:
+        return None
+    periodicity = found[1]
+    first_day, bits = get_day_bitmap(db, habit, user_id)
+    day = to_day(day)
+
+    if periodicity.lower() == "daily":
+        longest = max((length for _start, length in bitmap.iter_runs(first_day, bits, day)), default=0)
+        return longest, bitmap.run_until(first_day, bits, day) or bitmap.run_until(first_day, bits, day - 1)
+
+    days = list(bitmap.iter_days(first_day, bits, day))
+    if not days:
+        return 0, 0
+    periods = period_indices(days, periodicity)
+    longest, last = streak_runs(periods)
+    return longest, current_streak(last, int(periods[-1]), period_index(day, periodicity))
+
+@cached
+def get_done_on(db, day, user_id=DEFAULT_USER_ID):
+    """
+    Lists the habits of a user that were checked off on a given day.
+    Only the day bitmaps are scanned, one byte per habit is checked.
+    :param db: Database connection object.
+    :param day: Date (date or YYYY-MM-DD).
+    :param user_id: Id of the user.
+    :return: List of habit names, ordered by name.
+    """
+    day = to_day(day)
+    cur = db.cursor()
+    cur.execute("""SELECT habit.name, d.first_day, d.bits FROM habit JOIN habit_days d ON d.habit_id = habit.id
+    WHERE habit.user_id=? AND d.first_day <= ? ORDER BY habit.name""", (user_id, day))
+    return [name for name, first_day, bits in cur if bitmap.has_day(first_day, bits, day)]
+
+@span("calculate_streak")
+@cached
+def calculate_streak(db, habit, periodicity=None, user_id=DEFAULT_USER_ID):
     """
     Calculates the longest streak for a given habit, respecting its periodicity.
+    The stored streak is used unless a periodicity different from the habit's own is given.
     :param db: Database connection object.
     :param habit: Name of the habit.
-    :param periodicity: Periodicity of the habit (daily, weekly, etc.).
+    :param periodicity: Periodicity of the habit (daily, weekly, etc.). Defaults to the stored one.
+    :param user_id: Id of the user the habit belongs to.
     :return: Longest streak for the habit.
     """
     try:
-        data = get_habit_checkoffs(db, habit)
-        if not data:
+        cur = db.cursor()
+        cur.execute("SELECT periodicity FROM habit WHERE user_id=? AND name=?", (user_id, habit))
+        row = cur.fetchone()
+        if row and (periodicity is None or periodicity.lower() == row[0].lower()):
+            return get_streak_state(db, habit, user_id=user_id)[0]
+
+        days = get_habit_days(db, habit, user_id)
+        if not days:
             return 0  # No data means no streak.
 
-        dates = sorted([datetime.strptime(entry[0], "%Y-%m-%d") for entry in data])
-
-        gap_mapping = {
-            "daily": timedelta(days=1),
-            "weekly": timedelta(weeks=1),
-            "monthly": timedelta(weeks=4),  # Approximation
-            "bi-annually": timedelta(weeks=26),
-            "annually": timedelta(weeks=52),
-        }
-        expected_gap = gap_mapping.get(periodicity.lower(), timedelta(days=1))
-
-        streak = max_streak = 1
-        for i in range(1, len(dates)):
-            if dates[i] - dates[i - 1] == expected_gap:
-                streak += 1
-            else:
-                max_streak = max(max_streak, streak)
-                streak = 1
-
-        return max(max_streak, streak)
+        periodicity = periodicity or "daily"
+        return streak_runs(period_indices(days, periodicity))[0]
     except Exception as e:
         print(f"Error calculating streak for {habit}: {e}")
-        return 0
\ No newline at end of file
+        count("analyse_errors")
+        return 0
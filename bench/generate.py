@@ -0,0 +1,99 @@
+# Deterministic generator for synthetic habit tracker databases.
+#
+# Usage: python -m bench.generate bench.db --habits 1000 --days 3650
+import random
+from datetime import date, timedelta
+import click
+from db import DEFAULT_USER_ID, checkoff_many, get_db, get_user_id
+
+# Default share of habits per periodicity.
+DEFAULT_MIX = {"daily": 0.5, "weekly": 0.3, "monthly": 0.1, "bi-annually": 0.05, "annually": 0.05}
+
+# Average number of days between two check-offs per periodicity.
+INTERVALS = {"daily": 1, "weekly": 7, "monthly": 30, "bi-annually": 182, "annually": 365}
+
+
+def generate_checkoffs(rng, name, periodicity, start, days, irregular_rate, duplicate_rate):
+    """
+    Generates the check-offs of one habit.
+    :param rng: random.Random instance.
+    :param name: Name of the habit.
+    :param periodicity: Periodicity of the habit.
+    :param start: First day of the history.
+    :param days: Length of the history in days.
+    :param irregular_rate: Share of periods that are skipped or done off-schedule.
+    :param duplicate_rate: Share of check-offs that are logged twice.
+    :return: Generator of (habit name, date) pairs.
+    """
+    interval = INTERVALS[periodicity]
+    for offset in range(0, days, interval):
+        if rng.random() < irregular_rate:
+            if rng.random() < 0.5:
+                continue  # Skipped period
+            offset += rng.randrange(interval + 1)  # Off-schedule check-off
+        if offset >= days:
+            break
+        event_date = start + timedelta(days=offset + rng.randrange(interval) // 2)
+        yield name, event_date
+        if rng.random() < duplicate_rate:
+            yield name, event_date
+
+
+def generate(path, habits=100, days=365, mix=None, irregular_rate=0.1, duplicate_rate=0.01, seed=0,
+             end=date(2025, 12, 31), users=1):
+    """
+    Creates a database with synthetic habits and check-offs. The same arguments always give the same data.
+    :param path: Path of the database file.
+    :param habits: Number of habits.
+    :param days: Length of the check-off history in days.
+    :param mix: dict {periodicity: weight}. Defaults to DEFAULT_MIX.
+    :param irregular_rate: Share of periods that are skipped or done off-schedule.
+    :param duplicate_rate: Share of check-offs that are logged twice.
+    :param seed: Random seed.
+    :param end: Last day of the history.
+    :param users: Number of users. The habits are dealt out to the users in turn,
+                  the first user is the default user.
+    :return: Number of stored check-offs.
+    """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    periodicities = rng.choices(list(mix), weights=list(mix.values()), k=habits)
+    start = end - timedelta(days=days - 1)
+
+    db = get_db(path, seed=False)
+    user_ids = [DEFAULT_USER_ID] + [get_user_id(db, f"user-{u:06d}", create=True) for u in range(1, users)]
+    with db:
+        db.executemany("INSERT OR IGNORE INTO habit (user_id, name, periodicity) VALUES (?, ?, ?)",
+                       [(user_ids[i % users], f"habit-{i:06d}", periodicity)
+                        for i, periodicity in enumerate(periodicities)])
+
+    inserted = 0
+    for u, user_id in enumerate(user_ids):
+        checkoffs = (checkoff
+                     for i, periodicity in enumerate(periodicities) if i % users == u
+                     for checkoff in generate_checkoffs(rng, f"habit-{i:06d}", periodicity, start, days,
+                                                        irregular_rate, duplicate_rate))
+        inserted += checkoff_many(db, checkoffs, batch_size=50000, user_id=user_id)
+    db.close()
+    return inserted
+
+
+@click.command()
+@click.argument("path")
+@click.option("--habits", default=100, show_default=True, help="Number of habits.")
+@click.option("--days", default=365, show_default=True, help="Length of the history in days.")
+@click.option("--mix", default=None, help="Periodicity mix, e.g. daily=0.7,weekly=0.3.")
+@click.option("--irregular-rate", default=0.1, show_default=True, help="Share of skipped or off-schedule periods.")
+@click.option("--duplicate-rate", default=0.01, show_default=True, help="Share of check-offs logged twice.")
+@click.option("--seed", default=0, show_default=True, help="Random seed.")
+@click.option("--users", default=1, show_default=True, help="Number of users the habits are spread over.")
+def main(path, habits, days, mix, irregular_rate, duplicate_rate, seed, users):
+    """Generate a synthetic habit tracker database."""
+    if mix:
+        mix = {key: float(value) for key, value in (item.split("=") for item in mix.split(","))}
+    inserted = generate(path, habits, days, mix, irregular_rate, duplicate_rate, seed, users=users)
+    click.echo(f"✅ Generated {habits} habits of {users} users with {inserted} check-offs in {path}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# Benchmark runner for the db and analyse hot paths.
+#
+# Usage: python -m bench.run --habits 1000 --days 3650 --output results.json
+#        python -m bench.run --compare results.json   (fails if a benchmark got slower)
+#        python -m bench.run --db main.db              (runs on a copy, the file itself is not changed)
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from urllib.parse import quote
+import click
+from analyse import calculate_streak, get_habits_by_periodicity, get_longest_streak
+from bench.generate import generate
+from cache import analytics_cache
+from db import DEFAULT_USER_ID, checkoff_habit, get_all_habits, get_db
+
+
+def copy_database(path, destination):
+    """
+    Copies a database file with the SQLite backup API, including changes still in its WAL file.
+    The source is opened read-only, so it is neither changed nor upgraded.
+    :param path: Path of the database file.
+    :param destination: Path of the copy.
+    """
+    source = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True)
+    copy = sqlite3.connect(destination)
+    try:
+        source.backup(copy)
+    finally:
+        copy.close()
+        source.close()
+
+
+def measure(function, repeat, setup=None):
+    """
+    Calls a function repeatedly and collects the wall-clock durations.
+    :param function: Function without arguments.
+    :param repeat: Number of calls.
+    :param setup: Optional function called before every call, not timed.
+    :return: dict with timing statistics in seconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return {
+        "repeat": repeat,
+        "min": durations[0],
+        "median": statistics.median(durations),
+        "mean": statistics.fmean(durations),
+        "p95": durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        "max": durations[-1],
+    }
+
+
+def run_benchmarks(path, repeat, seed=0):
+    """
+    Times the hot paths against an existing database.
+    :param path: Path of the database file.
+    :param repeat: Number of calls per benchmark.
+    :param seed: Random seed for the choice of habits.
+    :return: dict {benchmark name: timing statistics}
+    """
+    rng = random.Random(seed)
+    db = get_db(path, seed=False)
+    habits = db.execute("SELECT name, periodicity FROM habit WHERE user_id=?", (DEFAULT_USER_ID,)).fetchall()
+    name, periodicity = rng.choice(habits)
+    checkoff_days = iter(range(1, repeat + 1))
+
+    benchmarks = {
+        "get_db": lambda: get_db(path, seed=False).close(),
+        "checkoff_habit": lambda: checkoff_habit(db, name, date(2026, 1, 1) + timedelta(days=next(checkoff_days))),
+        "get_all_habits": lambda: get_all_habits(db),
+        "get_habits_by_periodicity": lambda: get_habits_by_periodicity(db, periodicity),
+        "calculate_streak": lambda: calculate_streak(db, rng.choice(habits)[0]),
+        "calculate_streak_recompute": lambda: calculate_streak(db, name, "daily" if periodicity != "daily" else "weekly"),
+        "get_longest_streak": lambda: get_longest_streak(db),
+    }
+    # The analytics cache is emptied before every call, so the hot paths are timed and not cache hits
+    results = {key: measure(function, repeat, analytics_cache.clear) for key, function in benchmarks.items()}
+    db.close()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares median timings with a baseline run.
+    :param results: Results of this run.
+    :param baseline: Results of the baseline run.
+    :param threshold: Allowed slowdown factor.
+    :return: List of (benchmark name, slowdown factor) for all regressions.
+    """
+    regressions = []
+    for key, timing in results["benchmarks"].items():
+        old = baseline["benchmarks"].get(key)
+        if old and old["median"] > 0 and timing["median"] / old["median"] > threshold:
+            regressions.append((key, timing["median"] / old["median"]))
+    return regressions
+
+
+@click.command()
+@click.option("--habits", default=1000, show_default=True, help="Number of generated habits.")
+@click.option("--days", default=730, show_default=True, help="Length of the generated history in days.")
+@click.option("--repeat", default=50, show_default=True, help="Calls per benchmark.")
+@click.option("--seed", default=0, show_default=True, help="Random seed of the generator.")
+@click.option("--db", "path", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Benchmark a copy of an existing database instead of a generated one.")
+@click.option("--output", type=click.File("w"), default="-", help="JSON output file. Defaults to stdout.")
+@click.option("--compare", "baseline", type=click.File("r"), default=None, help="Baseline JSON to compare with.")
+@click.option("--threshold", default=1.25, show_default=True, help="Allowed slowdown against the baseline.")
+def main(habits, days, repeat, seed, path, output, baseline, threshold):
+    """Benchmark the db and analyse hot paths and write the results as JSON."""
+    with tempfile.TemporaryDirectory() as tmp:
+        if path is None:
+            path = os.path.join(tmp, "bench.db")
+            checkoffs = generate(path, habits, days, seed=seed)
+        else:
+            copy = os.path.join(tmp, "bench.db")
+            copy_database(path, copy)  # checkoff_habit writes, the user's data stays as it is
+            path, checkoffs = copy, None
+        benchmarks = run_benchmarks(path, repeat, seed)
+
+    results = {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "parameters": {"habits": habits, "days": days, "checkoffs": checkoffs, "repeat": repeat, "seed": seed},
+        "benchmarks": benchmarks,
+    }
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+    if baseline:
+        regressions = compare(results, json.load(baseline), threshold)
+        for key, factor in regressions:
+            click.echo(f"⚠️ {key} is {factor:.2f}x slower than the baseline.", err=True)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+# Load and concurrency stress test for the storage layer.
+#
+# Usage: python -m bench.stress --writers 16 --readers 4 --duration 30 --output stress.json
+#        python -m bench.stress --journal-mode DELETE --batch 20      (compare with other settings)
+#        python -m bench.stress --strategy log                         (writers append to the check-off log)
+#
+# N writers and M analytics readers run against a temporary database for a fixed time, as processes (like
+# concurrent "main.py checkoff" calls) or as threads (like the GUI's background thread). Every writer checks off
+# its own (habit, day) pairs, so the number of stored check-offs is known exactly and checked at the end, along
+# with the streak state, day bitmaps and rollups derived from them. The readers bypass the analytics cache, so
+# their latencies are SQLite reads; --cache runs them through the cache and reports its hit rate. The results are
+# written as JSON.
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, timedelta
+import click
+
+# First day of the check-offs, far away from today so the streaks of the stress habits stay short.
+START = date(2000, 1, 1)
+
+# Seconds between two compactions of the check-off log with --strategy log.
+COMPACT_INTERVAL = 0.5
+
+
+def configure(journal_mode, synchronous, busy_timeout):
+    """
+    Sets the connection settings of this process before any connection is opened.
+    :param journal_mode: SQLite journal mode, e.g. WAL or DELETE.
+    :param synchronous: SQLite synchronous setting, e.g. NORMAL or FULL.
+    :param busy_timeout: Seconds a connection waits for a lock.
+    """
+    import connection
+    connection.PRAGMAS = {**connection.PRAGMAS, "journal_mode": journal_mode, "synchronous": synchronous}
+    connection.BUSY_TIMEOUT = busy_timeout
+
+
+def prepare(path, habits, journal_mode="WAL"):
+    """
+    Creates the database of a stress run with daily habits stress_0, stress_1, ...
+    :param path: Path of the database file.
+    :param habits: Number of habits.
+    :param journal_mode: SQLite journal mode, stored in the file for WAL.
+    """
+    from db import DEFAULT_USER_ID, get_db
+    configure(journal_mode, "NORMAL", 10.0)
+    db = get_db(path, seed=False)
+    with db:
+        db.executemany("INSERT INTO habit (user_id, name, periodicity) VALUES (?, ?, 'daily')",
+                       [(DEFAULT_USER_ID, f"stress_{i}") for i in range(habits)])
+    db.close()
+
+
+def _is_locked(error):
+    """Checks whether an error is SQLite's "database is locked" (or busy) error."""
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+
+def _wait(start_at):
+    """Sleeps until the common start time of all workers."""
+    time.sleep(max(0.0, start_at - time.time()))
+
+
+def writer(params, index, start_at, deadline):
+    """
+    Checks off habits until the deadline. Writer i uses the days START + i, START + i + writers, ...
+    so the check-offs of different writers never collide.
+    :param params: dict of the run parameters, see run_stress.
+    :param index: Number of the writer.
+    :param start_at: Start time (time.time()).
+    :param deadline: End time (time.time()).
+    :return: dict with role, ops, checkoffs, latencies, locked and errors.
+    """
+    configure(params["journal_mode"], params["synchronous"], params["busy_timeout"])
+    from connection import open_connection
+    from db import checkoff_batch, checkoff_habit
+    from eventlog import EventLog
+
+    db = open_connection(params["path"])
+    log = EventLog.for_database(params["path"])
+    habits, batch_size = params["habits"], params["batch"]
+    result = {"role": "writer", "ops": 0, "checkoffs": 0, "latencies": [], "locked": 0, "errors": 0}
+    counter = 0
+    _wait(start_at)
+    while time.time() < deadline:
+        batch = []
+        for _ in range(batch_size):
+            event_date = START + timedelta(days=index + counter // habits * params["writers"])
+            batch.append((f"stress_{counter % habits}", event_date))
+            counter += 1
+
+        start = time.perf_counter()
+        try:
+            if params["strategy"] == "log":
+                log.append(batch)
+            elif batch_size == 1:
+                checkoff_habit(db, *batch[0])
+            else:
+                checkoff_batch(db, batch)
+        except sqlite3.OperationalError as e:
+            db.rollback()
+            result["locked" if _is_locked(e) else "errors"] += 1
+            counter -= batch_size  # Try the same check-offs again
+            continue
+        result["latencies"].append(time.perf_counter() - start)
+        result["ops"] += 1
+        result["checkoffs"] += len(batch)
+    db.close()
+    return result
+
+
+def reader(params, index, start_at, deadline):
+    """
+    Runs the analytics queries in turn until the deadline. The analytics cache is bypassed, so every query
+    reads SQLite and competes with the writers, unless the run uses the cache (params["cache"]).
+    :param params: dict of the run parameters, see run_stress.
+    :param index: Number of the reader.
+    :param start_at: Start time (time.time()).
+    :param deadline: End time (time.time()).
+    :return: dict with role, ops, latencies, locked, errors and, with the cache, the cache hits and misses
+             of this process.
+    """
+    configure(params["journal_mode"], params["synchronous"], params["busy_timeout"])
+    from analyse import get_checkoff_counts, get_completion_rates, get_top_streaks
+    from cache import analytics_cache
+    from connection import open_connection
+
+    functions = [get_top_streaks, get_completion_rates, get_checkoff_counts]
+    if not params["cache"]:
+        functions = [function.__wrapped__ for function in functions]  # The undecorated functions
+    top_streaks, rates, counts = functions
+    db = open_connection(params["path"])
+    until = START + timedelta(days=365)
+    queries = [
+        lambda: top_streaks(db, 10),
+        lambda: rates(db, START, until),
+        lambda: counts(db, "monthly"),
+    ]
+    result = {"role": "reader", "ops": 0, "latencies": [], "locked": 0, "errors": 0}
+    before = analytics_cache.stats()
+    _wait(start_at)
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            queries[(index + result["ops"]) % len(queries)]()
+        except sqlite3.OperationalError as e:
+            result["locked" if _is_locked(e) else "errors"] += 1
+            continue
+        result["latencies"].append(time.perf_counter() - start)
+        result["ops"] += 1
+    db.close()
+    if params["cache"]:
+        after = analytics_cache.stats()
+        result["cache"] = {key: after[key] - before[key] for key in ("hits", "misses")}
+    return result
+
+
+def compactor(params, start_at, deadline):
+    """
+    Merges the check-off log into the database every COMPACT_INTERVAL seconds until the deadline.
+    :param params: dict of the run parameters, see run_stress.
+    :param start_at: Start time (time.time()).
+    :param deadline: End time (time.time()).
+    :return: dict with role, ops, checkoffs, latencies, locked and errors.
+    """
+    configure(params["journal_mode"], params["synchronous"], params["busy_timeout"])
+    from connection import open_connection
+    from eventlog import EventLog
+
+    db = open_connection(params["path"])
+    log = EventLog.for_database(params["path"])
+    result = {"role": "compactor", "ops": 0, "checkoffs": 0, "latencies": [], "locked": 0, "errors": 0}
+    _wait(start_at)
+    while time.time() < deadline:
+        time.sleep(COMPACT_INTERVAL)
+        start = time.perf_counter()
+        try:
+            result["checkoffs"] += log.compact(db)
+        except sqlite3.OperationalError as e:
+            db.rollback()
+            result["locked" if _is_locked(e) else "errors"] += 1
+            continue
+        result["latencies"].append(time.perf_counter() - start)
+        result["ops"] += 1
+    db.close()
+    return result
+
+
+def summarise(results, duration):
+    """
+    Adds up the results of all workers of one role.
+    :param results: List of worker results.
+    :param duration: Length of the run in seconds.
+    :return: dict with workers, ops, checkoffs, throughput (ops per second), latency percentiles in
+             seconds, locked and errors.
+    """
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+    ops = sum(result["ops"] for result in results)
+
+    def percentile(share):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * share))] if latencies else None
+
+    summary = {
+        "workers": len(results),
+        "ops": ops,
+        "throughput": ops / duration,
+        "latency": {"p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99),
+                    "max": latencies[-1] if latencies else None},
+        "locked": sum(result["locked"] for result in results),
+        "errors": sum(result["errors"] for result in results),
+    }
+    if results and "cache" in results[0]:
+        hits = sum(result["cache"]["hits"] for result in results)
+        lookups = hits + sum(result["cache"]["misses"] for result in results)
+        summary["cache_hit_rate"] = hits / lookups if lookups else 0.0
+    if results and "checkoffs" in results[0]:
+        summary["checkoffs"] = sum(result["checkoffs"] for result in results)
+        summary["checkoffs_per_second"] = summary["checkoffs"] / duration
+    return summary
+
+
+def check_integrity(path, expected):
+    """
+    Compares the stored check-offs with the number the writers reported and checks that the streak state,
+    day bitmaps and rollups agree with the tracker table.
+    :param path: Path of the database file.
+    :param expected: Number of check-offs the writers stored.
+    :return: dict with expected, rows, duplicates and ok flags.
+    """
+    from connection import open_connection
+    from db import _rebuild_day_bitmaps, _rebuild_rollups, _rebuild_streak_state
+
+    derived_tables = {
+        "streaks": "SELECT * FROM streak_state ORDER BY habit_id",
+        "bitmaps": "SELECT * FROM habit_days ORDER BY habit_id",
+        "rollups": "SELECT * FROM checkoff_rollup ORDER BY habit_id, grain, bucket",
+    }
+    db = open_connection(path)
+    cur = db.cursor()
+    rows = cur.execute("SELECT COUNT(*) FROM tracker").fetchone()[0]
+    distinct = cur.execute("SELECT COUNT(*) FROM (SELECT DISTINCT habit_id, day FROM tracker)").fetchone()[0]
+    stored = {key: cur.execute(sql).fetchall() for key, sql in derived_tables.items()}
+
+    # Rebuild the derived tables from the tracker table in a transaction that is rolled back afterwards
+    _rebuild_streak_state(cur)
+    _rebuild_day_bitmaps(cur)
+    _rebuild_rollups(cur)
+    rebuilt = {key: cur.execute(sql).fetchall() for key, sql in derived_tables.items()}
+    db.rollback()
+    db.close()
+
+    integrity = {
+        "expected": expected,
+        "rows": rows,
+        "duplicates": rows - distinct,
+        "rows_ok": rows == expected == distinct,
+        **{f"{key}_ok": stored[key] == rebuilt[key] for key in derived_tables},
+    }
+    integrity["ok"] = all(value for key, value in integrity.items() if key.endswith("_ok"))
+    return integrity
+
+
+def run_stress(path, writers=8, readers=2, duration=10.0, mode="process", habits=50, batch=1, strategy="direct",
+               journal_mode="WAL", synchronous="NORMAL", busy_timeout=5.0, cache=False):
+    """
+    Runs writers and readers against a database for a fixed time and checks the result.
+    :param path: Path of a new database file.
+    :param writers: Number of writers.
+    :param readers: Number of analytics readers.
+    :param duration: Length of the run in seconds.
+    :param mode: "process" or "thread".
+    :param habits: Number of habits the writers check off.
+    :param batch: Check-offs per transaction (or per log append).
+    :param strategy: "direct" writes the database, "log" appends to the check-off log and compacts it.
+    :param journal_mode: SQLite journal mode.
+    :param synchronous: SQLite synchronous setting.
+    :param busy_timeout: Seconds a connection waits for a lock before "database is locked".
+    :param cache: Let the readers use the analytics cache and report its hit rate.
+    :return: dict with parameters, writers, readers, compactor and integrity.
+    """
+    params = {"path": path, "writers": writers, "habits": habits, "batch": batch, "strategy": strategy,
+              "journal_mode": journal_mode, "synchronous": synchronous, "busy_timeout": busy_timeout,
+              "cache": cache}
+    import connection
+    from cache import analytics_cache
+    settings = connection.PRAGMAS, connection.BUSY_TIMEOUT
+    try:
+        prepare(path, habits, journal_mode)
+
+        workers = writers + readers + (strategy == "log")
+        executor = ProcessPoolExecutor(max_workers=workers) if mode == "process" else ThreadPoolExecutor(workers)
+        start_at = time.time() + (1.0 if mode == "process" else 0.1)  # Time to start the processes
+        deadline = start_at + duration
+        before = analytics_cache.stats()
+        with executor:
+            write_jobs = [executor.submit(writer, params, i, start_at, deadline) for i in range(writers)]
+            read_jobs = [executor.submit(reader, params, i, start_at, deadline) for i in range(readers)]
+            compact_jobs = [executor.submit(compactor, params, start_at, deadline)] if strategy == "log" else []
+            write_results = [job.result() for job in write_jobs]
+            read_results = [job.result() for job in read_jobs]
+            compact_results = [job.result() for job in compact_jobs]
+        after = analytics_cache.stats()
+
+        if strategy == "log":  # Merge what the writers appended after the last compaction
+            from eventlog import EventLog
+            db = connection.open_connection(path)
+            EventLog.for_database(path).compact(db)
+            db.close()
+
+        if cache and mode == "thread" and read_results:  # The threads share one cache, so their counts overlap
+            for result in read_results:
+                result["cache"] = {"hits": 0, "misses": 0}
+            read_results[0]["cache"] = {key: after[key] - before[key] for key in ("hits", "misses")}
+        results = {
+            "parameters": {key: value for key, value in params.items() if key != "path"},
+            "writers": summarise(write_results, duration),
+            "readers": summarise(read_results, duration),
+            "integrity": check_integrity(path, sum(result["checkoffs"] for result in write_results)),
+        }
+    finally:
+        connection.PRAGMAS, connection.BUSY_TIMEOUT = settings  # Threads change the settings of this process
+    if compact_results:
+        results["compactor"] = summarise(compact_results, duration)
+    results["parameters"].update(readers=readers, duration=duration, mode=mode)
+    return results
+
+
+@click.command()
+@click.option("--writers", default=8, show_default=True, help="Number of writers.")
+@click.option("--readers", default=2, show_default=True, help="Number of analytics readers.")
+@click.option("--duration", default=10.0, show_default=True, help="Length of the run in seconds.")
+@click.option("--mode", type=click.Choice(["process", "thread"]), default="process", show_default=True,
+              help="Run the writers and readers as processes or as threads of one process.")
+@click.option("--habits", default=50, show_default=True, help="Number of habits the writers check off.")
+@click.option("--batch", default=1, show_default=True, help="Check-offs per transaction (or per log append).")
+@click.option("--strategy", type=click.Choice(["direct", "log"]), default="direct", show_default=True,
+              help="Write the database directly or append to the check-off log and compact it.")
+@click.option("--journal-mode", type=click.Choice(["WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY"],
+                                                  case_sensitive=False), default="WAL", show_default=True)
+@click.option("--synchronous", type=click.Choice(["OFF", "NORMAL", "FULL"], case_sensitive=False),
+              default="NORMAL", show_default=True)
+@click.option("--busy-timeout", default=5.0, show_default=True, help="Seconds to wait for a lock.")
+@click.option("--cache", is_flag=True, help="Let the readers use the analytics cache and report its hit rate.")
+@click.option("--db", "path", default=None, help="Path of the database file. Defaults to a temporary file.")
+@click.option("--output", type=click.File("w"), default="-", help="JSON output file. Defaults to stdout.")
+def main(writers, readers, duration, mode, habits, batch, strategy, journal_mode, synchronous, busy_timeout, cache,
+         path, output):
+    """Stress the storage layer with concurrent writers and readers and write the results as JSON."""
+    with tempfile.TemporaryDirectory() as tmp:
+        if path is None:
+            path = os.path.join(tmp, "stress.db")
+        elif os.path.exists(path):
+            raise click.ClickException(f"{path} already exists, the stress test needs a new database.")
+        results = run_stress(path, writers, readers, duration, mode, habits, batch, strategy, journal_mode.upper(),
+                             synchronous.upper(), busy_timeout, cache)
+
+    results = {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        **results,
+    }
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+    if not results["integrity"]["ok"]:
+        click.echo("⚠️ The database does not match the check-offs of the writers.", err=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Day bitmaps: the check-off days of a habit as one bit per day, starting at the day of its first check-off.
+#
+# Bit i (byte i // 8, bit i % 8) stands for the day first_day + i, so checking a single day only reads one byte.
+# For runs and streaks the bytes are read as one Python integer, where runs of consecutive days are runs of set
+# bits that can be skipped with a few integer operations instead of looking at every day.
+
+
+def from_days(days):
+    """
+    Builds the bitmap of a set of days.
+    :param days: Iterable of day numbers, duplicates are allowed.
+    :return: tuple: (first day, bytes), (None, b"") if there are no days.
+    """
+    days = list(days)
+    if not days:
+        return None, b""
+    first_day = min(days)
+    bits = 0
+    for day in days:
+        bits |= 1 << (day - first_day)
+    return first_day, _to_bytes(bits)
+
+
+def add_day(first_day, bits, day):
+    """
+    Sets the bit of a day, moving the start of the bitmap if the day is older than the first day.
+    :param first_day: First day of the bitmap, None for an empty bitmap.
+    :param bits: Bitmap bytes.
+    :param day: Day number.
+    :return: tuple: (first day, bytes)
+    """
+    if first_day is None:
+        return day, b"\x01"
+    value = int.from_bytes(bits, "little")
+    if day < first_day:
+        value <<= first_day - day
+        first_day = day
+    return first_day, _to_bytes(value | 1 << (day - first_day))
+
+
+def has_day(first_day, bits, day):
+    """
+    Checks whether the bit of a day is set.
+    :param first_day: First day of the bitmap, None for an empty bitmap.
+    :param bits: Bitmap bytes.
+    :param day: Day number.
+    :return: bool
+    """
+    if first_day is None or day < first_day:
+        return False
+    offset = day - first_day
+    return offset < len(bits) * 8 and bool(bits[offset >> 3] >> (offset & 7) & 1)
+
+
+def iter_days(first_day, bits, until=None):
+    """
+    Yields the days whose bits are set, in ascending order.
+    :param first_day: First day of the bitmap, None for an empty bitmap.
+    :param bits: Bitmap bytes.
+    :param until: Last day to yield. Defaults to all days.
+    :return: Generator of day numbers.
+    """
+    for start, length in iter_runs(first_day, bits, until):
+        yield from range(start, start + length)
+
+
+def iter_runs(first_day, bits, until=None):
+    """
+    Yields the runs of consecutive days, in ascending order.
+    Every run costs a few integer operations, independent of its length.
+    :param first_day: First day of the bitmap, None for an empty bitmap.
+    :param bits: Bitmap bytes.
+    :param until: Last day to look at. Defaults to all days.
+    :return: Generator of tuples (first day of the run, length).
+    """
+    if first_day is None:
+        return
+    value = int.from_bytes(bits, "little")
+    if until is not None:
+        if until < first_day:
+            return
+        value &= (1 << (until - first_day + 1)) - 1
+    day = first_day
+    while value:
+        gap = (value & -value).bit_length() - 1  # Unset bits before the run
+        value >>= gap
+        length = (~value & (value + 1)).bit_length() - 1  # Set bits of the run
+        value >>= length
+        yield day + gap, length
+        day += gap + length
+
+
+def run_until(first_day, bits, day):
+    """
+    Returns the length of the run of consecutive days that ends on a day.
+    :param first_day: First day of the bitmap, None for an empty bitmap.
+    :param bits: Bitmap bytes.
+    :param day: Last day of the run.
+    :return: Number of days, 0 if the bit of the day is not set.
+    """
+    if not has_day(first_day, bits, day):
+        return 0
+    width = day - first_day + 1
+    unset = ~int.from_bytes(bits, "little") & ((1 << width) - 1)  # Unset bits up to the day
+    return width - unset.bit_length()
+
+
+def _to_bytes(value):
+    """Converts the integer form of a bitmap back to bytes."""
+    return value.to_bytes((value.bit_length() + 7) // 8, "little")
@@ -0,0 +1,142 @@
+import copy
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from functools import wraps
+from itertools import count
+from db import data_version
+
+
+class AnalyticsCache:
+
+    def __init__(self, maxsize=256, ttl=60.0):
+        """
+        A bounded LRU cache for analytics results. Every entry remembers the data version
+        of the database it was computed from and is only returned while that version is current.
+        :param maxsize: Maximum number of entries.
+        :param ttl: Seconds after which an entry expires, None for no expiry.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (version, expires, value)
+        self.lock = threading.RLock()  # forget can run from the garbage collector while the lock is held
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        """
+        Looks up a result.
+        :param key: Cache key.
+        :param version: Current data version of the database.
+        :return: tuple: (found, value)
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry_version, expires, value = entry
+                if entry_version == version and (expires is None or expires > time.monotonic()):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, version, value):
+        """
+        Stores a result and evicts the least recently used entries beyond maxsize.
+        :param key: Cache key.
+        :param version: Data version the result was computed from.
+        :param value: The result.
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (version, expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def forget(self, token):
+        """
+        Removes all entries of a connection.
+        :param token: Token of the connection, see connection_token.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == token]:
+                del self.entries[key]
+
+    def clear(self):
+        """Removes all entries and resets the statistics."""
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Returns the cache statistics.
+        :return: dict with hits, misses, hit rate, evictions, size and maxsize.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+            }
+
+
+# Cache shared by all analytics functions of this process.
+analytics_cache = AnalyticsCache()
+
+
+# Tokens of the live connections. Unlike id(), a token is never reused by a later connection.
+_tokens = weakref.WeakKeyDictionary()
+_next_token = count()
+_tokens_lock = threading.Lock()
+
+
+def connection_token(db):
+    """
+    Returns the number that identifies a connection in the cache keys. The entries of a connection
+    are removed when it is garbage collected.
+    :param db: Database connection object.
+    :return: int, None for connections that can't be weakly referenced (not opened through connection.py).
+    """
+    with _tokens_lock:
+        try:
+            token = _tokens.get(db)
+            if token is None:
+                token = _tokens[db] = next(_next_token)
+                weakref.finalize(db, analytics_cache.forget, token)
+        except TypeError:
+            return None
+    return token
+
+
+def cached(function):
+    """
+    Decorator for analytics functions that take the database connection as first argument.
+    Results are cached per connection and arguments until the database is written.
+    Connections that can't be weakly referenced are not cached.
+    Deep copies are returned, so callers can't change the cached results, not even nested ones.
+    """
+    @wraps(function)
+    def wrapper(db, *args, **kwargs):
+        token = connection_token(db)
+        if token is None:
+            return function(db, *args, **kwargs)
+        key = (token, function.__name__, args, tuple(sorted(kwargs.items())))
+        version = data_version(db)
+        found, value = analytics_cache.get(key, version)
+        if not found:
+            value = function(db, *args, **kwargs)
+            analytics_cache.put(key, version, value)
+        return copy.deepcopy(value)
+
+    return wrapper
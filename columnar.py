@@ -0,0 +1,216 @@
+# Columnar analytics backend.
+#
+# The check-offs of all habits of a user are loaded into two compact int32 columns, the habit id and the day
+# number, sorted by habit and day. Habit names and periodicities are dictionary-encoded: the habit id in the
+# columns is the index into Columns.names (not the id in the database). Streaks, completion rates and
+# per-period counts are then computed for all habits at once with NumPy (diff, cumsum and group boundaries).
+# Without NumPy the same results are computed per habit with the pure Python streak rules.
+# The analytics in analyse.py use this backend with backend="columnar", snapshot files always do.
+from array import array
+from bisect import bisect_right
+from datetime import date
+from itertools import groupby, repeat
+from operator import itemgetter
+from db import DEFAULT_USER_ID
+from streaks import current_streak, load_numpy, period_index, period_indices, period_start, streak_runs
+
+# The columnar backend is only used for analytics over many check-offs, so NumPy is imported right away.
+np = load_numpy()
+
+
+class Columns:
+
+    def __init__(self, names, periodicities, habit_ids, days):
+        """
+        Check-offs of all habits in columnar form.
+        :param names: List of habit names, the position is the habit id.
+        :param periodicities: List of periodicities, in the same order as names.
+        :param habit_ids: int32 habit id of every check-off, sorted.
+        :param days: int32 day number of every check-off, sorted within each habit.
+        """
+        self.names = names
+        self.periodicities = periodicities
+        self.habit_ids = habit_ids
+        self.days = days
+
+    def __len__(self):
+        return len(self.days)
+
+    def groups(self):
+        """
+        Yields the check-offs of every habit, including habits without check-offs.
+        :return: Generator of tuples (habit id, days).
+        """
+        start = 0
+        for habit_id in range(len(self.names)):
+            end = bisect_right(self.habit_ids, habit_id, lo=start)
+            yield habit_id, self.days[start:end]
+            start = end
+
+
+def load_columns(db, user_id=DEFAULT_USER_ID):
+    """
+    Loads all check-offs of a user from the database into columns.
+    :param db: Database connection object.
+    :param user_id: Id of the user.
+    :return: Columns object.
+    """
+    cur = db.cursor()
+    cur.execute("SELECT id, name, periodicity FROM habit WHERE user_id=? ORDER BY id", (user_id,))
+    habits = cur.fetchall()
+    positions = {habit: position for position, (habit, _name, _periodicity) in enumerate(habits)}
+
+    # One scan of the user's part of the (user_id, habit_id, day) index, already in column order
+    habit_ids = array("i")
+    days = array("i")
+    cur.execute("SELECT habit_id, day FROM tracker WHERE user_id=? ORDER BY habit_id, day", (user_id,))
+    for habit, rows in groupby(cur, key=itemgetter(0)):
+        if habit in positions:
+            count = len(days)
+            days.extend(row[1] for row in rows)
+            habit_ids.extend(repeat(positions[habit], len(days) - count))
+
+    return Columns([name for _, name, _ in habits], [periodicity for _, _, periodicity in habits], habit_ids, days)
+
+
+def _as_numpy(columns):
+    """Returns zero-copy NumPy views of the habit id and day columns."""
+    return np.frombuffer(columns.habit_ids, dtype=np.int32), np.frombuffer(columns.days, dtype=np.int32)
+
+
+def _row_periods(periodicities, habit_ids, days):
+    """
+    Maps every check-off to the period index of its habit's periodicity.
+    :return: NumPy array of period indices.
+    """
+    periods = np.empty(len(days), dtype=np.int64)
+    codes = {periodicity: code for code, periodicity in enumerate(sorted(set(periodicities)))}
+    row_codes = np.array([codes[p] for p in periodicities], dtype=np.int16)[habit_ids]
+    for periodicity, code in codes.items():
+        mask = row_codes == code
+        if mask.any():
+            periods[mask] = period_indices(days[mask], periodicity)
+    return periods
+
+
+def _group_starts(habit_ids, periods):
+    """
+    Marks the first check-off of every (habit, period) group. Rows must be sorted by habit and period.
+    :return: NumPy bool array.
+    """
+    starts = np.ones(len(periods), dtype=bool)
+    starts[1:] = (habit_ids[1:] != habit_ids[:-1]) | (periods[1:] != periods[:-1])
+    return starts
+
+
+def column_streaks(columns, today=None):
+    """
+    Calculates the longest and the current streak of every habit.
+    :param columns: Columns object.
+    :param today: Reference date for the current streak. Defaults to today.
+    :return: dict: {habit_name: (longest streak, current streak)}
+    """
+    today = (today or date.today()).toordinal()
+    today_periods = [period_index(today, periodicity) for periodicity in columns.periodicities]
+
+    if np is None:
+        streaks = {}
+        for habit_id, days in columns.groups():
+            periods = period_indices(days, columns.periodicities[habit_id])
+            longest, last = streak_runs(periods)
+            last_period = periods[-1] if periods else None
+            streaks[columns.names[habit_id]] = (longest, current_streak(last, last_period, today_periods[habit_id]))
+        return streaks
+
+    count = len(columns.names)
+    longest = np.zeros(count, dtype=np.int64)
+    last = np.zeros(count, dtype=np.int64)
+    last_period = np.full(count, np.iinfo(np.int64).min // 2, dtype=np.int64)
+
+    habit_ids, days = _as_numpy(columns)
+    periods = _row_periods(columns.periodicities, habit_ids, days)
+    first = _group_starts(habit_ids, periods)  # Several check-offs in one period count once
+    habit_ids, periods = habit_ids[first], periods[first]
+    if len(periods):
+        # A run starts with every new habit and every gap of more than one period
+        starts = np.ones(len(periods), dtype=bool)
+        starts[1:] = (habit_ids[1:] != habit_ids[:-1]) | (periods[1:] - periods[:-1] != 1)
+        run_lengths = np.bincount(np.cumsum(starts) - 1)
+        run_habits = habit_ids[starts]
+        np.maximum.at(longest, run_habits, run_lengths)
+
+        # The last run of every habit
+        is_last = np.append(run_habits[1:] != run_habits[:-1], True)
+        last[run_habits[is_last]] = run_lengths[is_last]
+        habit_ends = np.append(habit_ids[1:] != habit_ids[:-1], True)
+        last_period[habit_ids[habit_ends]] = periods[habit_ends]
+
+    current = np.where(np.array(today_periods) - last_period <= 1, last, 0)
+    return {name: (int(longest[i]), int(current[i])) for i, name in enumerate(columns.names)}
+
+
+def completion_rates(columns, since, until):
+    """
+    Calculates for every habit the share of periods between two dates with at least one check-off.
+    :param columns: Columns object.
+    :param since: First date of the range.
+    :param until: Last date of the range.
+    :return: dict: {habit_name: completion rate between 0 and 1}
+    """
+    since, until = since.toordinal(), until.toordinal()
+    totals = [period_index(until, p) - period_index(since, p) + 1 for p in columns.periodicities]
+
+    if np is None:
+        done = []
+        for habit_id, days in columns.groups():
+            in_range = [day for day in days if since <= day <= until]
+            done.append(len(set(period_indices(in_range, columns.periodicities[habit_id]))))
+    else:
+        habit_ids, days = _as_numpy(columns)
+        mask = (days >= since) & (days <= until)
+        habit_ids, days = habit_ids[mask], days[mask]
+        first = _group_starts(habit_ids, _row_periods(columns.periodicities, habit_ids, days))
+        done = np.bincount(habit_ids[first], minlength=len(columns.names)).tolist()
+
+    return {name: done[i] / totals[i] for i, name in enumerate(columns.names)}
+
+
+def period_counts(columns, periodicity=None, since=None, until=None):
+    """
+    Counts the check-offs of every habit per period, like analyse.get_checkoff_counts.
+    :param columns: Columns object.
+    :param periodicity: Periodicity of the periods. Defaults to the periodicity of each habit.
+    :param since: First date of the range. Defaults to the first check-off.
+    :param until: Last date of the range. Defaults to the last check-off.
+    :return: dict: {habit_name: {first day of the period (YYYY-MM-DD): number of check-offs}},
+             habits and periods without check-offs are left out.
+    """
+    periodicities = [periodicity.lower()] * len(columns.names) if periodicity else columns.periodicities
+    first = since.toordinal() if since else None
+    last = until.toordinal() if until else None
+    counts = {}  # habit id -> {period index: number of check-offs}
+
+    if np is None:
+        for habit_id, days in columns.groups():
+            days = [day for day in days if (first is None or day >= first) and (last is None or day <= last)]
+            for period in period_indices(days, periodicities[habit_id]):
+                habit_counts = counts.setdefault(habit_id, {})
+                habit_counts[period] = habit_counts.get(period, 0) + 1
+    else:
+        habit_ids, days = _as_numpy(columns)
+        mask = np.ones(len(days), dtype=bool)
+        if first is not None:
+            mask &= days >= first
+        if last is not None:
+            mask &= days <= last
+        habit_ids, days = habit_ids[mask], days[mask]
+        periods = _row_periods(periodicities, habit_ids, days)
+        starts = _group_starts(habit_ids, periods)
+        group_counts = np.diff(np.append(np.flatnonzero(starts), len(periods)))
+        for habit_id, period, count in zip(habit_ids[starts].tolist(), periods[starts].tolist(),
+                                           group_counts.tolist()):
+            counts.setdefault(habit_id, {})[period] = count
+
+    return {columns.names[habit_id]: {period_start(period, periodicities[habit_id]).isoformat(): count
+                                      for period, count in habit_counts.items()}
+            for habit_id, habit_counts in counts.items()}
@@ -0,0 +1,118 @@
+import atexit
+import sqlite3
+import threading
+from contextlib import contextmanager
+from instrument import instrument_connection
+
+# PRAGMAs applied to every new connection.
+PRAGMAS = {
+    "journal_mode": "WAL",  # Readers don't block the writer and vice versa
+    "synchronous": "NORMAL",  # Safe in WAL mode, avoids an fsync per commit
+    "cache_size": -16000,  # Negative values are KiB, i.e. 16 MB page cache
+    "mmap_size": 268435456,  # Map up to 256 MB of the database file into memory
+    "temp_store": "MEMORY",
+}
+
+# Number of prepared statements each connection keeps in its cache.
+STATEMENT_CACHE_SIZE = 256
+
+# Seconds to wait for a lock held by another connection before failing.
+BUSY_TIMEOUT = 10.0
+
+
+
+class Connection(sqlite3.Connection):
+    """sqlite3 connection that can be weakly referenced, so per-connection caches are dropped together with it."""
+
+
+_local = threading.local()
+_lock = threading.Lock()
+_connections = []
+
+
+def open_connection(name="main.db"):
+    """
+    Opens a new tuned connection to the SQLite database.
+    :param name: Name of the database file. Defaults to "main.db".
+    :return: Database connection object.
+    """
+    # The pool makes sure a connection is only used by the thread that opened it,
+    # check_same_thread is switched off so close_all can close it at exit.
+    db = sqlite3.connect(name, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE,
+                         check_same_thread=False, factory=Connection)
+    for pragma, value in PRAGMAS.items():
+        db.execute(f"PRAGMA {pragma} = {value}")
+    instrument_connection(db)
+    return db
+
+
+def get_connection(name="main.db"):
+    """
+    Returns the connection of the current thread to the given database.
+    The connection is opened (and the schema created) on first use and reused afterwards.
+    :param name: Name of the database file. Defaults to "main.db".
+    :return: Database connection object.
+    """
+    connections = _local.__dict__.setdefault("connections", {})
+    db = connections.get(name)
+    if db is None:
+        from db import get_db
+        db = get_db(name)
+        connections[name] = db
+        with _lock:
+            _connections.append(db)
+    return db
+
+
+@contextmanager
+def session(name="main.db", readonly=False):
+    """
+    Context manager around the reused connection of the current thread.
+    Commits when the block succeeds and rolls back when it raises.
+    :param name: Name of the database file. Defaults to "main.db".
+    :param readonly: Refuse writes (PRAGMA query_only) and end without a commit.
+    :return: Database connection object.
+    """
+    db = get_connection(name)
+    if readonly:
+        db.execute("PRAGMA query_only = ON")
+    try:
+        yield db
+        if readonly:
+            db.rollback()
+        else:
+            db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        if readonly:
+            db.execute("PRAGMA query_only = OFF")
+
+
+def close_connection(name="main.db"):
+    """
+    Closes the connection of the current thread to the given database, if it is open.
+    :param name: Name of the database file. Defaults to "main.db".
+    """
+    db = _local.__dict__.get("connections", {}).pop(name, None)
+    if db is not None:
+        with _lock:
+            _connections.remove(db)
+        db.close()
+
+
+def close_all():
+    """Closes all connections opened by the pool."""
+    with _lock:
+        connections = list(_connections)
+        _connections.clear()
+    _local.__dict__.pop("connections", None)
+    for db in connections:
+        try:
+            db.close()
+        except sqlite3.Error:
+            pass
+
+
+atexit.register(close_all)
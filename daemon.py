@@ -0,0 +1,157 @@
+# Daemon mode: "main.py serve" keeps a warm database connection and the analytics cache in one process
+# and answers requests on a Unix domain socket. The protocol is JSON lines, one request and one response
+# per line:
+#   request:  {"op": "checkoff", "params": {"name": "Yoga", "date": "2025-01-01"}}
+#   response: {"ok": true, "result": null, "output": "..."}  or  {"ok": false, "error": "..."}
+# "output" holds everything the operation printed, so the client can show it.
+#
+# The client side (request) only needs the standard library, the server imports the database modules lazily.
+import json
+import os
+import socket
+
+# Seconds a client waits for the daemon before falling back to direct database access.
+CONNECT_TIMEOUT = 0.5
+
+
+class DaemonUnavailable(Exception):
+    """No daemon is serving the socket."""
+
+
+class DaemonError(Exception):
+    """The daemon could not run the requested operation."""
+
+
+def socket_path(db_name="main.db"):
+    """
+    Returns the socket path of the daemon serving a database.
+    Can be overridden with the environment variable HABITTRACKER_SOCKET.
+    :param db_name: Name of the database file.
+    :return: Path of the Unix domain socket.
+    """
+    return os.environ.get("HABITTRACKER_SOCKET", f"{db_name}.sock")
+
+
+def request(op, db_name="main.db", **params):
+    """
+    Sends one request to the daemon and prints what the operation printed.
+    :param op: Name of the operation, see operations.OPERATIONS.
+    :param db_name: Name of the database file.
+    :param params: Parameters of the operation.
+    :return: Result of the operation.
+    :raises DaemonUnavailable: If no daemon is running or the daemon mode is switched off.
+    :raises DaemonError: If the operation failed in the daemon.
+    """
+    path = socket_path(db_name)
+    if os.environ.get("HABITTRACKER_NO_DAEMON") or not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        raise DaemonUnavailable(path)
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(path)
+            sock.settimeout(None)
+            with sock.makefile("rwb") as stream:
+                stream.write(json.dumps({"op": op, "params": params}).encode() + b"\n")
+                stream.flush()
+                line = stream.readline()
+    except OSError as e:
+        raise DaemonUnavailable(path) from e
+    if not line:
+        raise DaemonUnavailable(path)
+
+    response = json.loads(line)
+    if response.get("output"):
+        print(response["output"], end="")
+    if not response["ok"]:
+        raise DaemonError(response["error"])
+    return response["result"]
+
+
+def handle(db, line):
+    """
+    Runs one request line against the database.
+    :param db: Database connection object.
+    :param line: JSON request line.
+    :return: JSON response line.
+    """
+    import contextlib
+    import io
+    from operations import OPERATIONS
+
+    output = io.StringIO()
+    try:
+        message = json.loads(line)
+        operation = OPERATIONS[message["op"]]
+        with contextlib.redirect_stdout(output):
+            result = operation(db, **message.get("params", {}))
+        db.commit()
+        response = {"ok": True, "result": result, "output": output.getvalue()}
+    except Exception as e:
+        db.rollback()
+        response = {"ok": False, "error": f"{type(e).__name__}: {e}", "output": output.getvalue()}
+    return json.dumps(response).encode() + b"\n"
+
+
+def serve(db_name="main.db", path=None):
+    """
+    Serves requests until the process is interrupted. Requests are handled one at a time
+    on a single warm connection, in the order they arrive. Between requests the check-off log
+    is compacted every COMPACT_INTERVAL seconds.
+    :param db_name: Name of the database file.
+    :param path: Path of the Unix domain socket. Defaults to socket_path(db_name).
+    """
+    import signal
+    import socketserver
+    import threading
+    import time
+    from connection import get_connection
+    from eventlog import COMPACT_INTERVAL, EventLog
+
+    def stop(_signum, _frame):
+        raise KeyboardInterrupt
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, stop)  # Remove the socket on "kill" as well
+
+    path = path or socket_path(db_name)
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+            raise RuntimeError(f"A daemon is already serving {path}")
+        except ConnectionRefusedError:
+            os.remove(path)  # Left over from a daemon that did not shut down cleanly
+
+    db = get_connection(db_name)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if line.strip():
+                    self.wfile.write(handle(db, line))
+                    self.wfile.flush()
+
+    class Server(socketserver.UnixStreamServer):
+        last_compaction = 0.0
+
+        def service_actions(self):
+            # Called by serve_forever between requests, so the compaction never runs during one
+            if time.monotonic() - self.last_compaction >= COMPACT_INTERVAL:
+                self.last_compaction = time.monotonic()
+                try:
+                    if log.has_pending():
+                        log.compact(db)
+                        db.commit()
+                except Exception as e:
+                    db.rollback()
+                    print(f"Error compacting the check-off log: {e}")
+
+    log = EventLog.for_database(db_name)
+    with Server(path, Handler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
@@ -1,147 +1,908 @@
-import sqlite3
+import os
+from collections import Counter
 from datetime import date
+from itertools import groupby, islice
+import bitmap
+from connection import open_connection
+from streaks import current_streak, extend_streak, period_index, period_indices, streak_runs
 
-def get_db(name="main.db"):
+def get_db(name="main.db", seed=True):
     """
-    Creates and returns a connection to the SQLite database.
+    Creates and returns a new connection to the SQLite database.
     If the database does not exist, it will be created.
+    Use connection.session() to reuse one connection per thread instead.
+    Default habits are only inserted the first time a database is opened.
+    Seeding can be switched off with seed=False or the environment variable HABITTRACKER_NO_SEED=1,
+    e.g. for production databases.
     :param name: Name of the database file. Defaults to "main.db".
+    :param seed: Whether to insert the default habits into a new database.
     :return: Database connection object.
     """
-    db = sqlite3.connect(name)
+    db = open_connection(name)
     create_tables(db)
-    insert_default_data(db) # Insert default habits
+    if seed and not os.environ.get("HABITTRACKER_NO_SEED") and not is_seeded(db):
+        insert_default_data(db) # Insert default habits
     return db
 
+# Number of writes made by this process, see data_version.
+_write_count = 0
+
+def data_version(db):
+    """
+    Returns a value that changes whenever the database content changes.
+    PRAGMA data_version changes with commits of other connections, the write count with
+    writes through this module (add_habit, checkoff_habit, ...) in this process.
+    :param db: Database connection object.
+    :return: tuple: (data version, write count)
+    """
+    return db.execute("PRAGMA data_version").fetchone()[0], _write_count
+
+def _bump_data_version():
+    """Marks that the database content has changed, which invalidates cached analytics results."""
+    global _write_count
+    _write_count += 1
+
+# Habits and check-offs that are stored without naming a user belong to the default user.
+DEFAULT_USER = "default"
+DEFAULT_USER_ID = 1
+
+# Offset between SQLite julian day numbers and Python date ordinals.
+JULIAN_DAY_OFFSET = 1721424.5
+
 def create_tables(db):
     """
-    Creates the necessary tables for tracking habits and their check-ins.
+    Creates the necessary tables for tracking habits and their check-ins
+    and upgrades older database files in place.
 
     Tables:
-        - habit: Stores habit names and their periodicity.
-        - tracker: Logs the dates when a habit is completed.
+        - user: Stores the users, every user has their own habits.
+        - habit: Stores habit names and their periodicity, the name is unique per user.
+        - tracker: Logs the days when a habit is completed, one row per habit and day.
+
+    The schema version is stored in PRAGMA user_version. Every migration in
+    MIGRATIONS that is newer than the stored version is applied in order.
+    All migrations run in one write transaction: a failed upgrade leaves the file unchanged,
+    and connections that open a new database at the same time upgrade it only once.
 
     :param db: Database connection object.
     """
     cur = db.cursor()
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    if version == len(MIGRATIONS):
+        return  # Up to date: no DDL and no transaction
+
+    cur.execute("BEGIN IMMEDIATE")  # DDL would commit statement by statement otherwise
+    try:
+        # Another connection may have upgraded the file while this one waited for the lock
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(cur)
+            cur.execute(f"PRAGMA user_version = {target}")
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
 
+def _migrate_v1(cur):
+    """
+    Schema version 1: dates are stored as integer day numbers (date ordinals)
+    and (habitName, day) is unique. Existing check-offs are converted and deduplicated.
+    :param cur: Database cursor.
+    """
     cur.execute("""CREATE TABLE IF NOT EXISTS habit (
     name TEXT PRIMARY KEY,
     periodicity TEXT)""")
 
-    cur.execute("""CREATE TABLE IF NOT EXISTS tracker(
-    date TEXT,
-    habitName TEXT,
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='tracker'")
+    legacy = cur.fetchone() is not None
+    if legacy:
+        cur.execute("ALTER TABLE tracker RENAME TO tracker_v0")
+
+    cur.execute("""CREATE TABLE tracker(
+    habitName TEXT NOT NULL,
+    day INTEGER NOT NULL,
     FOREIGN KEY (habitName) REFERENCES habit(name))""")
 
+    if legacy:
+        cur.execute("SELECT COUNT(*) FROM tracker_v0")
+        old_rows = cur.fetchone()[0]
+        cur.execute(f"""INSERT INTO tracker (habitName, day)
+        SELECT habitName, CAST(julianday(date) - {JULIAN_DAY_OFFSET} AS INTEGER)
+        FROM tracker_v0 WHERE julianday(date) IS NOT NULL ORDER BY rowid""")
+        removed = old_rows - cur.rowcount + _remove_duplicates(cur, "habitName, day")
+        cur.execute("DROP TABLE tracker_v0")
+        if removed:
+            print(f"🧹 Removed {removed} duplicate or invalid check-offs while upgrading the database.")
+
+    cur.execute("CREATE UNIQUE INDEX tracker_habit_day ON tracker(habitName, day)")
+
+def _migrate_v2(cur):
+    """
+    Schema version 2: adds the meta table, which holds the "seeded" flag.
+    Databases that already contain habits count as seeded.
+    :param cur: Database cursor.
+    """
+    cur.execute("""CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT)""")
+    cur.execute("INSERT INTO meta SELECT 'seeded', '1' WHERE EXISTS (SELECT 1 FROM habit)")
+
+def _migrate_v3(cur):
+    """
+    Schema version 3: adds the streak_state table, which holds the streaks of every habit
+    so they don't have to be recalculated from the whole history on every query.
+    The table is filled by the last migration.
+    :param cur: Database cursor.
+    """
+    cur.execute("""CREATE TABLE streak_state (
+    habitName TEXT PRIMARY KEY,
+    current_streak INTEGER NOT NULL,
+    longest_streak INTEGER NOT NULL,
+    last_period INTEGER,
+    last_day INTEGER,
+    FOREIGN KEY (habitName) REFERENCES habit(name))""")
+
+def _migrate_v4(cur):
+    """
+    Schema version 4: streaks are counted on calendar periods (ISO weeks, months, ...)
+    instead of exact gaps between check-offs. The stored streaks are recalculated by the last migration.
+    :param cur: Database cursor.
+    """
+
+def _migrate_v5(cur):
+    """
+    Schema version 5: index for listing the habits of one periodicity in name order.
+    :param cur: Database cursor.
+    """
+    cur.execute("CREATE INDEX habit_periodicity ON habit(periodicity, name)")
+
+def _migrate_v6(cur):
+    """
+    Schema version 6: habits belong to users. Habits get an integer id, the name is only unique per user,
+    and check-offs and streaks refer to the habit id. Existing habits move to the default user.
+    All indexes start with the user id, so the queries of one user only touch that user's part of the index.
+    Check-offs of habits that no longer exist are dropped.
+    :param cur: Database cursor.
+    """
+    cur.execute("""CREATE TABLE user (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE)""")
+    cur.execute("INSERT INTO user (id, name) VALUES (?, ?)", (DEFAULT_USER_ID, DEFAULT_USER))
+
+    cur.execute("ALTER TABLE habit RENAME TO habit_v5")
+    cur.execute("ALTER TABLE tracker RENAME TO tracker_v5")
+    cur.execute("DROP TABLE streak_state")
+
+    cur.execute(f"""CREATE TABLE habit (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL DEFAULT {DEFAULT_USER_ID},
+    name TEXT NOT NULL,
+    periodicity TEXT,
+    UNIQUE (user_id, name),
+    FOREIGN KEY (user_id) REFERENCES user(id))""")
+    cur.execute("""CREATE TABLE tracker(
+    user_id INTEGER NOT NULL,
+    habit_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES user(id),
+    FOREIGN KEY (habit_id) REFERENCES habit(id))""")
+    cur.execute("""CREATE TABLE streak_state (
+    habit_id INTEGER PRIMARY KEY,
+    current_streak INTEGER NOT NULL,
+    longest_streak INTEGER NOT NULL,
+    last_period INTEGER,
+    last_day INTEGER,
+    FOREIGN KEY (habit_id) REFERENCES habit(id))""")
+
+    cur.execute("""INSERT INTO habit (user_id, name, periodicity)
+    SELECT ?, name, periodicity FROM habit_v5 ORDER BY name""", (DEFAULT_USER_ID,))
+    cur.execute("""INSERT INTO tracker (user_id, habit_id, day)
+    SELECT habit.user_id, habit.id, tracker_v5.day FROM tracker_v5 JOIN habit ON habit.name = tracker_v5.habitName
+    ORDER BY habit.id, tracker_v5.day""")
+    cur.execute("DROP TABLE tracker_v5")
+    cur.execute("DROP TABLE habit_v5")
+
+    cur.execute("CREATE INDEX habit_periodicity ON habit(user_id, periodicity, name)")
+    cur.execute("CREATE UNIQUE INDEX tracker_user_habit_day ON tracker(user_id, habit_id, day)")
+    _rebuild_streak_state(cur)
+
+def _migrate_v7(cur):
+    """
+    Schema version 7: adds the habit_days table with the check-off days of every habit as a bitmap,
+    see bitmap.py. It is kept up to date on every check-off like the streak state.
+    :param cur: Database cursor.
+    """
+    cur.execute("""CREATE TABLE habit_days (
+    habit_id INTEGER PRIMARY KEY,
+    first_day INTEGER NOT NULL,
+    bits BLOB NOT NULL,
+    FOREIGN KEY (habit_id) REFERENCES habit(id))""")
+    _rebuild_day_bitmaps(cur)
+
+def _migrate_v8(cur):
+    """
+    Schema version 8: adds the checkoff_rollup table with the number of check-offs of every habit per week,
+    month and year (see ROLLUP_GRAINS), so reports over long histories don't read every tracker row.
+    It is kept up to date on every check-off like the streak state.
+    :param cur: Database cursor.
+    """
+    cur.execute("""CREATE TABLE checkoff_rollup (
+    habit_id INTEGER NOT NULL,
+    grain TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (habit_id, grain, bucket),
+    FOREIGN KEY (habit_id) REFERENCES habit(id)) WITHOUT ROWID""")
+    _rebuild_rollups(cur)
+
+# Schema migrations, index i upgrades a database from version i to i + 1.
+MIGRATIONS = [
+    _migrate_v1,
+    _migrate_v2,
+    _migrate_v3,
+    _migrate_v4,
+    _migrate_v5,
+    _migrate_v6,
+    _migrate_v7,
+    _migrate_v8,
+]
+
+def _remove_duplicates(cur, key="user_id, habit_id, day"):
+    """
+    Deletes all but the first of several identical check-offs.
+    :param cur: Database cursor.
+    :param key: Columns that identify a check-off.
+    :return: Number of deleted rows.
+    """
+    cur.execute(f"""DELETE FROM tracker WHERE rowid NOT IN (
+    SELECT MIN(rowid) FROM tracker GROUP BY {key})""")
+    return cur.rowcount
+
+def remove_duplicate_checkoffs(db):
+    """
+    Removes duplicate check-offs, e.g. the default check-offs that older versions
+    inserted again every time the database was opened.
+    :param db: Database connection object.
+    :return: Number of removed check-offs.
+    """
+    removed = _remove_duplicates(db.cursor())
+    db.commit()
+    _bump_data_version()
+    return removed
+
+def get_user_id(db, user, create=False):
+    """
+    Looks up the id of a user.
+    :param db: Database connection object.
+    :param user: Name of the user.
+    :param create: Add the user if it does not exist yet.
+    :return: The user id, None if the user does not exist.
+    """
+    cur = db.cursor()
+    cur.execute("SELECT id FROM user WHERE name=?", (user,))
+    row = cur.fetchone()
+    if row:
+        return row[0]
+    if not create:
+        return None
+    cur.execute("INSERT INTO user (name) VALUES (?)", (user,))
     db.commit()
+    return cur.lastrowid
 
-def add_habit(db, name, periodicity):
+def _get_habit(cur, user_id, name):
+    """
+    Looks up a habit of a user.
+    :param cur: Database cursor.
+    :param user_id: Id of the user.
+    :param name: Name of the habit.
+    :return: tuple: (habit id, periodicity), None if the habit does not exist.
+    """
+    cur.execute("SELECT id, periodicity FROM habit WHERE user_id=? AND name=?", (user_id, name))
+    return cur.fetchone()
+
+def get_habit(db, name, user_id=DEFAULT_USER_ID):
+    """
+    Looks up the id and periodicity of a habit.
+    :param db: Database connection object.
+    :param name: Name of the habit.
+    :param user_id: Id of the user the habit belongs to.
+    :return: tuple: (habit id, periodicity), None if the habit does not exist.
+    """
+    return _get_habit(db.cursor(), user_id, name)
+
+def _rebuild_scope(user_id=None, habit_id=None):
+    """
+    Returns the WHERE clauses that select the habits and check-offs to recalculate derived tables for.
+    :param user_id: Id of the user. Defaults to all users.
+    :param habit_id: Id of a habit of the user. Defaults to all habits.
+    :return: tuple: (habit WHERE clause, tracker WHERE clause, parameters of both)
+    """
+    if habit_id is not None:
+        return "user_id=? AND id=?", "user_id=? AND habit_id=?", (user_id, habit_id)
+    if user_id is not None:
+        return "user_id=?", "user_id=?", (user_id,)
+    return "1", "1", ()
+
+def _rebuild_streak_state(cur, user_id=None, habit_id=None):
+    """
+    Recalculates the streak state from the tracker table in one pass.
+    :param cur: Database cursor.
+    :param user_id: Id of the user. Defaults to all users.
+    :param habit_id: Id of a habit of the user. Defaults to all habits.
+    """
+    habit_where, tracker_where, params = _rebuild_scope(user_id, habit_id)
+    cur.execute(f"SELECT id, periodicity FROM habit WHERE {habit_where}", params)
+    periodicities = dict(cur.fetchall())
+
+    cur.execute(f"SELECT habit_id, day FROM tracker WHERE {tracker_where} ORDER BY user_id, habit_id, day", params)
+    states = []
+    for habit, rows in groupby(cur, key=lambda row: row[0]):
+        if habit in periodicities:
+            periodicity = periodicities[habit]
+            days = [row[1] for row in rows]
+            periods = period_indices(days, periodicity)
+            longest, last = streak_runs(periods)
+            states.append((habit, last, longest, int(periods[-1]), days[-1]))
+
+    cur.executemany("DELETE FROM streak_state WHERE habit_id=?", ((habit,) for habit in periodicities))
+    cur.executemany("INSERT INTO streak_state VALUES (?, ?, ?, ?, ?)", states)
+
+def _update_streak_state(cur, user_id, habit_id, periodicity, day):
+    """
+    Updates the streak state of a habit after a new check-off.
+    Only check-offs older than the last one require a full recalculation.
+    :param cur: Database cursor.
+    :param user_id: Id of the user.
+    :param habit_id: Id of the habit.
+    :param periodicity: Periodicity of the habit.
+    :param day: Day number of the new check-off.
+    """
+    cur.execute("SELECT current_streak, longest_streak, last_period, last_day FROM streak_state WHERE habit_id=?",
+                (habit_id,))
+    current, longest, last_period, last_day = cur.fetchone() or (0, 0, None, None)
+
+    period = period_index(day, periodicity)
+    if last_period is not None and period < last_period:
+        _rebuild_streak_state(cur, user_id, habit_id)
+        return
+
+    current, longest, last_period = extend_streak(current, longest, last_period, period)
+    cur.execute("INSERT OR REPLACE INTO streak_state VALUES (?, ?, ?, ?, ?)",
+                (habit_id, current, longest, last_period, max(day, last_day or day)))
+
+def _rebuild_day_bitmaps(cur, user_id=None, habit_id=None):
+    """
+    Recalculates the day bitmaps from the tracker table in one pass.
+    :param cur: Database cursor.
+    :param user_id: Id of the user. Defaults to all users.
+    :param habit_id: Id of a habit of the user. Defaults to all habits.
+    """
+    habit_where, tracker_where, params = _rebuild_scope(user_id, habit_id)
+    cur.execute(f"SELECT id FROM habit WHERE {habit_where}", params)
+    habits = [row[0] for row in cur.fetchall()]
+
+    cur.execute(f"SELECT habit_id, day FROM tracker WHERE {tracker_where} ORDER BY user_id, habit_id, day", params)
+    bitmaps = [(habit, *bitmap.from_days(row[1] for row in rows))
+               for habit, rows in groupby(cur, key=lambda row: row[0])]
+
+    cur.executemany("DELETE FROM habit_days WHERE habit_id=?", ((habit,) for habit in habits))
+    cur.executemany("INSERT INTO habit_days VALUES (?, ?, ?)", bitmaps)
+
+def _update_day_bitmap(cur, habit_id, day):
+    """
+    Sets the bit of a new check-off in the day bitmap of a habit.
+    :param cur: Database cursor.
+    :param habit_id: Id of the habit.
+    :param day: Day number of the new check-off.
+    """
+    cur.execute("SELECT first_day, bits FROM habit_days WHERE habit_id=?", (habit_id,))
+    first_day, bits = cur.fetchone() or (None, b"")
+    cur.execute("INSERT OR REPLACE INTO habit_days VALUES (?, ?, ?)", (habit_id, *bitmap.add_day(first_day, bits, day)))
+
+# Periodicities with a rollup table, their buckets are the period indices (see streaks.period_index).
+# Daily counts are read from the tracker index directly, it has at most one row per habit and day.
+ROLLUP_GRAINS = ("weekly", "monthly", "annually")
+
+def _rebuild_rollups(cur, user_id=None, habit_id=None):
+    """
+    Recalculates the check-off counts per week, month and year from the tracker table in one pass.
+    :param cur: Database cursor.
+    :param user_id: Id of the user. Defaults to all users.
+    :param habit_id: Id of a habit of the user. Defaults to all habits.
+    """
+    habit_where, tracker_where, params = _rebuild_scope(user_id, habit_id)
+    cur.execute(f"SELECT id FROM habit WHERE {habit_where}", params)
+    habits = [row[0] for row in cur.fetchall()]
+
+    cur.execute(f"SELECT habit_id, day FROM tracker WHERE {tracker_where} ORDER BY user_id, habit_id, day", params)
+    rows = []
+    for habit, checkoffs in groupby(cur, key=lambda row: row[0]):
+        days = [row[1] for row in checkoffs]
+        for grain in ROLLUP_GRAINS:
+            for bucket, count in Counter(int(period) for period in period_indices(days, grain)).items():
+                rows.append((habit, grain, bucket, count))
+
+    cur.executemany("DELETE FROM checkoff_rollup WHERE habit_id=?", ((habit,) for habit in habits))
+    cur.executemany("INSERT INTO checkoff_rollup VALUES (?, ?, ?, ?)", rows)
+
+def _update_rollups(cur, habit_id, day):
+    """
+    Counts a new check-off in the rollups of its week, month and year.
+    :param cur: Database cursor.
+    :param habit_id: Id of the habit.
+    :param day: Day number of the new check-off.
+    """
+    cur.executemany("""INSERT INTO checkoff_rollup VALUES (?, ?, ?, 1)
+    ON CONFLICT (habit_id, grain, bucket) DO UPDATE SET count = count + 1""",
+                    [(habit_id, grain, period_index(day, grain)) for grain in ROLLUP_GRAINS])
+
+def rebuild_rollups(db):
+    """
+    Recalculates all rollups from the check-off history, e.g. after check-offs were changed with plain SQL.
+    :param db: Database connection object.
+    """
+    with db:
+        _rebuild_rollups(db.cursor())
+    _bump_data_version()
+
+def iter_rollup_counts(db, grain, first=None, last=None, name=None, batch_size=10000, user_id=DEFAULT_USER_ID):
+    """
+    Streams the check-off counts of a user's habits per bucket of a rollup grain.
+    :param db: Database connection object.
+    :param grain: One of ROLLUP_GRAINS, or "daily" to count the tracker rows.
+    :param first: First bucket (period index) to read. Defaults to the first bucket.
+    :param last: Last bucket to read. Defaults to the last bucket.
+    :param name: Name of a habit. Defaults to all habits of the user.
+    :param batch_size: Number of rows fetched at a time.
+    :param user_id: Id of the user.
+    :return: Generator of tuples (habit name, bucket, count), ordered by habit name and bucket.
+    """
+    first = 0 if first is None else first
+    last = date.max.toordinal() if last is None else last
+    habit_filter, params = ("AND habit.name=?", (name,)) if name is not None else ("", ())
+    cur = db.cursor()
+    cur.arraysize = batch_size
+    if grain == "daily":
+        cur.execute(f"""SELECT habit.name, tracker.day, 1 FROM habit
+        JOIN tracker ON tracker.user_id = habit.user_id AND tracker.habit_id = habit.id
+        WHERE habit.user_id=? {habit_filter} AND tracker.day BETWEEN ? AND ? ORDER BY habit.name, tracker.day""",
+                    (user_id, *params, first, last))
+    else:
+        cur.execute(f"""SELECT habit.name, r.bucket, r.count FROM habit JOIN checkoff_rollup r ON r.habit_id = habit.id
+        WHERE habit.user_id=? {habit_filter} AND r.grain=? AND r.bucket BETWEEN ? AND ?
+        ORDER BY habit.name, r.bucket""", (user_id, *params, grain, first, last))
+    return _iter_rows(cur)
+
+def get_day_bitmap(db, name, user_id=DEFAULT_USER_ID):
+    """
+    Reads the day bitmap of a habit, see bitmap.py.
+    :param db: Database connection object.
+    :param name: Name of the habit.
+    :param user_id: Id of the user the habit belongs to.
+    :return: tuple: (first day, bytes), (None, b"") if the habit has no check-offs, None if it does not exist.
+    """
+    cur = db.cursor()
+    cur.execute("""SELECT d.first_day, d.bits FROM habit LEFT JOIN habit_days d ON d.habit_id = habit.id
+    WHERE habit.user_id=? AND habit.name=?""", (user_id, name))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return row if row[0] is not None else (None, b"")
+
+def has_checkoff(db, name, day, user_id=DEFAULT_USER_ID):
+    """
+    Checks whether a habit was checked off on a day, with a single lookup in its day bitmap.
+    :param db: Database connection object.
+    :param name: Name of the habit.
+    :param day: date object, YYYY-MM-DD string or day number.
+    :param user_id: Id of the user the habit belongs to.
+    :return: bool, False for unknown habits.
+    """
+    first_day, bits = get_day_bitmap(db, name, user_id) or (None, b"")
+    return bitmap.has_day(first_day, bits, day if isinstance(day, int) else to_day(day))
+
+def rebuild_streak_state(db, name=None, user_id=DEFAULT_USER_ID):
+    """
+    Recalculates the stored streaks from the check-off history.
+    :param db: Database connection object.
+    :param name: Name of the habit. Defaults to all habits of all users.
+    :param user_id: Id of the user the habit belongs to.
+    """
+    with db:
+        cur = db.cursor()
+        if name:
+            habit = _get_habit(cur, user_id, name)
+            if habit:
+                _rebuild_streak_state(cur, user_id, habit[0])
+        else:
+            _rebuild_streak_state(cur)
+    _bump_data_version()
+
+def get_streak_state(db, name, today=None, user_id=DEFAULT_USER_ID):
+    """
+    Reads the stored streaks of a habit.
+    :param db: Database connection object.
+    :param name: Name of the habit.
+    :param today: Reference date for the current streak. Defaults to today.
+    :param user_id: Id of the user the habit belongs to.
+    :return: tuple: (longest streak, current streak), None if the habit does not exist.
+    """
+    cur = db.cursor()
+    cur.execute("""SELECT habit.periodicity, s.current_streak, s.longest_streak, s.last_period
+    FROM habit LEFT JOIN streak_state s ON s.habit_id = habit.id WHERE habit.user_id=? AND habit.name=?""",
+                (user_id, name))
+    row = cur.fetchone()
+    if row is None:
+        return None
+
+    periodicity, last_streak, longest, last_period = row
+    today_period = period_index(to_day(today or date.today()), periodicity)
+    return longest or 0, current_streak(last_streak, last_period, today_period)
+
+def to_day(value):
+    """
+    Converts a date to an integer day number (date ordinal).
+    :param value: date object or ISO date string (YYYY-MM-DD).
+    :return: Day number.
+    """
+    if isinstance(value, str):
+        value = date.fromisoformat(value)
+    return value.toordinal()
+
+def from_day(day):
+    """
+    Converts an integer day number back to a date.
+    :param day: Day number (date ordinal).
+    :return: date object.
+    """
+    return date.fromordinal(day)
+
+def add_habit(db, name, periodicity, user_id=DEFAULT_USER_ID):
     """
     Adds a new habit to the database if it does not already exist.
 
     :param db:Database connection object.
     :param name: Name of the habit.
     :param periodicity: Frequency of the habit (e.g., "daily", "weekly").
+    :param user_id: Id of the user the habit belongs to.
     :return: none
     """
     cur = db.cursor()
 
     # Check if habit already exists.
-    cur.execute("SELECT name FROM habit WHERE name=?", (name,))
-    existing_habit = cur.fetchone()
+    existing_habit = _get_habit(cur, user_id, name)
 
     if existing_habit:
         print(f"⚠️ Habit '{name}' exists already!")
     else:
-        cur.execute("INSERT INTO habit VALUES (?, ?)", (name, periodicity))
+        cur.execute("INSERT INTO habit (user_id, name, periodicity) VALUES (?, ?, ?)", (user_id, name, periodicity))
         db.commit()
+        _bump_data_version()
 
 
-def delete_habit(db, name):
+def delete_habit(db, name, user_id=DEFAULT_USER_ID):
     """
     Deletes a habit from the database along with its check-offs.
 
     :param db: Database connection object.
     :param name: Name of the habit to delete.
+    :param user_id: Id of the user the habit belongs to.
     """
     cur = db.cursor()
 
     # Check, if habit exists
-    cur.execute("SELECT name FROM habit WHERE name=?", (name,))
-    existing_habit = cur.fetchone()
+    existing_habit = _get_habit(cur, user_id, name)
 
     if existing_habit:
-        # Delete habit from all tables (habit and tracker)
-        cur.execute("DELETE FROM habit WHERE name=?", (name,))
-        cur.execute("DELETE FROM tracker WHERE habitName=?", (name,))
+        # Delete habit from all tables (habit, tracker and the tables derived from it)
+        habit_id = existing_habit[0]
+        cur.execute("DELETE FROM habit WHERE id=?", (habit_id,))
+        cur.execute("DELETE FROM tracker WHERE user_id=? AND habit_id=?", (user_id, habit_id))
+        cur.execute("DELETE FROM streak_state WHERE habit_id=?", (habit_id,))
+        cur.execute("DELETE FROM habit_days WHERE habit_id=?", (habit_id,))
+        cur.execute("DELETE FROM checkoff_rollup WHERE habit_id=?", (habit_id,))
         db.commit()
+        _bump_data_version()
         print(f"✅ Habit '{name}' deleted successfully!")
     else:
         print(f"⚠️ Habit '{name}' does not exist.")
 
-def edit_habit(db, name, new_periodicity):
+def edit_habit(db, name, new_periodicity, user_id=DEFAULT_USER_ID):
     """
     Updates the periodicity of an existing habit.
     :param db: Database connection object.
     :param name: Name of the habit.
     :param new_periodicity: The new periodicity value.
+    :param user_id: Id of the user the habit belongs to.
     """
     cur = db.cursor()
 
     # Check if habit exists
-    cur.execute("SELECT * FROM habit WHERE name=?", (name,))
-    if not cur.fetchone():
+    habit = _get_habit(cur, user_id, name)
+    if not habit:
         print(f"⚠️ Habit '{name}' not found!")
         return False
 
     # Update periodicity
-    cur.execute("UPDATE habit SET periodicity=? WHERE name=?", (new_periodicity, name))
+    cur.execute("UPDATE habit SET periodicity=? WHERE id=?", (new_periodicity, habit[0]))
+    _rebuild_streak_state(cur, user_id, habit[0])  # Streaks depend on the periodicity
     db.commit()
+    _bump_data_version()
     return True
 
 
-def checkoff_habit(db, name, event_date=None):
+def checkoff_habit(db, name, event_date=None, user_id=DEFAULT_USER_ID):
     """
     Logs a habit completion (check-off) in the database.
     :param db: Database connection object.
     :param name: Name of the habit being checked off.
     :param event_date: Date of completion (YYYY-MM-DD). Defaults to today.
+    :param user_id: Id of the user the habit belongs to.
     :return: none
     """
+    _checkoff(db.cursor(), user_id, name, event_date)
+    db.commit()
+    _bump_data_version()
+
+def checkoff_batch(db, checkoffs, user_id=DEFAULT_USER_ID):
+    """
+    Logs several check-offs in one transaction and keeps the streaks up to date like checkoff_habit.
+    :param db: Database connection object.
+    :param checkoffs: List of (habit name, date) pairs. A date of None means today.
+    :param user_id: Id of the user the habits belong to.
+    :return: List with one bool per check-off, False if it was already stored or the habit does not exist.
+    """
     cur = db.cursor()
+    habits = {}  # Every habit is looked up once per batch
+    with db:
+        inserted = [_checkoff(cur, user_id, name, event_date, habits) for name, event_date in checkoffs]
+    _bump_data_version()
+    return inserted
 
-    if not event_date:
-        event_date = str(date.today())
+def _checkoff(cur, user_id, name, event_date, habits=None):
+    """
+    Inserts a check-off and updates the streak, the day bitmap and the rollups of the habit, without committing.
+    :param cur: Database cursor.
+    :param user_id: Id of the user.
+    :param name: Name of the habit.
+    :param event_date: Date of completion. Defaults to today.
+    :param habits: Optional dict {name: (habit id, periodicity)} of habits already looked up in this transaction.
+    :return: True if the check-off was new.
+    """
+    if habits is None:
+        habit = _get_habit(cur, user_id, name)
+    else:
+        habit = habits[name] if name in habits else habits.setdefault(name, _get_habit(cur, user_id, name))
+    if not habit:
+        print(f"⚠️ Habit '{name}' not found!")
+        return False
 
-    cur.execute("INSERT INTO tracker (date, habitName) VALUES (?, ?)", (event_date, name))
-    db.commit()
+    # A habit can only be checked off once per day.
+    habit_id, periodicity = habit
+    day = to_day(event_date or date.today())
+    cur.execute("INSERT OR IGNORE INTO tracker (user_id, habit_id, day) VALUES (?, ?, ?)", (user_id, habit_id, day))
+    if not cur.rowcount:
+        return False
+    _update_streak_state(cur, user_id, habit_id, periodicity, day)
+    _update_day_bitmap(cur, habit_id, day)
+    _update_rollups(cur, habit_id, day)
+    return True
+
+def checkoff_many(db, checkoffs, batch_size=10000, on_duplicate="ignore", progress=None, user_id=DEFAULT_USER_ID):
+    """
+    Logs many check-offs at once, e.g. to import a history.
+    The check-offs are consumed lazily and written in batches, one transaction per batch.
+    The streaks, day bitmaps and rollups of the imported habits are recalculated once at the end.
+    Check-offs of habits that do not exist are skipped.
+    :param db: Database connection object.
+    :param checkoffs: Iterable of (habit name, date) pairs. Dates are date objects or YYYY-MM-DD strings.
+    :param batch_size: Number of check-offs per transaction.
+    :param on_duplicate: "ignore" skips check-offs that are already stored,
+                         "error" raises sqlite3.IntegrityError and rolls back the current batch.
+    :param progress: Optional callback, called after every batch with (check-offs read, check-offs inserted).
+    :param user_id: Id of the user the habits belong to.
+    :return: Number of inserted check-offs.
+    """
+    if on_duplicate not in ("ignore", "error"):
+        raise ValueError(f"Unknown duplicate handling: {on_duplicate}")
+    sql = "INSERT OR IGNORE INTO tracker (user_id, habit_id, day) VALUES (?, ?, ?)" if on_duplicate == "ignore" \
+        else "INSERT INTO tracker (user_id, habit_id, day) VALUES (?, ?, ?)"
+
+    cur = db.cursor()
+    cur.execute("SELECT name, id FROM habit WHERE user_id=?", (user_id,))
+    habit_ids = dict(cur.fetchall())
+    read = inserted = 0
+    habits = set()
+    try:
+        checkoffs = iter(checkoffs)
+        while True:
+            batch = list(islice(checkoffs, batch_size))
+            if not batch:
+                break
+            rows = [(user_id, habit_ids[name], to_day(event_date))
+                    for name, event_date in batch if name in habit_ids]
+            with db:
+                cur.executemany(sql, rows)
+            habits.update(habit_id for _user, habit_id, _day in rows)
+            read += len(batch)
+            inserted += cur.rowcount
+            if progress:
+                progress(read, inserted)
+    finally:
+        with db:
+            for habit_id in habits:
+                _rebuild_streak_state(cur, user_id, habit_id)
+                _rebuild_day_bitmaps(cur, user_id, habit_id)
+                _rebuild_rollups(cur, user_id, habit_id)
+        _bump_data_version()
+    return inserted
+
+def iter_checkoffs(db, batch_size=10000, user_id=DEFAULT_USER_ID):
+    """
+    Streams all check-off records of a user, ordered by habit and date.
+    :param db: Database connection object.
+    :param batch_size: Number of rows fetched from SQLite at once.
+    :param user_id: Id of the user.
+    :return: Generator of tuples (habitName, date).
+    """
+    cur = db.cursor()
+    cur.arraysize = batch_size
+    cur.execute(f"""SELECT habit.name, date(tracker.day + {JULIAN_DAY_OFFSET})
+    FROM tracker JOIN habit ON habit.id = tracker.habit_id
+    WHERE tracker.user_id=? ORDER BY tracker.habit_id, tracker.day""", (user_id,))
+    yield from _iter_rows(cur)
+
+def _iter_rows(cur):
+    """
+    Streams the rows of an executed query in batches of cur.arraysize.
+    :param cur: Database cursor.
+    :return: Generator of rows.
+    """
+    while True:
+        rows = cur.fetchmany()
+        if not rows:
+            break
+        yield from rows
 
-def get_all_habits(db):
+def get_all_habits(db, user_id=DEFAULT_USER_ID):
     """
     Returns a list of all currently tracked habits.
     :param db: Database connection object.
+    :param user_id: Id of the user.
+    :return: list: A list of habit names, ordered by name.
+    """
+    return list(iter_habits(db, user_id=user_id))
+
+def iter_habits(db, periodicity=None, batch_size=500, user_id=DEFAULT_USER_ID):
+    """
+    Streams the names of all habits, or of all habits with a given periodicity, ordered by name.
+    :param db: Database connection object.
+    :param periodicity: Periodicity to filter by. Defaults to all habits.
+    :param batch_size: Number of rows fetched from SQLite at once.
+    :param user_id: Id of the user.
+    :return: Generator of habit names.
+    """
+    cur = db.cursor()
+    cur.arraysize = batch_size
+    if periodicity:
+        cur.execute("SELECT name FROM habit WHERE user_id=? AND periodicity=? ORDER BY name", (user_id, periodicity))
+    else:
+        cur.execute("SELECT name FROM habit WHERE user_id=? ORDER BY name", (user_id,))
+    for row in _iter_rows(cur):
+        yield row[0]
+
+def get_habit_page(db, after=None, limit=100, periodicity=None, user_id=DEFAULT_USER_ID):
+    """
+    Returns one page of habit names, ordered by name (keyset pagination).
+    The next page starts after the last name of the previous one.
+    :param db: Database connection object.
+    :param after: Last habit name of the previous page. Defaults to the first page.
+    :param limit: Maximum number of habits per page.
+    :param periodicity: Periodicity to filter by. Defaults to all habits.
+    :param user_id: Id of the user.
     :return: list: A list of habit names.
     """
     cur = db.cursor()
-    cur.execute("SELECT name FROM habit")
+    if periodicity:
+        cur.execute("SELECT name FROM habit WHERE user_id=? AND periodicity=? AND name>? ORDER BY name LIMIT ?",
+                    (user_id, periodicity, after or "", limit))
+    else:
+        cur.execute("SELECT name FROM habit WHERE user_id=? AND name>? ORDER BY name LIMIT ?",
+                    (user_id, after or "", limit))
     return [row[0] for row in cur.fetchall()]
 
-def get_habit_checkoffs(db, name):
+# Check-offs of one habit, the lookup uses the (user_id, name) and (user_id, habit_id, day) indexes.
+_HABIT_CHECKOFFS = f"""SELECT date(tracker.day + {JULIAN_DAY_OFFSET}), habit.name
+FROM habit JOIN tracker ON tracker.user_id = habit.user_id AND tracker.habit_id = habit.id
+WHERE habit.user_id=? AND habit.name=? ORDER BY tracker.day"""
+
+def get_habit_checkoffs(db, name, user_id=DEFAULT_USER_ID):
     """
     Retrieves all check-off records for a given habit.
     :param db: Database connection object.
     :param name: Name of the habit.
-    :return: A list of tuples with (date, habitName).
+    :param user_id: Id of the user the habit belongs to.
+    :return: A list of tuples with (date, habitName), ordered by date.
     """
     cur = db.cursor()
-    cur.execute("SELECT * FROM tracker WHERE habitName=?", (name,))
+    cur.execute(_HABIT_CHECKOFFS, (user_id, name))
     return cur.fetchall()
 
+def iter_habit_checkoffs(db, name, batch_size=10000, user_id=DEFAULT_USER_ID):
+    """
+    Streams all check-off records of a given habit.
+    :param db: Database connection object.
+    :param name: Name of the habit.
+    :param batch_size: Number of rows fetched from SQLite at once.
+    :param user_id: Id of the user the habit belongs to.
+    :return: Generator of tuples (date, habitName), ordered by date.
+    """
+    cur = db.cursor()
+    cur.arraysize = batch_size
+    cur.execute(_HABIT_CHECKOFFS, (user_id, name))
+    yield from _iter_rows(cur)
+
+def get_habit_days(db, name, user_id=DEFAULT_USER_ID, since=None, until=None):
+    """
+    Retrieves the check-off days of a given habit as integer day numbers.
+    With since or until only the matching range of the (user_id, habit_id, day) index is read.
+    :param db: Database connection object.
+    :param name: Name of the habit.
+    :param user_id: Id of the user the habit belongs to.
+    :param since: First date of the range (date or YYYY-MM-DD). Defaults to the first check-off.
+    :param until: Last date of the range (date or YYYY-MM-DD). Defaults to the last check-off.
+    :return: A sorted list of day numbers.
+    """
+    cur = db.cursor()
+    cur.execute("""SELECT tracker.day FROM habit
+    JOIN tracker ON tracker.user_id = habit.user_id AND tracker.habit_id = habit.id
+    WHERE habit.user_id=? AND habit.name=? AND tracker.day BETWEEN ? AND ? ORDER BY tracker.day""",
+                (user_id, name, *_day_range(since, until)))
+    return [row[0] for row in cur.fetchall()]
+
+def _day_range(since, until):
+    """
+    Converts optional range bounds to day numbers.
+    :param since: First date of the range, None for no lower bound.
+    :param until: Last date of the range, None for no upper bound.
+    :return: tuple: (first day, last day)
+    """
+    return (to_day(since) if since else 0), (to_day(until) if until else date.max.toordinal())
+
+def iter_days_in_range(db, since, until, user_id=DEFAULT_USER_ID):
+    """
+    Streams the check-off days of every habit of a user within a date range.
+    Every habit is one range lookup in the (user_id, habit_id, day) index, the rest of the history is not read.
+    :param db: Database connection object.
+    :param since: First date of the range (date or YYYY-MM-DD), None for no lower bound.
+    :param until: Last date of the range (date or YYYY-MM-DD), None for no upper bound.
+    :param user_id: Id of the user.
+    :return: Generator of tuples (habit name, periodicity, sorted list of day numbers), ordered by name.
+    """
+    first, last = _day_range(since, until)
+    habits = db.cursor()
+    habits.execute("SELECT id, name, periodicity FROM habit WHERE user_id=? ORDER BY name", (user_id,))
+    cur = db.cursor()
+    for habit_id, name, periodicity in habits:
+        cur.execute("SELECT day FROM tracker WHERE user_id=? AND habit_id=? AND day BETWEEN ? AND ? ORDER BY day",
+                    (user_id, habit_id, first, last))
+        yield name, periodicity, [row[0] for row in cur.fetchall()]
+
+
+def is_seeded(db):
+    """
+    Checks whether the default data has already been inserted into the database.
+    :param db: Database connection object.
+    :return: True if the database has been seeded.
+    """
+    cur = db.cursor()
+    cur.execute("SELECT value FROM meta WHERE key='seeded'")
+    return cur.fetchone() is not None
 
 def insert_default_data(db):
     """
-    Inserts default habits and check-offs if they are not already present.
+    Inserts default habits and check-offs if they are not already present
+    and marks the database as seeded. Everything is written in one transaction.
 
     :param db: Database connection object.
     """
@@ -156,12 +917,6 @@ def insert_default_data(db):
         ("Create my vision board", "annually"),
     ]
 
-    # Check if habits already exist
-    for name, periodicity in default_habits:
-        cur.execute("SELECT name FROM habit WHERE name=?", (name,))
-        if not cur.fetchone():
-            cur.execute("INSERT INTO habit VALUES (?, ?)", (name, periodicity))
-
     # Default check-offs
     default_checkoffs = [
         ("Yoga", ["2024-04-01", "2024-04-02", "2024-04-03", "2024-04-05", "2024-04-06", "2024-04-08"]),  # Almost daily
@@ -170,9 +925,18 @@ def insert_default_data(db):
         # "Clean windows" & "Create my vision board" have no check-offs yet
     ]
 
-    for habit, dates in default_checkoffs:
-        for date in dates:
-            cur.execute("INSERT INTO tracker (date, habitName) VALUES (?, ?)", (date, habit))
-
-    db.commit()
-    print("✅ Default habits and check-offs added (if not already present).")
+    with db:
+        cur.executemany("INSERT OR IGNORE INTO habit (user_id, name, periodicity) VALUES (?, ?, ?)",
+                        [(DEFAULT_USER_ID, name, periodicity) for name, periodicity in default_habits])
+        cur.execute("SELECT name, id FROM habit WHERE user_id=?", (DEFAULT_USER_ID,))
+        habit_ids = dict(cur.fetchall())
+        cur.executemany("INSERT OR IGNORE INTO tracker (user_id, habit_id, day) VALUES (?, ?, ?)",
+                        [(DEFAULT_USER_ID, habit_ids[habit], to_day(event_date))
+                         for habit, dates in default_checkoffs for event_date in dates])
+        cur.execute("INSERT OR REPLACE INTO meta VALUES ('seeded', '1')")
+        _rebuild_streak_state(cur, DEFAULT_USER_ID)
+        _rebuild_day_bitmaps(cur, DEFAULT_USER_ID)
+        _rebuild_rollups(cur, DEFAULT_USER_ID)
+    _bump_data_version()
+
+    print("✅ Default habits and check-offs added.")
@@ -0,0 +1,299 @@
+# Append-only check-off log for bursty writers ("main.py checkoff --log" or HABITTRACKER_INGEST=1).
+#
+# Instead of taking the SQLite write lock and committing on its own, every check-off is appended as a JSON line
+# to <database>.checkoffs.log, with one write and one fsync per batch. The compactor (compact, "main.py compact"
+# and the daemon every COMPACT_INTERVAL seconds) merges the log into the tracker table in large transactions.
+# Until then the streak rankings, completion rates and period counts read the merged view of SQLite plus the
+# records still in the log.
+#
+# Compaction renames the log first, so writers carry on with a new file. Writers hold a shared flock on the file
+# while they append and the compactor takes an exclusive one before reading the renamed file, so no record is
+# read while it is being written. A writer that opened the file just before the rename notices the changed
+# inode and appends to the new file instead.
+import json
+import os
+from datetime import date, datetime
+
+try:
+    import fcntl
+except ImportError:  # No flock on Windows, compaction must not run while check-offs are appended there
+    fcntl = None
+
+# Seconds between two compactions in the daemon.
+COMPACT_INTERVAL = 5.0
+
+# Log size in bytes at which "main.py checkoff --log" compacts right away (if the database isn't locked).
+COMPACT_SIZE = 1 << 20
+
+# Check-offs per transaction when the log is merged into the database.
+COMPACT_BATCH_SIZE = 50000
+
+
+class EventLog:
+
+    def __init__(self, path):
+        """
+        Append-only log of check-offs that are not in the database yet.
+        :param path: Path of the log file.
+        """
+        self.path = path
+        self.compacting = path + ".compacting"
+
+    @classmethod
+    def for_database(cls, name="main.db"):
+        """
+        Returns the log that belongs to a database file.
+        :param name: Name of the database file.
+        :return: EventLog
+        """
+        return cls(f"{name}.checkoffs.log")
+
+    @classmethod
+    def for_connection(cls, db):
+        """
+        Returns the log that belongs to the database of a connection, None for in-memory databases.
+        :param db: Database connection object.
+        :return: EventLog or None
+        """
+        path = db.execute("PRAGMA database_list").fetchone()[2]
+        return cls.for_database(path) if path else None
+
+    def append(self, checkoffs, user="default", sync=True):
+        """
+        Appends check-offs to the log with a single write.
+        :param checkoffs: Iterable of (habit name, date) pairs. A date of None means today.
+        :param user: Name of the user the habits belong to.
+        :param sync: fsync the log before returning, so the check-offs survive a crash.
+        :return: Number of appended check-offs.
+        :raises ValueError: If a date is not a date or YYYY-MM-DD string, nothing is appended then.
+        """
+        lines = [json.dumps({"user": user, "habit": name, "date": _iso_date(event_date or date.today())})
+                 for name, event_date in checkoffs]
+        data = "".join(line + "\n" for line in lines).encode()
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+                    try:
+                        if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                            continue  # Renamed by the compactor in the meantime
+                    except FileNotFoundError:
+                        continue
+                os.write(fd, data)
+                if sync:
+                    os.fsync(fd)
+                return len(lines)
+            finally:
+                os.close(fd)  # Also releases the lock
+
+    def size(self):
+        """
+        Returns the size of the log in bytes.
+        :return: int, 0 if there is no log.
+        """
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def has_pending(self):
+        """
+        Checks whether there are check-offs that are not in the database yet.
+        :return: True if the log or a compaction left over from a crash is not empty.
+        """
+        return self.size() > 0 or os.path.exists(self.compacting)
+
+    def pending(self):
+        """
+        Reads the check-offs that are not in the database yet, including an interrupted compaction.
+        :return: Generator of tuples (user, habit name, date string).
+        """
+        yield from _read(self.compacting)
+        yield from _read(self.path)
+
+    def pending_days(self, user="default"):
+        """
+        Collects the pending check-offs of a user per habit.
+        :param user: Name of the user.
+        :return: dict: {habit name: set of day numbers}
+        """
+        days = {}
+        for record_user, name, event_date in self.pending():
+            if record_user == user:
+                days.setdefault(name, set()).add(date.fromisoformat(event_date).toordinal())
+        return days
+
+    def compact(self, db, batch_size=COMPACT_BATCH_SIZE):
+        """
+        Merges the log into the tracker table. Only one compaction runs at a time,
+        a compaction that was interrupted is finished first.
+        :param db: Database connection object.
+        :param batch_size: Check-offs per transaction.
+        :return: Number of check-offs stored, duplicates and check-offs of unknown habits don't count.
+        """
+        from db import checkoff_many, get_user_id
+
+        lock = os.open(self.path + ".lock", os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return 0  # Another process is compacting
+
+            if not os.path.exists(self.compacting):
+                if not self.size():
+                    return 0
+                os.rename(self.path, self.compacting)
+            if fcntl:
+                with open(self.compacting) as file:
+                    fcntl.flock(file, fcntl.LOCK_EX)  # Wait for writers that are still appending
+
+            by_user = {}
+            for user, name, event_date in _read(self.compacting):
+                by_user.setdefault(user, []).append((name, event_date))
+            inserted = 0
+            for user, checkoffs in by_user.items():
+                inserted += checkoff_many(db, checkoffs, batch_size, user_id=get_user_id(db, user))
+            os.remove(self.compacting)
+            return inserted
+        finally:
+            os.close(lock)
+
+    def merged_streaks(self, db, user="default", today=None):
+        """
+        Returns the streaks of every habit of a user as if the pending check-offs were already stored.
+        Only the habits with pending check-offs are recalculated, all others use the stored streaks.
+        :param db: Database connection object.
+        :param user: Name of the user.
+        :param today: Reference date for the current streak. Defaults to today.
+        :return: dict: {habit_name: (longest streak, current streak)}, see analyse.get_all_streaks.
+        """
+        from analyse import get_all_streaks
+        from db import get_habit, get_habit_days, get_user_id
+        from streaks import current_streak, period_index, period_indices, streak_runs
+
+        user_id = get_user_id(db, user)
+        today = today or date.today()
+        streaks = get_all_streaks(db, today, user_id=user_id)
+        for name, days in self.pending_days(user).items():
+            habit = get_habit(db, name, user_id)
+            if habit is None:
+                continue  # Unknown habits are skipped by the compaction as well
+            periodicity = habit[1]
+            periods = period_indices(sorted(days.union(get_habit_days(db, name, user_id))), periodicity)
+            longest, last = streak_runs(periods)
+            streaks[name] = (longest, current_streak(last, int(periods[-1]), period_index(today.toordinal(), periodicity)))
+        return streaks
+
+    def merged_top_streaks(self, db, limit=10, by="longest", user="default", today=None):
+        """
+        Ranks the habits of a user like analyse.get_top_streaks, including the pending check-offs.
+        :param db: Database connection object.
+        :param limit: Number of habits to return.
+        :param by: "longest" or "current".
+        :param user: Name of the user.
+        :param today: Reference date for the current streak. Defaults to today.
+        :return: list of tuples (habit_name, streak), best first. Ties are ordered by name.
+        """
+        from analyse import rank_streaks
+        return rank_streaks(self.merged_streaks(db, user, today), limit, by)
+
+    def merged_completion_rates(self, db, since, until, user="default"):
+        """
+        Calculates the completion rates like analyse.get_completion_rates, including the pending check-offs.
+        Only the habits with pending check-offs in the range are recalculated.
+        :param db: Database connection object.
+        :param since: First date of the range (date or YYYY-MM-DD).
+        :param until: Last date of the range (date or YYYY-MM-DD).
+        :param user: Name of the user.
+        :return: dict: {habit_name: completion rate between 0 and 1}, ordered by name.
+        """
+        from analyse import get_completion_rates
+        from db import get_habit, get_habit_days, get_user_id, to_day
+        from streaks import period_index, period_indices
+
+        user_id = get_user_id(db, user)
+        first, last = to_day(since), to_day(until)
+        rates = dict(get_completion_rates(db, since, until, user_id=user_id))  # A copy, the result is cached
+        for name, days in self.pending_days(user).items():
+            days = {day for day in days if first <= day <= last}
+            habit = get_habit(db, name, user_id)
+            if not days or habit is None:
+                continue
+            periodicity = habit[1]
+            days.update(get_habit_days(db, name, user_id, since, until))
+            total = period_index(last, periodicity) - period_index(first, periodicity) + 1
+            rates[name] = len(set(period_indices(sorted(days), periodicity))) / total
+        return rates
+
+    def merged_period_counts(self, db, name, since=None, until=None, per=None, user="default"):
+        """
+        Counts the check-offs of a habit per period like analyse.get_period_counts, including the pending ones.
+        Pending check-offs of days that are already stored count once, as after the compaction.
+        :param db: Database connection object.
+        :param name: Name of the habit.
+        :param since: First date of the range (date or YYYY-MM-DD). Defaults to the first check-off.
+        :param until: Last date of the range (date or YYYY-MM-DD). Defaults to the last check-off.
+        :param per: Periodicity of the periods. Defaults to the periodicity of the habit.
+        :param user: Name of the user.
+        :return: dict: {first day of the period (YYYY-MM-DD): number of check-offs}, ordered by date.
+                 None if the habit does not exist.
+        """
+        from analyse import get_period_counts
+        from db import get_habit, get_habit_days, get_user_id, to_day
+        from streaks import period_index, period_start
+
+        user_id = get_user_id(db, user)
+        counts = get_period_counts(db, name, since, until, per, user_id)
+        if counts is None:
+            return None
+        first = to_day(since) if since else None
+        last = to_day(until) if until else None
+        days = {day for day in self.pending_days(user).get(name, ())
+                if (first is None or day >= first) and (last is None or day <= last)}
+        days.difference_update(get_habit_days(db, name, user_id, since, until))
+        if not days:
+            return counts
+        per = (per or get_habit(db, name, user_id)[1]).lower()
+        counts = dict(counts)  # A copy, the result is cached
+        for day in days:
+            start = period_start(period_index(day, per), per).isoformat()
+            counts[start] = counts.get(start, 0) + 1
+        return dict(sorted(counts.items()))
+
+def _iso_date(value):
+    """
+    Checks a check-off date before it goes into the log.
+    :param value: date object or YYYY-MM-DD string.
+    :return: YYYY-MM-DD string.
+    :raises ValueError: If the value is not a valid date.
+    """
+    if isinstance(value, str):
+        value = date.fromisoformat(value)
+    elif isinstance(value, datetime):
+        value = value.date()
+    if not isinstance(value, date):
+        raise ValueError(f"Invalid check-off date: {value!r}")
+    return value.isoformat()
+
+def _read(path):
+    """
+    Reads the records of one log file. Incomplete lines (from a crash while writing) and records with an invalid
+    date (written by older versions) are skipped, so they can't block the merged reads or the compaction.
+    :param path: Path of the log file.
+    :return: Generator of tuples (user, habit name, date string).
+    """
+    try:
+        file = open(path)
+    except FileNotFoundError:
+        return
+    with file:
+        for line in file:
+            try:
+                record = json.loads(line)
+                event_date = _iso_date(record["date"])
+            except (ValueError, KeyError, TypeError):
+                continue
+            yield record["user"], record["habit"], event_date
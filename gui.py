@@ -1,13 +1,22 @@
 import tkinter as tk
 from tkinter import messagebox, ttk
-from db import get_db, get_all_habits, checkoff_habit, delete_habit, edit_habit
+from connection import session
+from db import get_all_habits, get_habit_page, checkoff_habit, delete_habit, edit_habit
 from habit import Habit
 from analyse import calculate_streak, get_habits_by_periodicity, get_longest_streak
+from tasks import TaskRunner
+
+# Number of habits loaded into the listbox at once.
+HABIT_PAGE_SIZE = 100
 
 class HabitTrackerGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("Habit tracker")
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+
+        # Database and analytics calls run on a background thread
+        self.tasks = TaskRunner(root)
 
         # Name of the habit, input field
         tk.Label(root, text="Habit name:").grid(row=0, column=0)
@@ -33,23 +42,46 @@ class HabitTrackerGUI:
         tk.Button(root, text="Show Habits by Periodicity", command=self.show_habits_by_periodicity).grid(row=6, column=0, columnspan=2)
         tk.Button(root, text="Show Longest Streak", command=self.show_longest_streak).grid(row=7, column=0, columnspan=2)
 
-        # List of habits
+        # List of habits, further pages are loaded when scrolling down
         self.habit_listbox = tk.Listbox(root, width=50)
         self.habit_listbox.grid(row=8, column=0, columnspan=2)
+        self.scrollbar = tk.Scrollbar(root, command=self.habit_listbox.yview)
+        self.scrollbar.grid(row=8, column=2, sticky="ns")
+        self.habit_listbox.config(yscrollcommand=self.on_scroll)
+        self.last_loaded = None
+        self.all_loaded = False
         self.load_habits()
 
+    def run_db(self, key, function, on_done=None, replace=False):
+        """
+        Run a database function on the background thread and hand its result to on_done.
+        :param key: Name for coalescing repeated requests, None for requests that always run.
+        :param function: Function that takes the database connection.
+        :param on_done: Called on the Tk thread with the result.
+        :param replace: Replace a pending request with the same key instead of dropping this one.
+        """
+        def task():
+            with session() as db:
+                return function(db)
+
+        self.tasks.submit(key, task, on_done, lambda e: messagebox.showerror("Error", str(e)), replace)
+
+    def close(self):
+        """Stop the background thread and close the window."""
+        self.tasks.shutdown()
+        self.root.destroy()
+
     def add_habit(self):
         """Add a habit to the database and update the UI."""
         name = self.entry_name.get()
         periodicity = self.entry_period.get()
         if name:
-            db = get_db()
-            habit = Habit(name, periodicity)
-            habit.store(db)
-            db.close()
-            messagebox.showinfo("Success", f"Habit '{name}' with periodicity '{periodicity}' added!")
-            self.entry_name.delete(0, tk.END)  # Clear entry cell.
-            self.load_habits()  # Update list.
+            def done(_):
+                messagebox.showinfo("Success", f"Habit '{name}' with periodicity '{periodicity}' added!")
+                self.entry_name.delete(0, tk.END)  # Clear entry cell.
+                self.load_habits()  # Update list.
+
+            self.run_db(None, lambda db: Habit(name, periodicity).store(db), done)
         else:
             messagebox.showerror("Error", "Please enter a Habit name!")
 
@@ -58,14 +90,12 @@ class HabitTrackerGUI:
         selected_item = self.habit_listbox.curselection()
         if selected_item:
             habit_name = self.habit_listbox.get(selected_item).split(" - ")[0]  # Extract habit name.
-            db = get_db()
-            cur = db.cursor()
-            cur.execute("DELETE FROM habit WHERE name=?", (habit_name,))
-            cur.execute("DELETE FROM tracker WHERE habitName=?", (habit_name,))
-            db.commit()
-            db.close()
-            messagebox.showinfo("Deleted", f"Habit '{habit_name}' deleted!")
-            self.load_habits()  # Update list
+
+            def done(_):
+                messagebox.showinfo("Deleted", f"Habit '{habit_name}' deleted!")
+                self.load_habits()  # Update list
+
+            self.run_db(None, lambda db: delete_habit(db, habit_name), done)
         else:
             messagebox.showerror("Error", "Please select a habit to delete!")
 
@@ -80,12 +110,11 @@ class HabitTrackerGUI:
                 messagebox.showerror("Error", "Please select a new periodicity!")
                 return
 
-            db = get_db()
-            edit_habit(db, habit_name, new_periodicity)  # Call the edit function
-            db.close()
+            def done(_):
+                messagebox.showinfo("Updated", f"'{habit_name}' updated to periodicity: {new_periodicity}")
+                self.load_habits()
 
-            messagebox.showinfo("Updated", f"'{habit_name}' updated to periodicity: {new_periodicity}")
-            self.load_habits()
+            self.run_db(None, lambda db: edit_habit(db, habit_name, new_periodicity), done)  # Call the edit function
         else:
             messagebox.showerror("Error", "Please select a habit to edit!")
 
@@ -94,58 +123,73 @@ class HabitTrackerGUI:
         selected_item = self.habit_listbox.curselection()
         if selected_item:
             habit_name = self.habit_listbox.get(selected_item).split(" - ")[0]
-            db = get_db()
-            checkoff_habit(db, habit_name)
-            db.close()
-            messagebox.showinfo("Tracked", f"Check-off for '{habit_name}' recorded!")
+            self.run_db(None, lambda db: checkoff_habit(db, habit_name),
+                        lambda _: messagebox.showinfo("Tracked", f"Check-off for '{habit_name}' recorded!"))
         else:
             messagebox.showerror("Error", "Please select a habit to track!")
 
     def load_habits(self):
-        """Load all habits and display in listbox."""
+        """Load the first page of habits and display in listbox."""
         self.habit_listbox.delete(0, tk.END)
-        db = get_db()
-        habits = get_all_habits(db)
-        db.close()
-        for habit in habits:
-            self.habit_listbox.insert(tk.END, f"{habit}")
+        self.last_loaded = None
+        self.all_loaded = False
+        self.tasks.cancel("habit_page")  # A page requested before the reset is outdated
+        self.load_next_page()
+
+    def load_next_page(self):
+        """Append the next page of habits to the listbox."""
+        if self.all_loaded:
+            return
+        after = self.last_loaded
+
+        def done(habits):
+            if habits:
+                self.habit_listbox.insert(tk.END, *habits)
+                self.last_loaded = habits[-1]
+            self.all_loaded = len(habits) < HABIT_PAGE_SIZE
+
+        self.run_db("habit_page", lambda db: get_habit_page(db, after=after, limit=HABIT_PAGE_SIZE), done)
+
+    def on_scroll(self, first, last):
+        """Update the scrollbar and load more habits when the end of the list comes into view."""
+        self.scrollbar.set(first, last)
+        if float(last) > 0.9:
+            self.load_next_page()
 
     def analyse_habit(self):
         """Show streak analysis for the selected habit."""
         selected_item = self.habit_listbox.curselection()
         if selected_item:
             habit_name = self.habit_listbox.get(selected_item).split(" - ")[0]  # Extract name
-            db = get_db()
-            streak = calculate_streak(db, habit_name)
-            db.close()
-            messagebox.showinfo("Habit Analysis", f"🔥 Longest streak for '{habit_name}': {streak} days.")
+            self.run_db(f"analyse:{habit_name}", lambda db: calculate_streak(db, habit_name),
+                        lambda streak: messagebox.showinfo(
+                            "Habit Analysis", f"🔥 Longest streak for '{habit_name}': {streak} days."))
         else:
             messagebox.showerror("Error", "Please select a habit to analyse!")
 
     def show_all_habits(self):
         """Show all tracked habits in a message box."""
-        db = get_db()
-        habits = get_all_habits(db)
-        db.close()
-        habit_list = "\n".join(habits) if habits else "No habits found."
-        messagebox.showinfo("All Habits", habit_list)
+        def done(habits):
+            habit_list = "\n".join(habits) if habits else "No habits found."
+            messagebox.showinfo("All Habits", habit_list)
+
+        self.run_db("all_habits", get_all_habits, done)
 
     def show_habits_by_periodicity(self):
         """Show habits filtered by periodicity."""
         periodicity = self.entry_period.get()
-        db = get_db()
-        habits = get_habits_by_periodicity(db, periodicity)
-        db.close()
-        habit_list = "\n".join(habits) if habits else f"No {periodicity} habits found."
-        messagebox.showinfo(f"Habits ({periodicity})", habit_list)
+
+        def done(habits):
+            habit_list = "\n".join(habits) if habits else f"No {periodicity} habits found."
+            messagebox.showinfo(f"Habits ({periodicity})", habit_list)
+
+        self.run_db(f"periodicity:{periodicity}", lambda db: get_habits_by_periodicity(db, periodicity), done)
 
     def show_longest_streak(self):
         """Show the longest streak among all habits."""
-        db = get_db()
-        longest_streak = get_longest_streak(db)
-        db.close()
-        messagebox.showinfo("Longest Streak", f"🔥 Longest streak: {longest_streak} days.")
-
+        self.run_db("longest_streak", get_longest_streak,
+                    lambda longest_streak: messagebox.showinfo(
+                        "Longest Streak", f"🔥 Longest streak: {longest_streak} days."))
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -1,33 +1,144 @@
-from db import add_habit, checkoff_habit, delete_habit, edit_habit
+from datetime import date
+from enum import IntEnum
+from typing import NamedTuple
+from db import DEFAULT_USER_ID, add_habit, checkoff_habit, delete_habit, edit_habit, get_habit, get_habit_days
+
+class Periodicity(IntEnum):
+    """Periodicity of a habit. The database stores the name, in memory it is a small int."""
+    DAILY = 0
+    WEEKLY = 1
+    MONTHLY = 2
+    BI_ANNUALLY = 3
+    ANNUALLY = 4
+
+    @property
+    def label(self):
+        """
+        Name of the periodicity as used in the database and the CLI.
+        :return: e.g. "daily" or "bi-annually"
+        """
+        return self.name.lower().replace("_", "-")
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Converts a periodicity name (any case) to the enum.
+        :param value: Periodicity name or Periodicity.
+        :return: Periodicity
+        """
+        if isinstance(value, cls):
+            return value
+        try:
+            return cls[value.upper().replace("-", "_")]
+        except KeyError:
+            raise ValueError(f"Unknown periodicity: {value}") from None
+
+
+class CheckOff(NamedTuple):
+    """A single check-off: the habit id and the day number (date ordinal)."""
+    habit_id: int
+    day: int
+
+    @property
+    def date(self):
+        """
+        Date of the check-off.
+        :return: date object
+        """
+        return date.fromordinal(self.day)
+
 
 class Habit:
+    # No per-instance __dict__, a loaded habit only holds these four references
+    __slots__ = ("name", "periodicity", "user_id", "habit_id")
 
-    def __init__(self, name: str, periodicity: str):
+    def __init__(self, name: str, periodicity, user_id: int = DEFAULT_USER_ID, habit_id: int = None):
         """
         A class to represent a habit that a user wants to track.
         :param name: name of the habit
-        :param periodicity: periodicity of the habit (e.g. daily, weekly,..)
+        :param periodicity: periodicity of the habit (e.g. daily, weekly,..), name or Periodicity
+        :param user_id: id of the user the habit belongs to
+        :param habit_id: id of the habit in the database, None until it is stored
         """
         self.name = name
-        self.periodicity = periodicity
+        self.periodicity = Periodicity.parse(periodicity)
+        self.user_id = user_id
+        self.habit_id = habit_id
 
     def __str__(self):
         """
         Runs a string representation, showing its name. Useful for debugging and logging.
         :return: Habit and periodicity
         """
-        return f"{self.name}: {self.periodicity}"
+        return f"{self.name}: {self.periodicity.label}"
 
     def store(self, db):
         """
         Database functionality to store a habit.
         :param db: Database connection object.
         """
-        add_habit(db, self.name, self.periodicity)
+        add_habit(db, self.name, self.periodicity.label, self.user_id)
+        self.habit_id = get_habit(db, self.name, self.user_id)[0]
 
     def delete(self,db):
         """
         Deletes a Habit.
         :param db: Database connection object.
         """
-        delete_habit(db, self.name, self.periodicity)
+        delete_habit(db, self.name, self.user_id)
+        self.habit_id = None
+
+    def checkoffs(self, db):
+        """
+        Loads the check-offs of the habit.
+        :param db: Database connection object.
+        :return: list of CheckOff records, ordered by day.
+        """
+        return [CheckOff(self.habit_id, day) for day in get_habit_days(db, self.name, self.user_id)]
+
+
+class HabitMap:
+
+    def __init__(self, db, user_id=DEFAULT_USER_ID):
+        """
+        Identity map of the habits of a user: every habit is loaded once and the same Habit object
+        is returned for its name and its id afterwards.
+        :param db: Database connection object.
+        :param user_id: Id of the user.
+        """
+        self.db = db
+        self.user_id = user_id
+        self.by_name = {}
+        self.by_id = {}
+
+    def get(self, name):
+        """
+        Returns the habit with the given name, loading it on first use.
+        :param name: Name of the habit.
+        :return: Habit, None if the habit does not exist.
+        """
+        habit = self.by_name.get(name)
+        if habit is None:
+            row = get_habit(self.db, name, self.user_id)
+            if row is None:
+                return None
+            habit = Habit(name, row[1], self.user_id, row[0])
+            self.by_name[name] = self.by_id[habit.habit_id] = habit
+        return habit
+
+    def __getitem__(self, habit_id):
+        """
+        Returns an already loaded habit by its id.
+        :param habit_id: Id of the habit.
+        :return: Habit
+        """
+        return self.by_id[habit_id]
+
+    def forget(self, name):
+        """
+        Removes a habit from the map, e.g. after it was deleted or edited.
+        :param name: Name of the habit.
+        """
+        habit = self.by_name.pop(name, None)
+        if habit is not None:
+            self.by_id.pop(habit.habit_id, None)
@@ -0,0 +1,215 @@
+# Optional instrumentation of the database and analytics hot paths.
+#
+# Enabled with the environment variable HABITTRACKER_STATS=<file> or with "main.py --stats <file>".
+# Every connection opened through connection.py then reports its statements (sqlite3 trace callback),
+# fetched rows (row factory) and commits, and the analytics functions are timed as spans.
+# The numbers are written when the command ends: appended as one JSON line per command, or, for files
+# ending in .prom, as a Prometheus text file (e.g. for the node exporter's textfile collector).
+#
+# Without HABITTRACKER_STATS or --stats no callbacks are installed, the only cost is one check per span.
+import os
+import re
+import threading
+import time
+from functools import wraps
+
+# Literals are replaced with "?" so the timings of one statement with different values are added up.
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+class Stats:
+
+    def __init__(self, path):
+        """
+        Counters and timings of one process.
+        :param path: File the numbers are written to, see write.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.rows = 0
+        self.commits = 0
+        self.statements = {}  # normalized SQL -> [count, seconds]
+        self.spans = {}  # span name -> [count, seconds, max seconds]
+        self.counters = {}  # name -> count
+        self.local = threading.local()  # Statement running on this thread and its start time
+        self.written = False
+
+    def on_statement(self, sql):
+        """Trace callback: called by SQLite before every statement."""
+        now = time.perf_counter()
+        self._finish_statement(now)
+        keyword = sql.lstrip()[:8].upper()
+        with self.lock:
+            if keyword.startswith("COMMIT"):
+                self.commits += 1
+            elif not keyword.startswith(("BEGIN", "ROLLBACK")):
+                self.queries += 1
+                self.local.statement = (_LITERALS.sub("?", " ".join(sql.split())), now)
+
+    def on_row(self, cursor, row):
+        """Row factory: counts every fetched row and returns it unchanged."""
+        with self.lock:
+            self.rows += 1
+        return row
+
+    def _finish_statement(self, now):
+        """
+        Books the time of the statement running on this thread. A statement is timed until the next one
+        starts or the stats are written, so the time includes the Python work on its results.
+        """
+        statement = getattr(self.local, "statement", None)
+        if statement is None:
+            return
+        self.local.statement = None
+        sql, start = statement
+        with self.lock:
+            entry = self.statements.setdefault(sql, [0, 0.0])
+            entry[0] += 1
+            entry[1] += now - start
+
+    def add_span(self, name, seconds):
+        """Books one call of a timed function."""
+        with self.lock:
+            entry = self.spans.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def count(self, name):
+        """Increments a named counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def snapshot(self, command=None):
+        """
+        Returns all numbers as a JSON-serializable dict.
+        :param command: Name of the command the numbers belong to.
+        :return: dict
+        """
+        self._finish_statement(time.perf_counter())
+        with self.lock:
+            return {
+                "command": command,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "queries": self.queries,
+                "rows": self.rows,
+                "commits": self.commits,
+                "counters": dict(self.counters),
+                "statements": {sql: {"count": count, "seconds": seconds}
+                               for sql, (count, seconds) in self.statements.items()},
+                "spans": {name: {"count": count, "seconds": seconds, "max_seconds": longest}
+                          for name, (count, seconds, longest) in self.spans.items()},
+            }
+
+    def write(self, command=None):
+        """
+        Writes the numbers to the stats file: a JSON line, or the Prometheus text format for .prom files.
+        :param command: Name of the command the numbers belong to.
+        """
+        snapshot = self.snapshot(command)
+        self.written = True
+        if self.path.endswith(".prom"):
+            with open(self.path, "w") as file:
+                file.write(prometheus_text(snapshot))
+        else:
+            import json
+            with open(self.path, "a") as file:
+                file.write(json.dumps(snapshot) + "\n")
+
+
+def prometheus_text(snapshot):
+    """
+    Formats a snapshot in the Prometheus text exposition format.
+    :param snapshot: dict, see Stats.snapshot.
+    :return: str
+    """
+    def label(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+    command = f'command="{label(snapshot["command"] or "")}"'
+    lines = []
+    for metric, key in (("queries", "queries"), ("rows_fetched", "rows"), ("commits", "commits")):
+        lines += [f"# TYPE habittracker_{metric}_total counter",
+                  f"habittracker_{metric}_total{{{command}}} {snapshot[key]}"]
+    lines += ["# TYPE habittracker_events_total counter"]
+    lines += [f'habittracker_events_total{{{command},event="{label(name)}"}} {count}'
+              for name, count in snapshot["counters"].items()]
+    lines += ["# TYPE habittracker_statement_seconds_total counter"]
+    lines += [f'habittracker_statement_seconds_total{{{command},statement="{label(sql)}"}} '
+              f'{entry["seconds"]:.6f}' for sql, entry in snapshot["statements"].items()]
+    lines += ["# TYPE habittracker_span_calls_total counter"]
+    lines += [f'habittracker_span_calls_total{{{command},span="{label(name)}"}} {entry["count"]}'
+              for name, entry in snapshot["spans"].items()]
+    lines += ["# TYPE habittracker_span_seconds_total counter"]
+    lines += [f'habittracker_span_seconds_total{{{command},span="{label(name)}"}} {entry["seconds"]:.6f}'
+              for name, entry in snapshot["spans"].items()]
+    return "\n".join(lines) + "\n"
+
+
+# Stats of this process, None while instrumentation is disabled.
+stats = None
+
+
+def enable(path):
+    """
+    Switches the instrumentation on. Only connections opened afterwards are traced.
+    :param path: File the numbers are written to.
+    :return: Stats object.
+    """
+    global stats
+    if stats is None:
+        stats = Stats(path)
+    return stats
+
+
+def instrument_connection(db):
+    """
+    Installs the trace callback and the counting row factory on a connection, if enabled.
+    :param db: Database connection object.
+    """
+    if stats is not None:
+        db.set_trace_callback(stats.on_statement)
+        db.row_factory = stats.on_row
+
+
+def span(name):
+    """
+    Decorator that times every call of a function as a span, if enabled.
+    :param name: Name of the span.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if stats is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.add_span(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name):
+    """
+    Increments a named counter, if enabled.
+    :param name: Name of the counter, e.g. "analyse_errors".
+    """
+    if stats is not None:
+        stats.count(name)
+
+
+def _write_at_exit():
+    """Writes the numbers of processes that did not write them themselves, e.g. the daemon."""
+    if stats is not None and not stats.written:
+        stats.write()
+
+
+if os.environ.get("HABITTRACKER_STATS"):
+    import atexit
+    enable(os.environ["HABITTRACKER_STATS"])
+    atexit.register(_write_at_exit)
@@ -1,102 +1,449 @@
+import time
+_started = time.perf_counter()
+import json
+from contextlib import contextmanager
 import click
-from db import get_db, get_all_habits, checkoff_habit, delete_habit, edit_habit
-from habit import Habit
-from analyse import calculate_streak, get_habits_by_periodicity, get_longest_streak
+import daemon
+
+# (step, seconds) of the startup steps, reported with --profile-startup.
+_timings = [("import main modules", time.perf_counter() - _started)]
+
+@contextmanager
+def _profile(step):
+    """Measures a startup step for --profile-startup."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _timings.append((step, time.perf_counter() - start))
+
+def _report_profile():
+    """Prints the measured startup steps to stderr."""
+    click.echo("⏱️ Startup profile:", err=True)
+    for step, seconds in _timings:
+        click.echo(f"  {step:<28}{seconds * 1000:8.1f} ms", err=True)
+    click.echo(f"  {'total since main.py loaded':<28}{(time.perf_counter() - _started) * 1000:8.1f} ms", err=True)
 
 @click.group()
-def cli():
+@click.option("--user", default="default", envvar="HABITTRACKER_USER", show_default=True,
+              help="Name of the user whose habits are managed. Can be set with HABITTRACKER_USER.")
+@click.option("--profile-startup", is_flag=True, help="Report import and initialisation times on stderr.")
+@click.option("--stats", "stats_path", default=None, envvar="HABITTRACKER_STATS", metavar="FILE",
+              help="Record queries, rows, commits and analytics timings and append them to FILE "
+                   "(JSON lines, Prometheus text format for *.prom). The command then runs in this process, "
+                   "not in the daemon. Can be set with HABITTRACKER_STATS.")
+@click.pass_context
+def cli(ctx, user, profile_startup, stats_path):
     """Habit Tracker CLI - Manage your habits via command line."""
-    pass
+    ctx.obj = {"user": user, "daemon": not stats_path}  # Work done in the daemon would not be counted
+    if profile_startup:
+        ctx.call_on_close(_report_profile)
+    if stats_path:
+        import instrument
+        stats = instrument.enable(stats_path)
+        ctx.call_on_close(lambda: stats.write(ctx.invoked_subcommand))
+
+def _user():
+    """Returns the user selected with --user."""
+    return click.get_current_context().obj["user"]
+
+def _daemon_request(op, **params):
+    """
+    Sends a request to the daemon, unless the command has to run in this process (--stats).
+    :param op: Name of the operation, see operations.OPERATIONS.
+    :param params: Parameters of the operation.
+    :return: Result of the operation.
+    :raises daemon.DaemonUnavailable: If no daemon is running or it must not be used.
+    """
+    if not click.get_current_context().obj["daemon"]:
+        raise daemon.DaemonUnavailable(daemon.socket_path())
+    return daemon.request(op, **params)
+
+def _session(readonly=False):
+    """
+    Imports the database modules and opens the database, measuring both for --profile-startup.
+    Without a daemon this is the only place the database modules are imported.
+    :param readonly: Run without a write transaction.
+    :return: Context manager, see connection.session.
+    """
+    with _profile("import database modules"):
+        from connection import get_connection, session
+    with _profile("open database"):
+        get_connection()
+    return session(readonly=readonly)
+
+def run(op, **params):
+    """
+    Runs an operation in the daemon if one is serving, otherwise directly on the database.
+    Read-only operations run without a write transaction.
+    :param op: Name of the operation, see operations.OPERATIONS.
+    :param params: Parameters of the operation.
+    :return: Result of the operation.
+    """
+    try:
+        with _profile(f"daemon {op}"):
+            return _daemon_request(op, **params)
+    except daemon.DaemonUnavailable:
+        with _profile("import operations"):
+            from operations import OPERATIONS, READ_ONLY
+        with _session(readonly=op in READ_ONLY) as db, _profile(f"run {op}"):
+            return OPERATIONS[op](db, **params)
+    except daemon.DaemonError as e:
+        raise click.ClickException(str(e))
 
 @click.command()
 @click.argument("name")
 @click.argument("periodicity", type=click.Choice(["daily", "weekly", "monthly", "bi-annually", "annually"], case_sensitive=False))
 def create(name, periodicity):
     """Create a new habit."""
-    db = get_db()
-    habit = Habit(name, periodicity)
-    habit.store(db)
-    db.close()
+    run("create", name=name, periodicity=periodicity, user=_user())
     click.echo(f"✅ Habit '{name}' with periodicity '{periodicity}' added!")
 
 @click.command()
 @click.argument("name")
 def delete(name):
     """Delete a habit from the database."""
-    db = get_db()
-    delete_habit(db, name)
-    db.close()
+    run("delete", name=name, user=_user())
     click.echo(f"✅ Habit '{name}' deleted!")
 
-    db.close()
-
 @click.command()
 @click.argument("name")
 @click.argument("new_periodicity", type=click.Choice(["daily", "weekly", "monthly", "bi-annually", "annually"], case_sensitive=False))
 def edit(name, new_periodicity):
     """Update the periodicity of a habit."""
-    db = get_db()
-    edit_habit(db, name, new_periodicity)
-    db.close()
+    run("edit", name=name, new_periodicity=new_periodicity, user=_user())
     click.echo(f"✅ Habit '{name}' updated to periodicity '{new_periodicity}'.")
 
+DATE = click.DateTime(formats=["%Y-%m-%d"])
+
 @click.command()
 @click.argument("name")
-@click.option("--date", default=None, help="Date of completion (YYYY-MM-DD). Defaults to today.")
-def checkoff(name, date):
+@click.option("--date", type=DATE, default=None, help="Date of completion (YYYY-MM-DD). Defaults to today.")
+@click.option("--log", "to_log", is_flag=True, envvar="HABITTRACKER_INGEST",
+              help="Append to the check-off log instead of writing the database (for bursts of check-offs). "
+                   "Can be set with HABITTRACKER_INGEST=1.")
+def checkoff(name, date, to_log):
     """Log a completion for a habit (check-off)."""
-    db = get_db()
-
-    if not date:
+    if date:
+        date = date.date().isoformat()
+    else:
         from datetime import date as dt
         date = dt.today().isoformat()
 
-    checkoff_habit(db, name, date)
-    db.close()
+    if to_log:
+        _append_to_log(name, date)
+    else:
+        run("checkoff", name=name, date=date, user=_user())
     click.echo(f"✅ Check-off logged for habit '{name}' on {date}.")
 
+def _append_to_log(name, date):
+    """
+    Appends a check-off to the check-off log. A large log is compacted right away,
+    unless the database is locked by another writer, then the next compaction picks it up.
+    :param name: Name of the habit.
+    :param date: Date of the check-off (YYYY-MM-DD).
+    """
+    from eventlog import COMPACT_SIZE, EventLog
+    log = EventLog.for_database()
+    log.append([(name, date)], _user())
+    if log.size() >= COMPACT_SIZE:
+        import sqlite3
+        try:
+            with _session() as db:
+                log.compact(db)
+        except sqlite3.OperationalError:
+            pass
+
 
 @click.command()
 def list_habits():
     """List all currently tracked habits."""
-    db = get_db()
-    habits = get_all_habits(db)
-    db.close()
-
-    if habits:
-        click.echo("📋 Your tracked habits:")
-        for habit in habits:
-            click.echo(f"- {habit}")
-    else:
-        click.echo("⚠️ No habits found.")
+    _echo_habits(None, "📋 Your tracked habits:", "⚠️ No habits found.")
 
 @click.command()
 @click.argument("periodicity",
                 type=click.Choice(["daily", "weekly", "monthly", "bi-annually", "annually"], case_sensitive=False))
 def list_by_periodicity(periodicity):
     """List all habits with a specific periodicity."""
-    db = get_db()
-    habits = get_habits_by_periodicity(db, periodicity)
-    db.close()
-    if habits:
-        click.echo(f"📆 Habits with periodicity '{periodicity}':")
-        for habit in habits:
-            click.echo(f"- {habit}")
-    else:
-        click.echo(f"⚠️ No habits found for periodicity '{periodicity}'.")
+    _echo_habits(periodicity, f"📆 Habits with periodicity '{periodicity}':",
+                 f"⚠️ No habits found for periodicity '{periodicity}'.")
+
+def _echo_habits(periodicity, title, empty_message):
+    """
+    Prints habit names, from the daemon or while they are read from the database.
+    :param periodicity: Periodicity to filter by, None for all habits.
+    :param title: Line printed before the first habit.
+    :param empty_message: Line printed if there are no habits.
+    """
+    try:
+        _print_habits(_daemon_request("list_habits", periodicity=periodicity, user=_user()), title, empty_message)
+    except daemon.DaemonUnavailable:
+        with _session(readonly=True) as db:
+            from db import get_user_id, iter_habits
+            _print_habits(iter_habits(db, periodicity, user_id=get_user_id(db, _user())), title, empty_message)
+
+def _print_habits(habits, title, empty_message):
+    """
+    Prints habit names as a list.
+    :param habits: Iterable of habit names.
+    :param title: Line printed before the first habit.
+    :param empty_message: Line printed if there are no habits.
+    """
+    found = False
+    for habit in habits:
+        if not found:
+            click.echo(title)
+            found = True
+        click.echo(f"- {habit}")
+    if not found:
+        click.echo(empty_message)
+
+
+SNAPSHOT = click.option("--snapshot", "snapshot_path", type=click.Path(exists=True, dir_okay=False), default=None,
+                        help="Read a snapshot file (see the snapshot command) instead of the database.")
+
+# Mirrors analyse.BACKENDS, analyse is not imported at startup.
+BACKEND = click.option("--backend", type=click.Choice(["sqlite", "columnar"]), default="sqlite", show_default=True,
+                       help="Read the stored streaks or compute all habits at once from columns of check-offs.")
 
+def _from_snapshot(path, function, *args):
+    """
+    Runs a snapshot function of analyse.py on a memory-mapped snapshot file, without opening the database.
+    :param path: Path of the snapshot file.
+    :param function: Name of the function, e.g. "get_snapshot_top_streaks".
+    :param args: Arguments after the snapshot.
+    :return: Result of the function.
+    """
+    import analyse
+    from snapshot import Snapshot
+    try:
+        with Snapshot(path) as snapshot_file:
+            return getattr(analyse, function)(snapshot_file, *args, user=_user())
+    except ValueError as e:
+        raise click.ClickException(str(e))
 
 @click.command()
-def longest_streak():
+@SNAPSHOT
+def longest_streak(snapshot_path):
     """Show the habit with the longest streak."""
-    db = get_db()
-    best_habit, max_streak = get_longest_streak(db)
-    db.close()
+    if snapshot_path:
+        top = _from_snapshot(snapshot_path, "get_snapshot_top_streaks", 1)
+        best_habit, max_streak = top[0] if top else (None, 0)
+    else:
+        best_habit, max_streak = run("longest_streak", user=_user())
     if best_habit:
         click.echo(f"🏆 Longest streak: '{best_habit}' with {max_streak} days!")
     else:
         click.echo("⚠️ No habit streaks found.")
 
+@click.command()
+@click.option("--limit", default=10, show_default=True, help="Number of habits to show.")
+@click.option("--by", type=click.Choice(["longest", "current"]), default="longest", show_default=True,
+              help="Rank by the longest or by the current streak.")
+@SNAPSHOT
+@BACKEND
+def top_streaks(limit, by, snapshot_path, backend):
+    """Show the habits with the longest (or current) streaks."""
+    if snapshot_path:
+        ranking = _from_snapshot(snapshot_path, "get_snapshot_top_streaks", limit, by)
+    else:
+        ranking = run("top_streaks", limit=limit, by=by, user=_user(), backend=backend)
+    if not ranking:
+        click.echo("⚠️ No habits found.")
+        return
+    click.echo(f"🏆 Top {len(ranking)} habits by {by} streak:")
+    for rank, (habit, streak) in enumerate(ranking, start=1):
+        click.echo(f"{rank:>3}. {habit}: {streak}")
+
+def _date_range(since, until, days=None):
+    """
+    Returns the bounds of a date range as YYYY-MM-DD strings.
+    :param since: datetime from --since or None.
+    :param until: datetime from --until or None.
+    :param days: Length of the range if --since is missing, None to leave it open.
+    :return: tuple: (since, until)
+    """
+    from datetime import date, timedelta
+    until = until.date() if until else (date.today() if days else None)
+    since = since.date() if since else (until - timedelta(days=days - 1) if days else None)
+    if since and until and since > until:
+        raise click.BadParameter("--since must not be after --until.")
+    return since and since.isoformat(), until and until.isoformat()
+
+@click.command()
+@click.option("--since", type=DATE, default=None, help="First day (YYYY-MM-DD). Defaults to 30 days before --until.")
+@click.option("--until", type=DATE, default=None, help="Last day (YYYY-MM-DD). Defaults to today.")
+@SNAPSHOT
+@BACKEND
+def completion_rate(since, until, snapshot_path, backend):
+    """Show the share of periods with a check-off for every habit."""
+    since, until = _date_range(since, until, days=30)
+    if snapshot_path:
+        rates = _from_snapshot(snapshot_path, "get_snapshot_completion_rates", since, until)
+    else:
+        rates = run("completion_rates", since=since, until=until, user=_user(), backend=backend)
+    if not rates:
+        click.echo("⚠️ No habits found.")
+        return
+    click.echo(f"📈 Completion from {since} to {until}:")
+    for habit, rate in rates.items():
+        click.echo(f"- {habit}: {rate:.0%}")
+
+@click.command()
+@click.argument("name")
+@click.option("--since", type=DATE, default=None, help="First day (YYYY-MM-DD). Defaults to the first check-off.")
+@click.option("--until", type=DATE, default=None, help="Last day (YYYY-MM-DD). Defaults to the last check-off.")
+@click.option("--per", type=click.Choice(["daily", "weekly", "monthly", "bi-annually", "annually"], case_sensitive=False),
+              default=None, help="Length of the periods. Defaults to the periodicity of the habit.")
+def period_counts(name, since, until, per):
+    """Show the number of check-offs of a habit per period."""
+    since, until = _date_range(since, until)
+    counts = run("period_counts", name=name, since=since, until=until, per=per, user=_user())
+    if counts is None:
+        click.echo(f"⚠️ Habit '{name}' not found!")
+    elif not counts:
+        click.echo(f"⚠️ No check-offs found for '{name}'.")
+    else:
+        click.echo(f"📊 Check-offs of '{name}' per period:")
+        for start, count in counts.items():
+            click.echo(f"- {start}: {count}")
+
+@click.command()
+@click.argument("path", default="main.db.snapshot")
+def snapshot(path):
+    """Write all habits and check-offs to a snapshot file for reports (see --snapshot)."""
+    from snapshot import write_snapshot
+    with _session(readonly=True) as db:
+        habits, checkoffs = write_snapshot(db, path)
+    click.echo(f"📸 Snapshot of {habits} habits and {checkoffs} check-offs written to {path}.")
+
+@click.command()
+def compact():
+    """Merge the check-off log (checkoff --log) into the database."""
+    count = run("compact")
+    click.echo(f"🗜️ Compacted {count} check-offs into the database.")
+
+@click.command()
+def dedupe():
+    """Remove duplicate check-offs from the database."""
+    removed = run("dedupe")
+    click.echo(f"🧹 Removed {removed} duplicate check-offs.")
+
+
+def _read_checkoffs(file, file_format):
+    """
+    Lazily parses check-offs from a CSV (habit,date) or JSON lines ({"habit": ..., "date": ...}) file.
+    :param file: Open text file.
+    :param file_format: "csv" or "jsonl".
+    :return: Generator of (habit, date) pairs.
+    :raises ValueError: If a record can't be read, with its line number.
+    """
+    import csv
+    from datetime import date
+    if file_format == "jsonl":
+        records = ((number, line) for number, line in enumerate(file, start=1) if line.strip())
+    else:
+        reader = csv.reader(file)
+        records = ((reader.line_num, row) for row in reader if row and row != ["habit", "date"])  # Skip the header
+    for number, record in records:
+        try:
+            if file_format == "jsonl":
+                record = json.loads(record)
+                habit, event_date = record["habit"], record["date"]
+            else:
+                habit, event_date = record[0], record[1]
+            date.fromisoformat(event_date)  # Bad dates would only fail later in checkoff_many
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise ValueError(f"line {number}: {type(e).__name__}: {e}") from e
+        yield habit, event_date
+
+def _guess_format(file, file_format):
+    """Returns the given format or guesses it from the file name (CSV by default)."""
+    return file_format or ("jsonl" if file.name.endswith((".jsonl", ".json")) else "csv")
+
+@click.command(name="import")
+@click.argument("source", type=click.File("r"), default="-")
+@click.option("--format", "file_format", type=click.Choice(["csv", "jsonl"]), default=None,
+              help="Input format. Guessed from the file name, defaults to CSV.")
+@click.option("--batch-size", default=10000, show_default=True, help="Check-offs per transaction.")
+@click.option("--on-duplicate", type=click.Choice(["ignore", "error"]), default="ignore", show_default=True,
+              help="Skip check-offs that already exist or stop with an error.")
+@click.option("--progress", is_flag=True, help="Report progress after every batch.")
+def import_checkoffs(source, file_format, batch_size, on_duplicate, progress):
+    """Import check-offs from a CSV or JSON lines file (or stdin). Check-offs of unknown habits are skipped."""
+    import sqlite3
+    from db import checkoff_many, get_user_id
+
+    def report(read, inserted):
+        click.echo(f"… {read} read, {inserted} imported", err=True)
+
+    checkoffs = _read_checkoffs(source, _guess_format(source, file_format))
+    try:
+        with _session() as db:
+            inserted = checkoff_many(db, checkoffs, batch_size, on_duplicate, report if progress else None,
+                                     get_user_id(db, _user()))
+    except sqlite3.IntegrityError as e:
+        raise click.ClickException(f"Import stopped at a duplicate check-off ({e}). Earlier batches were kept.")
+    except ValueError as e:
+        raise click.ClickException(f"Import stopped at an invalid record ({e}). Earlier batches were kept.")
+    click.echo(f"✅ Imported {inserted} check-offs.")
+
+@click.command(name="export")
+@click.argument("destination", type=click.File("w"), default="-")
+@click.option("--format", "file_format", type=click.Choice(["csv", "jsonl"]), default=None,
+              help="Output format. Guessed from the file name, defaults to CSV.")
+def export_checkoffs(destination, file_format):
+    """Export all check-offs as CSV or JSON lines to a file (or stdout)."""
+    import csv
+    from db import get_user_id, iter_checkoffs
+
+    file_format = _guess_format(destination, file_format)
+    with _session(readonly=True) as db:
+        user_id = get_user_id(db, _user())
+        if file_format == "jsonl":
+            for habit, event_date in iter_checkoffs(db, user_id=user_id):
+                destination.write(json.dumps({"habit": habit, "date": event_date}) + "\n")
+        else:
+            writer = csv.writer(destination)
+            writer.writerow(["habit", "date"])
+            writer.writerows(iter_checkoffs(db, user_id=user_id))
+
+@click.command(name="analyse-shards")
+@click.argument("paths", nargs=-1, required=True)
+@click.option("--top", default=10, show_default=True, help="Number of habits per leaderboard.")
+@click.option("--workers", type=int, default=None, help="Number of processes. Defaults to the number of CPUs.")
+@click.option("--json", "as_json", is_flag=True, help="Print the merged summary as JSON.")
+def analyse_shards(paths, top, workers, as_json):
+    """Show leaderboards across several database files (paths or glob patterns)."""
+    from shards import analyse_shards as run_shards
+
+    try:
+        summary = run_shards(paths, top, workers)
+    except (OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+    if as_json:
+        click.echo(json.dumps(summary, indent=2))
+        return
+    if not summary["shards"]:
+        raise click.ClickException("No database files found.")
+
+    click.echo(f"🗂️ {summary['shards']} shards: {summary['users']} users, {summary['habits']} habits, "
+               f"{summary['checkoffs']} check-offs")
+    for key, title in (("longest", "🏆 Longest streaks:"), ("current", "🔥 Current streaks:")):
+        click.echo(title)
+        for rank, (streak, user, habit) in enumerate(summary[key], start=1):
+            click.echo(f"{rank:>3}. {habit} ({user}): {streak}")
+    click.echo("📆 Habits per periodicity:")
+    for periodicity, count in sorted(summary["periodicities"].items()):
+        click.echo(f"- {periodicity}: {count}")
+
+@click.command()
+@click.option("--socket", "path", default=None, help="Path of the Unix domain socket. Defaults to main.db.sock.")
+def serve(path):
+    """Keep the database open and answer the other commands over a local socket."""
+    click.echo(f"🚀 Serving {path or daemon.socket_path()}, stop with Ctrl+C.")
+    daemon.serve(path=path)
+
 
 cli.add_command(create)
 cli.add_command(delete)
@@ -105,6 +452,16 @@ cli.add_command(edit)
 cli.add_command(list_habits)
 cli.add_command(list_by_periodicity)
 cli.add_command(longest_streak)
+cli.add_command(top_streaks)
+cli.add_command(completion_rate)
+cli.add_command(period_counts)
+cli.add_command(snapshot)
+cli.add_command(compact)
+cli.add_command(dedupe)
+cli.add_command(import_checkoffs)
+cli.add_command(export_checkoffs)
+cli.add_command(analyse_shards)
+cli.add_command(serve)
 
 if __name__ == "__main__":
     cli()
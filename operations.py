@@ -0,0 +1,116 @@
+# CLI operations that can run either in the CLI process or in the daemon (see daemon.py).
+# Every operation takes the database connection and JSON-serializable keyword arguments
+# and returns a JSON-serializable result. Habit operations take the name of the user;
+# a user is created on their first write, reads of an unknown user find nothing.
+# Streak rankings, completion rates and period counts include the check-offs still waiting in the check-off log
+# (see eventlog.py).
+# The analytics modules are imported by the operations that use them, so the CLI starts fast.
+from db import (DEFAULT_USER, checkoff_habit, delete_habit, edit_habit, get_user_id, iter_habits,
+                remove_duplicate_checkoffs)
+
+
+def create(db, name, periodicity, user=DEFAULT_USER):
+    """Creates a new habit."""
+    from habit import Habit
+    Habit(name, periodicity, get_user_id(db, user, create=True)).store(db)
+
+
+def delete(db, name, user=DEFAULT_USER):
+    """Deletes a habit."""
+    delete_habit(db, name, get_user_id(db, user))
+
+
+def edit(db, name, new_periodicity, user=DEFAULT_USER):
+    """Updates the periodicity of a habit."""
+    return edit_habit(db, name, new_periodicity, get_user_id(db, user))
+
+
+def checkoff(db, name, date, user=DEFAULT_USER):
+    """Logs a check-off."""
+    checkoff_habit(db, name, date, get_user_id(db, user))
+
+
+def list_habits(db, periodicity=None, user=DEFAULT_USER):
+    """Returns the names of all habits, or of all habits with the given periodicity."""
+    return list(iter_habits(db, periodicity, user_id=get_user_id(db, user)))
+
+
+def _pending_log(db):
+    """Returns the check-off log of the database if it holds check-offs that are not compacted yet."""
+    from eventlog import EventLog
+    log = EventLog.for_connection(db)
+    return log if log is not None and log.has_pending() else None
+
+
+def longest_streak(db, user=DEFAULT_USER):
+    """Returns the habit with the longest streak as [habit name, streak]."""
+    log = _pending_log(db)
+    if log is not None:
+        top = log.merged_top_streaks(db, 1, user=user)
+        return list(top[0]) if top else [None, 0]
+    from analyse import get_longest_streak
+    return list(get_longest_streak(db, get_user_id(db, user)))
+
+
+def top_streaks(db, limit=10, by="longest", user=DEFAULT_USER, backend="sqlite"):
+    """Returns the habits with the longest or current streaks as [[habit name, streak], ...]."""
+    log = _pending_log(db)
+    if log is not None:
+        return [list(item) for item in log.merged_top_streaks(db, limit, by, user)]
+    from analyse import get_top_streaks
+    return [list(item) for item in get_top_streaks(db, limit, by, user_id=get_user_id(db, user), backend=backend)]
+
+
+def completion_rates(db, since, until, user=DEFAULT_USER, backend="sqlite"):
+    """Returns the completion rate of every habit between two dates as {habit name: rate}."""
+    log = _pending_log(db)
+    if log is not None:
+        return log.merged_completion_rates(db, since, until, user)
+    from analyse import get_completion_rates
+    return get_completion_rates(db, since, until, user_id=get_user_id(db, user), backend=backend)
+
+
+def period_counts(db, name, since=None, until=None, per=None, user=DEFAULT_USER):
+    """Returns the check-offs of a habit per period as {first day of the period: count}, None for unknown habits."""
+    log = _pending_log(db)
+    if log is not None:
+        return log.merged_period_counts(db, name, since, until, per, user)
+    from analyse import get_period_counts
+    return get_period_counts(db, name, since, until, per, user_id=get_user_id(db, user))
+
+
+def compact(db):
+    """Merges the check-off log into the database and returns how many check-offs were stored."""
+    from eventlog import EventLog
+    log = EventLog.for_connection(db)
+    return log.compact(db) if log is not None else 0
+
+
+def dedupe(db):
+    """Removes duplicate check-offs and returns how many were removed."""
+    return remove_duplicate_checkoffs(db)
+
+
+def stats(db):
+    """Returns the statistics of the analytics cache."""
+    from cache import analytics_cache
+    return analytics_cache.stats()
+
+
+OPERATIONS = {
+    "create": create,
+    "delete": delete,
+    "edit": edit,
+    "checkoff": checkoff,
+    "list_habits": list_habits,
+    "longest_streak": longest_streak,
+    "top_streaks": top_streaks,
+    "completion_rates": completion_rates,
+    "period_counts": period_counts,
+    "compact": compact,
+    "dedupe": dedupe,
+    "stats": stats,
+}
+
+# Operations that never write, they run without a write transaction.
+READ_ONLY = {"list_habits", "longest_streak", "top_streaks", "completion_rates", "period_counts", "stats"}
@@ -0,0 +1,151 @@
+# Analytics across several database files (shards), e.g. when users are spread over many files.
+#
+# Every shard is summarised in its own process: the number of users, habits and check-offs, the habits per
+# periodicity and the top k habits by longest and by current streak. Only these small summaries are sent back
+# and merged into global leaderboards, so the work scales with the number of cores.
+#
+# Shards are opened read-only and never created or migrated, a shard must have the current schema version.
+import glob
+import heapq
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from urllib.parse import quote
+from streaks import current_streak, period_index
+
+
+def expand_paths(patterns):
+    """
+    Expands glob patterns into a sorted list of database paths. Paths without wildcards are kept as they are.
+    :param patterns: Iterable of paths or glob patterns.
+    :return: list of paths, each path only once.
+    """
+    paths = set()
+    for pattern in patterns:
+        paths.update(glob.glob(pattern) if glob.has_magic(pattern) else [pattern])
+    return sorted(paths)
+
+
+def _keep_top(heap, k, entry):
+    """Adds an entry to a min-heap that keeps the k largest entries."""
+    if len(heap) < k:
+        heapq.heappush(heap, entry)
+    elif entry > heap[0]:
+        heapq.heapreplace(heap, entry)
+
+
+def _ranked(heap):
+    """Returns the entries of a top-k heap, highest streak first, ties in user and habit order."""
+    return sorted(heap, key=lambda entry: (-entry[0], entry[1], entry[2]))
+
+
+def open_shard(path):
+    """
+    Opens a shard read-only.
+    :param path: Path of the database file.
+    :return: Database connection object.
+    :raises FileNotFoundError: If the file does not exist.
+    :raises ValueError: If the schema version of the shard is not the current one.
+    """
+    from db import MIGRATIONS
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"Shard {path} does not exist")
+    db = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True)
+    try:
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+    except sqlite3.DatabaseError:
+        db.close()
+        raise ValueError(f"Shard {path} is not a database")
+    if version != len(MIGRATIONS):
+        db.close()
+        raise ValueError(f"Shard {path} has schema version {version}, expected {len(MIGRATIONS)}")
+    return db
+
+
+def shard_summary(path, k=10, today=None):
+    """
+    Summarises one shard in a single pass over its habits and stored streaks.
+    :param path: Path of the database file.
+    :param k: Number of habits per leaderboard.
+    :param today: Reference date for the current streaks. Defaults to today.
+    :return: dict with path, users, habits, checkoffs, periodicities {periodicity: number of habits}
+             and the leaderboards longest and current, lists of (streak, user, habit).
+    :raises FileNotFoundError: If the file does not exist.
+    :raises ValueError: If the file is not a database with the current schema version.
+    """
+    today = (today or date.today()).toordinal()
+    db = open_shard(path)
+    try:
+        cur = db.cursor()
+        users = cur.execute("SELECT COUNT(DISTINCT user_id) FROM habit").fetchone()[0]  # Users with habits
+        checkoffs = cur.execute("SELECT COUNT(*) FROM tracker").fetchone()[0]
+        cur.execute("""SELECT user.name, habit.name, habit.periodicity,
+        s.current_streak, s.longest_streak, s.last_period
+        FROM habit JOIN user ON user.id = habit.user_id LEFT JOIN streak_state s ON s.habit_id = habit.id""")
+
+        habits = 0
+        periodicities = {}
+        longest, current = [], []
+        for user, name, periodicity, last_streak, longest_streak, last_period in cur:
+            habits += 1
+            periodicities[periodicity] = periodicities.get(periodicity, 0) + 1
+            _keep_top(longest, k, (longest_streak or 0, user, name))
+            streak = current_streak(last_streak, last_period, period_index(today, periodicity))
+            _keep_top(current, k, (streak, user, name))
+    finally:
+        db.close()
+
+    return {
+        "path": path,
+        "users": users,
+        "habits": habits,
+        "checkoffs": checkoffs,
+        "periodicities": periodicities,
+        "longest": _ranked(longest),
+        "current": _ranked(current),
+    }
+
+
+def merge_summaries(summaries, k=10):
+    """
+    Merges shard summaries into global totals and leaderboards.
+    The top k of every shard are enough for the global top k.
+    :param summaries: Iterable of shard summaries, see shard_summary.
+    :param k: Number of habits per leaderboard.
+    :return: dict with shards, users, habits, checkoffs, periodicities, longest and current.
+    """
+    merged = {"shards": 0, "users": 0, "habits": 0, "checkoffs": 0, "periodicities": {}}
+    longest, current = [], []
+    for summary in summaries:
+        merged["shards"] += 1
+        for key in ("users", "habits", "checkoffs"):
+            merged[key] += summary[key]
+        for periodicity, count in summary["periodicities"].items():
+            merged["periodicities"][periodicity] = merged["periodicities"].get(periodicity, 0) + count
+        for entry in summary["longest"]:
+            _keep_top(longest, k, tuple(entry))
+        for entry in summary["current"]:
+            _keep_top(current, k, tuple(entry))
+
+    merged["longest"] = _ranked(longest)
+    merged["current"] = _ranked(current)
+    return merged
+
+
+def analyse_shards(paths, k=10, workers=None, today=None):
+    """
+    Summarises several database files in parallel and merges the results.
+    :param paths: List of database paths or glob patterns.
+    :param k: Number of habits per leaderboard.
+    :param workers: Number of processes. Defaults to the number of CPUs, 1 runs everything in this process.
+    :param today: Reference date for the current streaks. Defaults to today.
+    :return: dict, see merge_summaries.
+    """
+    paths = expand_paths(paths)
+    if workers == 1 or len(paths) <= 1:
+        return merge_summaries((shard_summary(path, k, today) for path in paths), k)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        summaries = executor.map(shard_summary, paths, [k] * len(paths), [today] * len(paths))
+        return merge_summaries(summaries, k)
@@ -0,0 +1,150 @@
+# Read-only analytics snapshots ("main.py snapshot").
+#
+# A snapshot holds the habit and tracker tables of all users in one file, in the column layout of columnar.py:
+#   8 bytes   magic b"HTSNAP\x00\x01"
+#   4 bytes   length of the header (little-endian uint32)
+#   header    JSON: creation time, byte order, number of rows and per user the dictionary of habit names and
+#             periodicities with the rows of the user. Padded with spaces to a multiple of 8 bytes.
+#   int32[n]  habit of every check-off, the position in the user's names, sorted by user and habit
+#   int32[n]  day number of every check-off, sorted within each habit
+#
+# Snapshot maps the file into memory and hands out the columns as memoryviews of the mapping, so reading a
+# snapshot copies nothing and reports never touch the database or wait for its writers.
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from datetime import datetime
+from itertools import groupby, repeat
+from operator import itemgetter
+
+MAGIC = b"HTSNAP\x00\x01"
+
+
+def write_snapshot(db, path):
+    """
+    Writes the habits and check-offs of all users to a snapshot file. The file is replaced atomically,
+    readers of an older snapshot keep their mapping.
+    :param db: Database connection object.
+    :param path: Path of the snapshot file.
+    :return: tuple: (number of habits, number of check-offs)
+    """
+    cur = db.cursor()
+    started = not db.in_transaction
+    if started:
+        cur.execute("BEGIN")  # One read transaction, so habits and check-offs are consistent
+    try:
+        cur.execute("""SELECT habit.user_id, user.name, habit.id, habit.name, habit.periodicity
+        FROM habit JOIN user ON user.id = habit.user_id ORDER BY habit.user_id, habit.id""")
+        users = {}  # user id -> header entry
+        positions = {}  # habit id -> position in the names of its user
+        for user_id, user, habit_id, name, periodicity in cur.fetchall():
+            entry = users.setdefault(user_id, {"name": user, "names": [], "periodicities": []})
+            positions[habit_id] = len(entry["names"])
+            entry["names"].append(name)
+            entry["periodicities"].append(periodicity)
+
+        # One scan of the (user_id, habit_id, day) index, already in file order
+        habit_ids = array("i")
+        days = array("i")
+        for entry in users.values():
+            entry["start"] = entry["end"] = 0
+        cur.execute("SELECT user_id, habit_id, day FROM tracker ORDER BY user_id, habit_id, day")
+        for user_id, user_rows in groupby(cur, key=itemgetter(0)):
+            entry = users.get(user_id)
+            if entry is None:
+                continue
+            entry["start"] = len(days)
+            for habit_id, rows in groupby(user_rows, key=itemgetter(1)):
+                if habit_id in positions:
+                    count = len(days)
+                    days.extend(row[2] for row in rows)
+                    habit_ids.extend(repeat(positions[habit_id], len(days) - count))
+            entry["end"] = len(days)
+    finally:
+        if started:
+            db.rollback()
+
+    header = json.dumps({
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "byteorder": sys.byteorder,
+        "rows": len(days),
+        "users": list(users.values()),
+    }).encode()
+    header += b" " * (-(len(MAGIC) + 4 + len(header)) % 8)  # The columns start 8-byte aligned
+
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(MAGIC + struct.pack("<I", len(header)) + header)
+        habit_ids.tofile(file)
+        days.tofile(file)
+    os.replace(temporary, path)
+    return len(positions), len(days)
+
+
+class Snapshot:
+
+    def __init__(self, path):
+        """
+        Memory-mapped snapshot file, see write_snapshot.
+        :param path: Path of the snapshot file.
+        :raises ValueError: If the file is not a snapshot or was written on a machine with another byte order.
+        """
+        self.path = path
+        with open(path, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            self.mmap.close()
+            raise ValueError(f"{path} is not a habit tracker snapshot")
+        size = struct.unpack_from("<I", self.mmap, len(MAGIC))[0]
+        offset = len(MAGIC) + 4
+        self.header = json.loads(self.mmap[offset:offset + size])
+        if self.header["byteorder"] != sys.byteorder:
+            self.mmap.close()
+            raise ValueError(f"{path} was written with {self.header['byteorder']}-endian byte order")
+
+        rows = self.header["rows"]
+        self.view = memoryview(self.mmap)
+        start = offset + size
+        self.habit_ids = self.view[start:start + rows * 4].cast("i")
+        self.days = self.view[start + rows * 4:start + rows * 8].cast("i")
+
+    @property
+    def created(self):
+        """Time the snapshot was written (ISO format)."""
+        return self.header["created"]
+
+    @property
+    def users(self):
+        """Names of the users in the snapshot."""
+        return [entry["name"] for entry in self.header["users"]]
+
+    def columns(self, user="default"):
+        """
+        Returns the check-offs of a user as columns for columnar.py, without copying them.
+        :param user: Name of the user.
+        :return: columnar.Columns, with no habits if the user is not in the snapshot.
+        """
+        from columnar import Columns
+        for entry in self.header["users"]:
+            if entry["name"] == user:
+                start, end = entry["start"], entry["end"]
+                return Columns(entry["names"], entry["periodicities"], self.habit_ids[start:end], self.days[start:end])
+        return Columns([], [], self.habit_ids[0:0], self.days[0:0])
+
+    def close(self):
+        """Unmaps the file. Columns handed out before must not be used afterwards."""
+        try:
+            for view in (self.habit_ids, self.days, self.view):
+                view.release()
+            self.mmap.close()
+        except BufferError:
+            pass  # Columns are still referenced, the mapping is closed when they are garbage collected
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,151 @@
+# Streak rules shared by the database layer (streak_state maintenance) and the analytics module.
+#
+# Every check-off day is mapped to a calendar period ("bucket") of the habit's periodicity:
+# the day itself, the ISO week, the calendar month, the half-year or the year.
+# A streak is a run of consecutive period indices; several check-offs in one period count once.
+from datetime import date
+
+# NumPy is optional and only imported for the first large input (see load_numpy),
+# so commands that never process long histories don't pay for the import.
+np = None
+_numpy_loaded = False
+
+# Arrays with at least this many days are processed with NumPy, if it is installed.
+VECTORIZE_MIN = 512
+
+# Date ordinal of 1970-01-01, the NumPy datetime64 epoch.
+EPOCH_DAY = 719163
+
+def load_numpy():
+    """
+    Imports NumPy on first use.
+    :return: The numpy module, None if it is not installed.
+    """
+    global np, _numpy_loaded
+    if not _numpy_loaded:
+        _numpy_loaded = True
+        try:
+            import numpy
+            np = numpy
+        except ImportError:  # NumPy is optional, the pure Python path is used without it
+            np = None
+    return np
+
+def _vectorize(count):
+    """Checks whether an input of count values is processed with NumPy."""
+    return count >= VECTORIZE_MIN and load_numpy() is not None
+
+def period_index(day, periodicity):
+    """
+    Maps a day number to the index of the calendar period it belongs to.
+    Consecutive periods have consecutive indices.
+    :param day: Day number (date ordinal).
+    :param periodicity: Periodicity of the habit (daily, weekly, etc.).
+    :return: Period index.
+    """
+    periodicity = periodicity.lower()
+    if periodicity == "weekly":
+        return (day - 1) // 7  # Day 1 (0001-01-01) is a Monday, so weeks are ISO weeks
+    if periodicity in ("monthly", "bi-annually", "annually"):
+        d = date.fromordinal(day)
+        if periodicity == "monthly":
+            return d.year * 12 + d.month - 1
+        if periodicity == "bi-annually":
+            return d.year * 2 + (d.month - 1) // 6
+        return d.year
+    return day
+
+def period_indices(days, periodicity):
+    """
+    Maps many day numbers to period indices, see period_index.
+    :param days: Sequence of day numbers (list or NumPy array).
+    :param periodicity: Periodicity of the habit (daily, weekly, etc.).
+    :return: Period indices, a NumPy array for large inputs if NumPy is installed, a list otherwise.
+    """
+    if not _vectorize(len(days)):
+        return [period_index(day, periodicity) for day in days]
+
+    days = np.asarray(days, dtype=np.int64)
+    periodicity = periodicity.lower()
+    if periodicity == "weekly":
+        return (days - 1) // 7
+    if periodicity in ("monthly", "bi-annually", "annually"):
+        months = (days - EPOCH_DAY).astype("datetime64[D]").astype("datetime64[M]").astype(np.int64) + 1970 * 12
+        if periodicity == "monthly":
+            return months
+        if periodicity == "bi-annually":
+            return months // 6
+        return months // 12
+    return days
+
+def streak_runs(periods):
+    """
+    Calculates the longest streak and the length of the last streak.
+    :param periods: Sorted period indices of the check-offs (list or NumPy array).
+    :return: tuple: (longest streak, last streak)
+    """
+    if len(periods) == 0:
+        return 0, 0
+
+    if _vectorize(len(periods)):
+        periods = np.unique(periods)
+        ends = np.append(np.flatnonzero(np.diff(periods) != 1), len(periods) - 1)
+        lengths = np.diff(ends, prepend=-1)
+        return int(lengths.max()), int(lengths[-1])
+
+    streak = max_streak = 1
+    for i in range(1, len(periods)):
+        if periods[i] - periods[i - 1] == 1:
+            streak += 1
+        elif periods[i] != periods[i - 1]:
+            max_streak = max(max_streak, streak)
+            streak = 1
+
+    return max(max_streak, streak), streak
+
+def extend_streak(current, longest, last_period, period):
+    """
+    Updates a streak with a check-off that is not older than the last one.
+    :param current: Length of the last streak.
+    :param longest: Longest streak so far.
+    :param last_period: Period index of the last check-off, None if there is none.
+    :param period: Period index of the new check-off.
+    :return: tuple: (last streak, longest streak, last period)
+    """
+    if period == last_period:
+        return current, longest, last_period  # Same period, the streak does not change
+    if last_period is None or period - last_period != 1:
+        current = 0
+    current += 1
+    return current, max(longest, current), period
+
+def current_streak(last_streak, last_period, today_period):
+    """
+    Returns the last streak if it is still running, i.e. its last check-off
+    is in the current or in the previous period.
+    :param last_streak: Length of the last streak.
+    :param last_period: Period index of the last check-off, None if there is none.
+    :param today_period: Period index of today.
+    :return: Current streak.
+    """
+    if last_period is None or today_period - last_period > 1:
+        return 0
+    return last_streak
+
+def period_start(period, periodicity):
+    """
+    Returns the first day of a period, the inverse of period_index.
+    :param period: Period index.
+    :param periodicity: Periodicity of the habit (daily, weekly, etc.).
+    :return: date object.
+    """
+    periodicity = periodicity.lower()
+    if periodicity == "weekly":
+        return date.fromordinal(period * 7 + 1)
+    if periodicity == "monthly":
+        return date(period // 12, period % 12 + 1, 1)
+    if periodicity == "bi-annually":
+        return date(period // 2, period % 2 * 6 + 1, 1)
+    if periodicity == "annually":
+        return date(period, 1, 1)
+    return date.fromordinal(period)
@@ -0,0 +1,106 @@
+import queue
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+
+class TaskRunner:
+
+    def __init__(self, root, poll_interval=50):
+        """
+        Runs database and analytics calls of the GUI on a dedicated background thread,
+        so the Tk main loop never blocks. Results are handed back to the Tk thread,
+        which polls them with root.after.
+        :param root: Tk root window (anything with an after(ms, callback) method).
+        :param poll_interval: Milliseconds between two checks for finished tasks.
+        """
+        self.root = root
+        self.poll_interval = poll_interval
+        # One worker: SQLite allows a single writer anyway, and the thread keeps its own connection.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="habit-db")
+        self.finished = queue.Queue()
+        self.pending = {}  # key -> Future of the task whose result is still wanted
+        self.lock = threading.Lock()
+        self.closed = False
+        self.root.after(self.poll_interval, self._poll)
+
+    def submit(self, key, function, on_done=None, on_error=None, replace=False):
+        """
+        Queues a function for the background thread.
+        Tasks with the same key are coalesced: while one is queued or running, a new one is dropped,
+        unless replace is set, then the old one is cancelled and only the new result is delivered.
+        :param key: Name for coalescing, None for tasks that always run (e.g. writes).
+        :param function: Function without arguments, runs on the background thread.
+        :param on_done: Called on the Tk thread with the result.
+        :param on_error: Called on the Tk thread with the exception if the function raises.
+        :param replace: Replace a queued or running task with the same key instead of dropping this one.
+        :return: True if the task was queued, False if it was coalesced with a running one.
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            if key is not None and key in self.pending:
+                if not replace:
+                    return False
+                self.pending.pop(key).cancel()
+
+            future = self.executor.submit(function)
+            if key is not None:
+                self.pending[key] = future
+        future.add_done_callback(lambda f: self.finished.put((key, f, on_done, on_error)))
+        return True
+
+    def cancel(self, key):
+        """
+        Cancels a queued task. The result of a task that is already running is discarded.
+        :param key: Name of the task.
+        """
+        with self.lock:
+            future = self.pending.pop(key, None)
+        if future is not None:
+            future.cancel()
+
+    def is_pending(self, key):
+        """
+        Checks whether a task with the given key is queued or running.
+        :param key: Name of the task.
+        :return: True if the task has not been delivered yet.
+        """
+        with self.lock:
+            return key in self.pending
+
+    def shutdown(self):
+        """Cancels all queued tasks and stops the background thread after the running one."""
+        with self.lock:
+            self.closed = True
+            self.pending.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _poll(self):
+        """Delivers the results of finished tasks on the Tk thread."""
+        while True:
+            try:
+                key, future, on_done, on_error = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock:
+                if key is not None:
+                    if self.pending.get(key) is not future:
+                        continue  # Cancelled or replaced
+                    del self.pending[key]
+                if self.closed:
+                    continue
+            try:
+                result = future.result()
+            except CancelledError:
+                continue
+            except Exception as e:
+                if on_error:
+                    on_error(e)
+                else:
+                    print(f"Error in background task {key}: {e}")
+                continue
+            if on_done:
+                on_done(result)
+
+        if not self.closed:
+            self.root.after(self.poll_interval, self._poll)
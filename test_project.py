@@ -1,7 +1,11 @@
+import sqlite3
 import pytest
 from habit import Habit
-from db import get_db, add_habit, edit_habit, delete_habit, checkoff_habit, get_all_habits
-from analyse import get_habits_by_periodicity, get_longest_streak
+from db import (get_db, add_habit, edit_habit, delete_habit, checkoff_habit, get_all_habits, get_habit_checkoffs,
+                checkoff_many, iter_checkoffs, get_streak_state, rebuild_streak_state, iter_habits, get_habit_page,
+                get_user_id)
+from analyse import (get_habits_by_periodicity, get_longest_streak, get_all_streaks, calculate_streak, get_top_streaks,
+                     get_completion_rates, get_period_counts)
 
 class TestHabit:
     def setup_method(self):
@@ -33,13 +37,35 @@ class TestHabit:
         habit.store(self.db)
 
         cur = self.db.cursor()
-        cur.execute("SELECT * FROM habit WHERE name=?", ("test_habit_new",))
+        cur.execute("SELECT name, periodicity FROM habit WHERE name=?", ("test_habit_new",))
         result = cur.fetchone()
 
         assert result is not None
         assert result[0] == "test_habit_new"
         assert result[1] == "daily"
 
+    def test_habit_model(self):
+        """Test the slotted habit model, its check-off records and the identity map."""
+        from habit import CheckOff, HabitMap, Periodicity
+        habit = Habit("test_habit_slots", "Bi-Annually")
+        assert not hasattr(habit, "__dict__")
+        assert habit.periodicity == Periodicity.BI_ANNUALLY and str(habit) == "test_habit_slots: bi-annually"
+        with pytest.raises(ValueError):
+            Periodicity.parse("hourly")
+
+        habit.store(self.db)
+        habits = HabitMap(self.db)
+        assert habits.get("test_habit_slots").habit_id == habit.habit_id
+        assert habits.get("test_habit_daily") is habits.get("test_habit_daily")
+        assert habits[habits.get("test_habit_daily").habit_id].name == "test_habit_daily"
+        assert habits.get("missing") is None
+        checkoffs = habits.get("test_habit_weekly").checkoffs(self.db)
+        assert checkoffs[0] == CheckOff(habits.get("test_habit_weekly").habit_id, checkoffs[0].day)
+        assert str(checkoffs[0].date) == "2025-01-20"
+
+        habit.delete(self.db)
+        assert "test_habit_slots" not in get_all_habits(self.db)
+
     def test_habit_deletion(self):
         """Test deleting a habit removes it from the habit and tracker tables."""
         # First create habit
@@ -47,6 +73,7 @@ class TestHabit:
 
         # Add a check-off
         checkoff_habit(self.db, "test_habit_daily", "2025-02-25")
+        habit_id = self.db.execute("SELECT id FROM habit WHERE name=?", ("test_habit_daily",)).fetchone()[0]
 
         # Delete habit
         delete_habit(self.db, "test_habit_daily")
@@ -58,7 +85,7 @@ class TestHabit:
         assert result_habit is None  # Should be "None", since it was deleted
 
         # Check, if check-offs were deleted, too
-        cur.execute("SELECT * FROM tracker WHERE habitName=?", ("test_habit_daily",))
+        cur.execute("SELECT * FROM tracker WHERE habit_id=?", (habit_id,))
         result_tracker = cur.fetchone()
         assert result_tracker is None  # Should be "None" as well
 
@@ -82,9 +109,7 @@ class TestHabit:
         """Test logging a check-off for a habit."""
         checkoff_habit(self.db, "test_habit_daily")
 
-        cur = self.db.cursor()
-        cur.execute("SELECT * FROM tracker WHERE habitName=?", ("test_habit_daily",))
-        result = cur.fetchall()
+        result = get_habit_checkoffs(self.db, "test_habit_daily")
 
         assert len(result) > 0
 
@@ -97,6 +122,22 @@ class TestHabit:
 
         print(get_all_habits(self.db))
 
+    def test_habit_pages(self):
+        """Test streaming habits and loading them page by page."""
+        for i in range(5):
+            add_habit(self.db, f"test_habit_page_{i}", "daily")
+
+        assert list(iter_habits(self.db, batch_size=2)) == get_all_habits(self.db)
+        assert list(iter_habits(self.db, "weekly")) == ["test_habit_weekly"]
+
+        pages = []
+        page = get_habit_page(self.db, limit=3, periodicity="daily")
+        while page:
+            pages.append(page)
+            page = get_habit_page(self.db, after=page[-1], limit=3, periodicity="daily")
+        assert [len(page) for page in pages] == [3, 3]
+        assert sum(pages, []) == get_habits_by_periodicity(self.db, "daily")
+
     def test_get_habits_by_periodicity(self):
         """Test filtering habits by periodicity."""
         daily_habits = get_habits_by_periodicity(self.db, "daily")
@@ -113,8 +154,722 @@ class TestHabit:
 
         print(longest_streak_value)
 
+    def test_top_streaks_and_ranges(self):
+        """Test ranked streaks, ties and zero streaks, and the date range analytics."""
+        from datetime import date
+        today = date(2025, 1, 30)
+        assert get_top_streaks(self.db, 2) == [("test_habit_daily", 3), ("test_habit_weekly", 2)]
+        assert get_top_streaks(self.db, 3, by="current", today=today)[0] == ("test_habit_weekly", 2)
+
+        # Every streak is 0: the first habit by name is returned instead of (None, 0)
+        empty = get_db("test.db")
+        empty.execute("DELETE FROM streak_state")
+        empty.commit()
+        empty.close()
+        assert get_longest_streak(self.db) == ("test_habit_daily", 0)
+
+        rates = get_completion_rates(self.db, "2025-01-20", "2025-01-29")
+        assert rates == {"test_habit_daily": 0.4, "test_habit_monthly": 0.0, "test_habit_weekly": 1.0}
+        assert get_period_counts(self.db, "test_habit_weekly") == {"2025-01-20": 1, "2025-01-27": 1}
+        assert get_period_counts(self.db, "test_habit_daily", since="2025-01-26", until="2025-01-27") == \
+            {"2025-01-26": 1, "2025-01-27": 1}
+        assert get_period_counts(self.db, "missing") is None
+
+    def test_rollups(self):
+        """Test that counts per period come from the rollups and match the check-offs for any range."""
+        from analyse import get_checkoff_counts, _choose_grain
+        from db import rebuild_rollups, to_day
+        checkoff_many(self.db, [("test_habit_daily", "2024-12-31"), ("test_habit_monthly", "2025-02-03")])
+        assert _choose_grain("annually", None, None) == "annually"
+        assert _choose_grain("annually", to_day("2025-01-01"), to_day("2025-06-30")) == "monthly"
+        assert _choose_grain("monthly", to_day("2025-01-02"), None) == "daily"
+        assert _choose_grain("bi-annually", None, None) == "monthly"
+
+        monthly = {"test_habit_daily": {"2024-12-01": 1, "2025-01-01": 4}, "test_habit_monthly": {"2025-02-01": 1},
+                   "test_habit_weekly": {"2025-01-01": 2}}
+        assert get_checkoff_counts(self.db, "monthly") == monthly
+        assert get_checkoff_counts(self.db, "annually", until="2024-12-31") == {"test_habit_daily": {"2024-01-01": 1}}
+        assert get_checkoff_counts(self.db, "weekly", since="2025-01-26", until="2025-01-27") == \
+            {"test_habit_daily": {"2025-01-20": 1, "2025-01-27": 1}, "test_habit_weekly": {"2025-01-27": 1}}
+        assert get_period_counts(self.db, "test_habit_daily", per="annually") == {"2024-01-01": 1, "2025-01-01": 4}
+
+        self.db.execute("DELETE FROM checkoff_rollup")
+        self.db.commit()
+        rebuild_rollups(self.db)
+        assert get_checkoff_counts(self.db, "monthly") == monthly
+        delete_habit(self.db, "test_habit_monthly")
+        assert self.db.execute("SELECT grain, COUNT(*) FROM checkoff_rollup GROUP BY grain").fetchall() == \
+            [("annually", 3), ("monthly", 3), ("weekly", 5)]
+
+    def test_day_bitmaps(self):
+        """Test per-day lookups and streaks as of a day, read from the day bitmaps."""
+        from analyse import get_done_on, get_streak_as_of
+        from db import get_day_bitmap, has_checkoff
+        checkoff_habit(self.db, "test_habit_daily", "2025-01-20")  # Older than the first check-off
+        checkoff_many(self.db, [("test_habit_monthly", "2025-01-26")])
+        assert has_checkoff(self.db, "test_habit_daily", "2025-01-20")
+        assert not has_checkoff(self.db, "test_habit_daily", "2025-01-28")
+        assert not has_checkoff(self.db, "missing", "2025-01-28")
+        assert get_done_on(self.db, "2025-01-26") == ["test_habit_daily", "test_habit_monthly"]
+        assert get_done_on(self.db, "2025-01-27") == ["test_habit_daily", "test_habit_weekly"]
+
+        assert get_streak_as_of(self.db, "test_habit_daily", "2025-01-26") == (2, 2)
+        assert get_streak_as_of(self.db, "test_habit_daily", "2025-01-28") == (3, 3)  # Yesterday still counts
+        assert get_streak_as_of(self.db, "test_habit_daily", "2025-01-31") == (3, 0)
+        assert get_streak_as_of(self.db, "test_habit_weekly", "2025-01-26") == (1, 1)
+        assert get_streak_as_of(self.db, "test_habit_weekly", "2025-02-02") == (2, 2)
+        assert get_streak_as_of(self.db, "missing", "2025-02-02") is None
+
+        delete_habit(self.db, "test_habit_monthly")
+        assert get_done_on(self.db, "2025-01-26") == ["test_habit_daily"]
+        assert get_day_bitmap(self.db, "test_habit_monthly") is None
+
+    def test_all_streaks(self):
+        """Test calculating longest and current streaks of all habits in one pass."""
+        from datetime import date
+        streaks = get_all_streaks(self.db, today=date(2025, 1, 30))
+
+        assert streaks["test_habit_daily"] == (3, 1)
+        assert streaks["test_habit_weekly"] == (2, 2)
+        assert streaks["test_habit_monthly"] == (0, 0)
+
+    def test_streak_state(self):
+        """Test that stored streaks are updated on check-off and match a full recalculation."""
+        from datetime import date
+        today = date(2025, 1, 30)
+        assert get_streak_state(self.db, "test_habit_daily", today) == (3, 1)
+
+        # Closing the gap is an out-of-order check-off
+        checkoff_habit(self.db, "test_habit_daily", "2025-01-28")
+        assert get_streak_state(self.db, "test_habit_daily", today) == (5, 5)
+        assert calculate_streak(self.db, "test_habit_daily") == 5
+
+        # A new periodicity recalculates the streak, Jan 25-26 and Jan 27-29 are two consecutive ISO weeks
+        edit_habit(self.db, "test_habit_daily", "weekly")
+        assert get_streak_state(self.db, "test_habit_daily", today) == (2, 2)
+
+        state = get_all_streaks(self.db, today)
+        rebuild_streak_state(self.db)
+        assert get_all_streaks(self.db, today) == state
+
+        delete_habit(self.db, "test_habit_daily")
+        assert get_streak_state(self.db, "test_habit_daily") is None
+
+    def test_analytics_cache(self):
+        """Test that analytics results are cached until the database is written."""
+        from cache import analytics_cache
+        analytics_cache.clear()
+
+        assert get_longest_streak(self.db) == get_longest_streak(self.db)
+        assert analytics_cache.stats()["hits"] >= 1
+
+        # A write invalidates the cached result
+        for day in range(1, 6):
+            checkoff_habit(self.db, "test_habit_monthly", f"2025-0{day}-01")
+        assert get_longest_streak(self.db) == ("test_habit_monthly", 5)
+
+        # So does a commit through another connection
+        assert "test_habit_monthly" in get_habits_by_periodicity(self.db, "monthly")
+        other = get_db("test.db")
+        other.execute("DELETE FROM habit WHERE name='test_habit_monthly'")
+        other.commit()
+        other.close()
+        assert "test_habit_monthly" not in get_habits_by_periodicity(self.db, "monthly")
+
+        # Callers can't change cached results, not even nested ones
+        from analyse import get_checkoff_counts
+        counts = get_checkoff_counts(self.db, "monthly")
+        habit = next(iter(counts))
+        counts[habit]["2000-01-01"] = 999
+        assert "2000-01-01" not in get_checkoff_counts(self.db, "monthly")[habit]
+
+    def test_analytics_cache_per_connection(self, tmp_path):
+        """Test that a new connection to another file never gets the cached results of a closed one."""
+        for path, name, days in ((tmp_path / "a.db", "A", 2), (tmp_path / "b.db", "B", 1)):
+            db = get_db(str(path), seed=False)
+            add_habit(db, name, "daily")
+            for day in range(1, days + 1):
+                checkoff_habit(db, name, f"2025-01-0{day}")
+            db.close()
+        for _ in range(20):
+            for path, expected in ((tmp_path / "a.db", ("A", 2)), (tmp_path / "b.db", ("B", 1))):
+                db = get_db(str(path), seed=False)
+                assert get_longest_streak(db) == expected
+                db.close()
+                del db
+
+    def test_daemon_requests(self, tmp_path, monkeypatch):
+        """Test the daemon protocol and the fallback when no daemon is running."""
+        import json
+        import daemon
+        monkeypatch.setenv("HABITTRACKER_SOCKET", str(tmp_path / "missing.sock"))
+        with pytest.raises(daemon.DaemonUnavailable):
+            daemon.request("longest_streak")
+
+        response = json.loads(daemon.handle(self.db, b'{"op": "create", "params": {"name": "Yoga", "periodicity": "daily"}}'))
+        assert response["ok"] and response["output"] == ""
+        response = json.loads(daemon.handle(self.db, b'{"op": "list_habits", "params": {"periodicity": "daily"}}'))
+        assert response["result"] == ["Yoga", "test_habit_daily"]
+        response = json.loads(daemon.handle(self.db, b'{"op": "unknown"}'))
+        assert not response["ok"]
+
+    def test_checkoff_many(self):
+        """Test importing check-offs in batches and streaming them back."""
+        batches = []
+        checkoffs = (("test_habit_weekly", f"2025-02-{day:02d}") for day in (3, 10, 17, 3))
+        inserted = checkoff_many(self.db, checkoffs, batch_size=2, progress=lambda *args: batches.append(args))
+
+        assert inserted == 3  # The repeated check-off is ignored
+        assert batches == [(2, 2), (4, 3)]
+        assert ("test_habit_weekly", "2025-02-17") in list(iter_checkoffs(self.db, batch_size=2))
+
+        with pytest.raises(sqlite3.IntegrityError):
+            checkoff_many(self.db, [("test_habit_weekly", "2025-02-03")], on_duplicate="error")
+
+    def test_columnar_backend(self, monkeypatch):
+        """Test that the columnar backend agrees with the stored streaks and rollups, with and without NumPy."""
+        from datetime import date
+        import columnar
+        import streaks
+        from analyse import get_checkoff_counts, get_completion_rates, get_top_streaks
+        from cache import analytics_cache
+        today = date(2025, 1, 30)
+
+        for numpy in (streaks.np, None):
+            monkeypatch.setattr(streaks, "np", numpy)
+            monkeypatch.setattr(columnar, "np", numpy)
+            analytics_cache.clear()  # The cache doesn't know about NumPy
+            assert get_all_streaks(self.db, today, backend="columnar") == get_all_streaks(self.db, today)
+            assert (get_top_streaks(self.db, 2, "current", today, backend="columnar")
+                    == get_top_streaks(self.db, 2, "current", today))
+            rates = get_completion_rates(self.db, "2025-01-20", "2025-01-29", backend="columnar")
+            assert rates == get_completion_rates(self.db, "2025-01-20", "2025-01-29")
+            assert rates["test_habit_daily"] == 0.4
+            assert rates["test_habit_weekly"] == 1.0
+            for periodicity, since in (("weekly", None), ("monthly", "2025-01-02"), ("daily", "2025-01-21")):
+                assert (get_checkoff_counts(self.db, periodicity, since, backend="columnar")
+                        == get_checkoff_counts(self.db, periodicity, since))
+            counts = columnar.period_counts(columnar.load_columns(self.db))  # The periodicity of each habit
+            assert sum(counts["test_habit_daily"].values()) == 4
+            assert list(counts["test_habit_weekly"].values()) == [1, 1]
+        with pytest.raises(ValueError):
+            get_all_streaks(self.db, today, backend="pandas")
+
+    def test_snapshot(self, tmp_path):
+        """Test that analytics on a memory-mapped snapshot match the database and copy no check-offs."""
+        from datetime import date
+        from analyse import get_snapshot_completion_rates, get_snapshot_top_streaks
+        from snapshot import Snapshot, write_snapshot
+        today = date(2025, 1, 30)
+        path = str(tmp_path / "test.snapshot")
+        assert write_snapshot(self.db, path) == (3, 6)
+        checkoff_habit(self.db, "test_habit_monthly", "2025-01-29")  # Not in the snapshot
+
+        with Snapshot(path) as snapshot:
+            assert snapshot.users == ["default"]
+            columns = snapshot.columns()
+            assert isinstance(columns.days, memoryview) and columns.days.obj is snapshot.mmap
+            assert list(columns.days) == [739276, 739277, 739278, 739280, 739271, 739278]
+            assert get_snapshot_top_streaks(snapshot, 3, today=today) == \
+                [("test_habit_daily", 3), ("test_habit_weekly", 2), ("test_habit_monthly", 0)]
+            assert get_snapshot_completion_rates(snapshot, "2025-01-20", "2025-01-29") == \
+                {"test_habit_daily": 0.4, "test_habit_monthly": 0.0, "test_habit_weekly": 1.0}
+            assert get_snapshot_top_streaks(snapshot, user="missing") == []
+            del columns
+
+        (tmp_path / "broken.snapshot").write_bytes(b"not a snapshot")
+        with pytest.raises(ValueError):
+            Snapshot(str(tmp_path / "broken.snapshot"))
+
+    def test_users(self):
+        """Test that every user has their own habits, check-offs and streaks."""
+        from datetime import date
+        anna = get_user_id(self.db, "anna", create=True)
+        assert get_user_id(self.db, "anna") == anna
+        assert get_user_id(self.db, "nobody") is None
+
+        add_habit(self.db, "test_habit_daily", "weekly", user_id=anna)  # Same name as a habit of the default user
+        checkoff_habit(self.db, "test_habit_daily", "2025-01-28", user_id=anna)
+        assert get_all_habits(self.db, user_id=anna) == ["test_habit_daily"]
+        assert get_all_habits(self.db, user_id=None) == []
+        assert get_habit_checkoffs(self.db, "test_habit_daily", user_id=anna) == [("2025-01-28", "test_habit_daily")]
+        assert get_all_streaks(self.db, date(2025, 1, 30), user_id=anna) == {"test_habit_daily": (1, 1)}
+        assert get_streak_state(self.db, "test_habit_daily", date(2025, 1, 30)) == (3, 1)
+
+        delete_habit(self.db, "test_habit_daily", user_id=anna)
+        assert len(get_habit_checkoffs(self.db, "test_habit_daily")) == 4
+
+        # Queries of one user only search that user's part of the index
+        plan = self.db.execute("EXPLAIN QUERY PLAN SELECT day FROM tracker WHERE user_id=? AND habit_id=? ORDER BY day",
+                               (anna, 1)).fetchall()
+        assert "tracker_user_habit_day" in plan[0][-1]
+
     def teardown_method(self):
         """Cleanup the test database after each test."""
         import os
-        if os.path.exists("test.db"):
-            os.remove("test.db")
\ No newline at end of file
+        self.db.close()
+        for path in ("test.db", "test.db-wal", "test.db-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+
+class TestSchema:
+    def test_legacy_database_upgrade(self, tmp_path):
+        """Test that an old database is upgraded in place and duplicate check-offs are removed."""
+        path = str(tmp_path / "legacy.db")
+        legacy = sqlite3.connect(path)
+        legacy.execute("CREATE TABLE habit (name TEXT PRIMARY KEY, periodicity TEXT)")
+        legacy.execute("CREATE TABLE tracker(date TEXT, habitName TEXT)")
+        legacy.execute("INSERT INTO habit VALUES ('Reading', 'daily')")
+        legacy.executemany("INSERT INTO tracker VALUES (?, ?)",
+                           [("2025-01-01", "Reading"), ("2025-01-01", "Reading"), ("2025-01-02", "Reading")])
+        legacy.commit()
+        legacy.close()
+
+        db = get_db(path)
+        cur = db.cursor()
+        assert cur.execute("PRAGMA user_version").fetchone()[0] >= 1
+        assert get_habit_checkoffs(db, "Reading") == [("2025-01-01", "Reading"), ("2025-01-02", "Reading")]
+
+        # The same check-off is only stored once
+        checkoff_habit(db, "Reading", "2025-01-02")
+        assert len(get_habit_checkoffs(db, "Reading")) == 2
+        db.close()
+
+    def test_failed_upgrade_is_rolled_back(self, tmp_path, monkeypatch):
+        """Test that a migration that fails halfway leaves the old database unchanged and can be retried."""
+        import db as db_module
+        path = str(tmp_path / "legacy.db")
+        legacy = sqlite3.connect(path)
+        legacy.execute("CREATE TABLE habit (name TEXT PRIMARY KEY, periodicity TEXT)")
+        legacy.execute("CREATE TABLE tracker(date TEXT, habitName TEXT)")
+        legacy.execute("INSERT INTO habit VALUES ('Reading', 'daily')")
+        legacy.execute("INSERT INTO tracker VALUES ('2025-01-01', 'Reading')")
+        legacy.commit()
+        legacy.close()
+
+        def fail(*_args):
+            raise RuntimeError("disk full")
+        monkeypatch.setattr(db_module, "_remove_duplicates", fail)  # After tracker was renamed and recreated
+        with pytest.raises(RuntimeError):
+            get_db(path, seed=False)
+        legacy = sqlite3.connect(path)
+        assert legacy.execute("PRAGMA user_version").fetchone()[0] == 0
+        assert [row[0] for row in legacy.execute("SELECT name FROM sqlite_master ORDER BY name")] == \
+            ["habit", "sqlite_autoindex_habit_1", "tracker"]
+        legacy.close()
+
+        monkeypatch.undo()
+        db = get_db(path, seed=False)
+        assert db.execute("SELECT COUNT(*) FROM tracker").fetchone()[0] == 1
+        db.close()
+
+    def test_concurrent_first_open(self, tmp_path):
+        """Test that threads opening a new database at the same time upgrade it once."""
+        import threading
+        path = str(tmp_path / "fresh.db")
+        errors = []
+
+        def open_database():
+            try:
+                get_db(path).close()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=open_database) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        db = get_db(path)
+        assert "tracker_v0" not in {row[0] for row in db.execute("SELECT name FROM sqlite_master")}
+        assert len(get_all_habits(db)) == 5
+        db.close()
+
+    def test_default_data_is_seeded_once(self, tmp_path):
+        """Test that default check-offs are not inserted again when the database is reopened."""
+        path = str(tmp_path / "seed.db")
+        get_db(path).close()
+        get_db(path).close()
+
+        db = get_db(path)
+        assert len(get_habit_checkoffs(db, "Yoga")) == 6
+        db.close()
+
+        # Seeding can be switched off for new databases
+        db = get_db(str(tmp_path / "empty.db"), seed=False)
+        assert get_all_habits(db) == []
+        db.close()
+
+
+class TestConnection:
+    def test_session_reuses_connection(self, tmp_path):
+        """Test that sessions share one tuned connection per thread and roll back on errors."""
+        from connection import session, get_connection, close_connection
+        path = str(tmp_path / "pool.db")
+
+        with session(path) as db:
+            add_habit(db, "pooled_habit", "daily")
+        assert get_connection(path) is db
+        assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+        with pytest.raises(RuntimeError):
+            with session(path) as db:
+                db.execute("INSERT INTO habit (name, periodicity) VALUES ('rolled_back', 'daily')")
+                raise RuntimeError("abort")
+        assert "rolled_back" not in get_all_habits(db)
+
+        close_connection(path)
+        assert get_connection(path) is not db
+        close_connection(path)
+
+    def test_readonly_session_and_startup_profile(self, tmp_path, monkeypatch):
+        """Test that read-only commands can't write and that the CLI reports its startup times."""
+        from click.testing import CliRunner
+        from connection import session, close_connection
+        from main import cli
+        path = str(tmp_path / "readonly.db")
+        with pytest.raises(sqlite3.OperationalError):
+            with session(path, readonly=True) as db:
+                add_habit(db, "not_written", "daily")
+        with session(path) as db:
+            add_habit(db, "written", "daily")
+        close_connection(path)
+
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv("HABITTRACKER_NO_DAEMON", "1")
+        result = CliRunner().invoke(cli, ["--profile-startup", "longest-streak"])
+        assert result.exit_code == 0
+        assert "Startup profile" in result.output and "open database" in result.output
+        close_connection()
+
+    def test_import_reports_invalid_records(self, tmp_path, monkeypatch):
+        """Test that malformed import records stop the import with their line number instead of a traceback."""
+        from click.testing import CliRunner
+        from connection import close_connection
+        from main import cli
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv("HABITTRACKER_NO_DAEMON", "1")
+        files = [
+            ("short.csv", "habit,date\nReading,2025-01-01\nReading\n", 3),
+            ("date.csv", "Reading,2025-02-30\n", 1),
+            ("key.jsonl", '{"habit": "Reading", "date": "2025-01-01"}\n\n{"habit": "Reading"}\n', 3),
+        ]
+        for name, content, line in files:
+            (tmp_path / name).write_text(content)
+            result = CliRunner().invoke(cli, ["import", name])
+            assert result.exit_code == 1 and not isinstance(result.exception, (IndexError, KeyError))
+            assert f"line {line}:" in result.output
+        close_connection()
+
+
+class TestInstrument:
+    def test_queries_rows_commits_and_spans(self, tmp_path, monkeypatch):
+        """Test that enabled instrumentation counts queries, rows, commits and times the analytics spans."""
+        import json
+        import instrument
+        monkeypatch.setattr(instrument, "stats", None)
+        db = get_db(str(tmp_path / "plain.db"))
+        assert db.row_factory is None  # Nothing is installed while disabled
+        db.close()
+
+        stats = instrument.enable(str(tmp_path / "stats.jsonl"))
+        db = get_db(str(tmp_path / "traced.db"))
+        checkoff_habit(db, "Yoga", "2025-01-01")
+        calculate_streak(db, "Yoga")
+        calculate_streak(db, "Yoga")
+        db.close()
+
+        stats.write("test")
+        snapshot = json.loads((tmp_path / "stats.jsonl").read_text())
+        assert snapshot["command"] == "test"
+        assert snapshot["queries"] > 0 and snapshot["rows"] > 0 and snapshot["commits"] >= 2
+        assert snapshot["spans"]["calculate_streak"]["count"] == 2
+        assert any("INSERT OR IGNORE INTO tracker" in sql for sql in snapshot["statements"])
+        assert 'span="calculate_streak"' in instrument.prometheus_text(snapshot)
+
+    def test_stats_bypass_the_daemon(self, tmp_path, monkeypatch):
+        """Test that --stats runs the command in the CLI process, where its queries are counted."""
+        import json
+        import daemon
+        import instrument
+        from click.testing import CliRunner
+        from connection import close_connection
+        from main import cli
+
+        def request(*_args, **_kwargs):
+            raise AssertionError("the daemon was used")
+        monkeypatch.setattr(daemon, "request", request)
+        monkeypatch.setattr(instrument, "stats", None)
+        monkeypatch.chdir(tmp_path)
+        close_connection()
+        result = CliRunner().invoke(cli, ["--stats", "stats.jsonl", "top-streaks", "--limit", "1"])
+        assert result.exit_code == 0, result.output
+        assert json.loads((tmp_path / "stats.jsonl").read_text())["queries"] > 0
+        close_connection()
+
+
+class TestEventLog:
+    def test_log_is_merged_and_compacted(self, tmp_path):
+        """Test that logged check-offs count for the streaks and reports before and after they are compacted."""
+        from eventlog import EventLog
+        import operations
+        db = get_db(str(tmp_path / "log.db"), seed=False)
+        add_habit(db, "Walk", "daily")
+        checkoff_habit(db, "Walk", "2025-03-01")
+        log = EventLog.for_connection(db)
+        assert log.path == str(tmp_path / "log.db.checkoffs.log") and not log.has_pending()
+
+        log.append([("Walk", "2025-03-02"), ("Walk", "2025-03-03"), ("Unknown", "2025-03-03")])
+        with pytest.raises(ValueError):
+            log.append([("Walk", "2024-13-45")])
+        with open(log.path, "a") as file:
+            file.write('{"user": "default", "habit": "Walk", "date": "2024-13-45"}\n')  # Written by an older version
+            file.write('{"user": "default", "habit": "Walk"')  # Torn write of a crashed process
+        assert log.has_pending() and get_longest_streak(db) == ("Walk", 1)
+        assert operations.longest_streak(db) == ["Walk", 3]
+        assert operations.top_streaks(db, 1, "longest") == [["Walk", 3]]
+        assert operations.completion_rates(db, "2025-03-01", "2025-03-04") == {"Walk": 0.75}
+        log.append([("Walk", "2025-03-01"), ("Walk", "2025-02-27")])  # Already stored, before the first check-off
+        assert operations.period_counts(db, "Walk", per="monthly") == {"2025-02-01": 1, "2025-03-01": 3}
+        assert operations.period_counts(db, "Walk", since="2025-03-02") == {"2025-03-02": 1, "2025-03-03": 1}
+        assert operations.period_counts(db, "Unknown") is None
+
+        assert log.compact(db) == 3
+        assert not log.has_pending() and log.compact(db) == 0
+        assert operations.period_counts(db, "Walk", per="monthly") == {"2025-02-01": 1, "2025-03-01": 3}
+        assert get_longest_streak(db) == ("Walk", 3)
+        assert [day for day, _name in get_habit_checkoffs(db, "Walk")] == ["2025-02-27", "2025-03-01", "2025-03-02",
+                                                                           "2025-03-03"]
+        db.close()
+
+
+class TestStreaks:
+    def test_calendar_periods(self):
+        """Test that streaks are counted on calendar periods instead of exact gaps."""
+        from datetime import date
+        from streaks import period_indices, streak_runs
+
+        def streak(dates, periodicity):
+            return streak_runs(sorted(period_indices([date.fromisoformat(d).toordinal() for d in dates], periodicity)))
+
+        assert streak(["2025-01-06", "2025-01-06", "2025-01-07"], "daily") == (2, 2)
+        assert streak(["2025-01-06", "2025-01-19", "2025-01-20"], "weekly") == (3, 3)  # Monday, then Sunday
+        assert streak(["2025-01-31", "2025-02-01", "2025-04-01"], "monthly") == (2, 1)
+        assert streak(["2024-06-30", "2024-07-01", "2025-01-01"], "bi-annually") == (3, 3)
+        assert streak(["2023-12-31", "2024-01-01"], "annually") == (2, 2)
+
+    def test_bitmap_runs(self):
+        """Test that the runs of a day bitmap match the check-off days."""
+        import random
+        import bitmap
+        from streaks import streak_runs
+        days = sorted(random.Random(7).sample(range(739000, 739400), 250))
+        first_day, bits = bitmap.from_days(days)
+        assert list(bitmap.iter_days(first_day, bits)) == days
+        assert max(length for _start, length in bitmap.iter_runs(first_day, bits)) == streak_runs(days)[0]
+        assert bitmap.run_until(first_day, bits, days[-1]) == streak_runs(days)[1]
+        assert bitmap.add_day(*bitmap.add_day(first_day, bits, 738990), 739500) == \
+            bitmap.from_days(days + [738990, 739500])
+
+    def test_vectorized_periods_match_python(self, monkeypatch):
+        """Test that the NumPy path gives the same results as the pure Python path."""
+        import streaks
+        pytest.importorskip("numpy")
+        days = sorted(738000 + i * 3 + (i % 7) // 5 * 40 for i in range(2000))
+
+        for periodicity in ("daily", "weekly", "monthly", "bi-annually", "annually"):
+            vectorized = streaks.streak_runs(streaks.period_indices(days, periodicity))
+            monkeypatch.setattr(streaks, "np", None)
+            assert streaks.streak_runs(streaks.period_indices(days, periodicity)) == vectorized
+            monkeypatch.undo()
+
+
+class TestBench:
+    def test_generator_is_deterministic(self, tmp_path):
+        """Test that the benchmark data generator gives the same data for the same seed."""
+        from bench.generate import generate
+        exports = []
+        for name in ("a.db", "b.db"):
+            path = str(tmp_path / name)
+            assert generate(path, habits=20, days=60, seed=7) > 0
+            db = get_db(path, seed=False)
+            exports.append(list(iter_checkoffs(db)))
+            db.close()
+        assert exports[0] == exports[1]
+
+    def test_existing_database_is_not_changed(self, tmp_path):
+        """Test that benchmarking an existing database with --db leaves the file as it was."""
+        from click.testing import CliRunner
+        from bench.generate import generate
+        from bench.run import main
+        path = str(tmp_path / "user.db")
+        generate(path, habits=5, days=30, seed=1)
+        before = (tmp_path / "user.db").read_bytes()
+        result = CliRunner().invoke(main, ["--db", path, "--repeat", "2"])
+        assert result.exit_code == 0 and '"checkoff_habit"' in result.output
+        assert (tmp_path / "user.db").read_bytes() == before
+
+    def test_stress_harness(self, tmp_path):
+        """Test a short stress run with writer and reader threads and its integrity check."""
+        from bench.stress import run_stress
+        results = run_stress(str(tmp_path / "stress.db"), writers=2, readers=1, duration=0.3, mode="thread",
+                             habits=5, batch=3)
+        assert results["writers"]["checkoffs"] > 0 and results["readers"]["ops"] > 0
+        assert results["writers"]["latency"]["p50"] <= results["writers"]["latency"]["p99"]
+        assert results["integrity"]["ok"] and results["integrity"]["rows"] == results["writers"]["checkoffs"]
+        assert "cache_hit_rate" not in results["readers"]
+        cached = run_stress(str(tmp_path / "cached.db"), writers=1, readers=1, duration=0.2, mode="thread", habits=5,
+                            cache=True)
+        assert 0 < cached["readers"]["cache_hit_rate"] <= 1
+
+class TestShards:
+    def test_shards_are_merged(self, tmp_path):
+        """Test that summaries of several database files are merged into global leaderboards."""
+        from datetime import date
+        from shards import analyse_shards
+        for shard, (user, days) in enumerate([("anna", 3), ("ben", 5)]):
+            db = get_db(str(tmp_path / f"shard{shard}.db"), seed=False)
+            user_id = get_user_id(db, user, create=True)
+            add_habit(db, "Reading", "daily", user_id=user_id)
+            add_habit(db, "Groceries", "weekly", user_id=user_id)
+            checkoff_many(db, [("Reading", f"2025-01-{day:02d}") for day in range(1, days + 1)], user_id=user_id)
+            db.close()
+
+        for workers in (1, 2):
+            summary = analyse_shards([str(tmp_path / "shard*.db")], k=2, workers=workers, today=date(2025, 1, 5))
+            assert (summary["shards"], summary["users"], summary["habits"], summary["checkoffs"]) == (2, 2, 4, 8)
+            assert summary["periodicities"] == {"daily": 2, "weekly": 2}
+            assert summary["longest"] == [(5, "ben", "Reading"), (3, "anna", "Reading")]
+            assert summary["current"][0] == (5, "ben", "Reading")
+
+    def test_shards_are_read_only(self, tmp_path):
+        """Test that missing shards and shards with another schema version are refused and left unchanged."""
+        import sqlite3
+        from shards import shard_summary
+        missing = tmp_path / "typo.db"
+        with pytest.raises(FileNotFoundError):
+            shard_summary(str(missing))
+        assert not missing.exists()
+
+        old = tmp_path / "old.db"
+        db = sqlite3.connect(old)
+        db.execute("PRAGMA user_version = 1")
+        db.close()
+        with pytest.raises(ValueError):
+            shard_summary(str(old))
+        db = sqlite3.connect(old)
+        assert db.execute("PRAGMA user_version").fetchone()[0] == 1
+        db.close()
+
+
+class FakeRoot:
+    """Stands in for the Tk root window: collects the callbacks scheduled with after()."""
+    def __init__(self):
+        self.callbacks = []
+
+    def after(self, _ms, callback):
+        self.callbacks.append(callback)
+
+    def run_pending(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class TestTasks:
+    def test_tasks_are_coalesced_and_delivered_on_poll(self):
+        """Test that repeated requests run once and results arrive through root.after."""
+        import threading
+        from tasks import TaskRunner
+        root = FakeRoot()
+        runner = TaskRunner(root)
+        release = threading.Event()
+        calls, results = [], []
+
+        def slow():
+            calls.append(1)
+            release.wait(5)
+            return len(calls)
+
+        assert runner.submit("streak", slow, results.append)
+        assert not runner.submit("streak", slow, results.append)  # Coalesced with the running task
+        assert runner.submit("other", lambda: "replaced", results.append)
+        assert runner.submit("other", lambda: "latest", results.append, replace=True)
+        release.set()
+        runner.executor.shutdown(wait=True)
+
+        root.run_pending()
+        assert sorted(results, key=str) == [1, "latest"]
+        assert not runner.is_pending("streak")
+        runner.shutdown()
+
+
+class TestAsync:
+    def test_concurrent_checkoffs_are_batched(self, tmp_path):
+        """Test the asyncio API: concurrent check-offs end up in few transactions."""
+        import asyncio
+        from aio import AsyncHabitTracker
+        path = str(tmp_path / "async.db")
+
+        async def scenario():
+            async with AsyncHabitTracker(path, max_queue=50) as tracker:
+                await tracker.add_habit("Reading", "daily")
+                days = [f"2025-03-{day:02d}" for day in range(1, 31)]
+                results = await asyncio.gather(*(tracker.checkoff_habit("Reading", day) for day in days + days[:5]))
+                assert results.count(True) == 30
+                assert tracker.batches < len(results)
+                assert await tracker.calculate_streak("Reading") == 30
+                assert await tracker.get_longest_streak() == ("Reading", 30)
+                assert "Reading" in await tracker.get_all_habits()
+
+        asyncio.run(scenario())
+
+    def test_failing_checkoff_does_not_fail_its_batch(self, tmp_path, monkeypatch):
+        """Test that an invalid check-off only fails its own caller, not the others written with it."""
+        import asyncio
+        import aio
+        path = str(tmp_path / "async.db")
+        real_batch = aio.checkoff_batch
+
+        def checkoff_batch(db, checkoffs, user_id):
+            if ("Unknown", None) in checkoffs:
+                raise RuntimeError("write failed")
+            return real_batch(db, checkoffs, user_id=user_id)
+        monkeypatch.setattr(aio, "checkoff_batch", checkoff_batch)
+
+        async def scenario():
+            async with aio.AsyncHabitTracker(path) as tracker:
+                await tracker.add_habit("Reading", "daily")
+                results = await asyncio.gather(tracker.checkoff_habit("Reading", "2025-01-01"),
+                                               tracker.checkoff_habit("Reading", "not-a-date"),
+                                               tracker.checkoff_habit("Unknown"),
+                                               tracker.checkoff_habit("Reading", "2025-01-02"),
+                                               return_exceptions=True)
+                assert results[0] is True and results[3] is True
+                assert isinstance(results[1], ValueError) and isinstance(results[2], RuntimeError)
+                assert await tracker.calculate_streak("Reading") == 2
+
+        asyncio.run(scenario())
+
+    def test_close_closes_the_worker_connections(self, tmp_path):
+        """Test that closing the tracker closes the connections of its reader and writer threads."""
+        import asyncio
+        import connection
+        from aio import AsyncHabitTracker
+        path = str(tmp_path / "async.db")
+        pooled = len(connection._connections)
+
+        async def scenario():
+            tracker = AsyncHabitTracker(path, workers=2)
+            async with tracker:
+                await tracker.add_habit("Reading", "daily")
+                await asyncio.gather(*(tracker.get_all_habits() for _ in range(10)))
+                opened = list(tracker.connections)
+            assert opened and not tracker.connections
+            for db in opened:
+                with pytest.raises(sqlite3.ProgrammingError):
+                    db.execute("SELECT 1")
+
+        for _ in range(3):
+            asyncio.run(scenario())
+        assert len(connection._connections) == pooled